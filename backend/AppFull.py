@@ -1,19 +1,34 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask_mail import Mail, Message
 from neo4j_conn_Final import (
-    get_driver, Cart, History, Recommendation, User,
-    driver, log_view, log_like, add_to_wishlist, remove_from_wishlist,
-    log_purchase, log_return, get_user_history, recommend_products,
-    recommend_products_advanced, get_user_segment, item_based_recommendations,
-    seasonal_promotions, manual_adjustment, add_to_cart, remove_from_cart, get_cart, checkout
+    get_driver, Cart, History, Recommendation, Review, User, driver, pool_metrics
+)
+from cache import recommendation_cache, product_cache
+from ingest import ingestor, IngestQueueFull
+from audit import audit_writer
+from mail_outbox import outbox
+from cart_store import cart_store
+from promotions import promotions, purchased_ids, MANUAL
+from schema import ensure_schema, SchemaManager
+from segments import SegmentationJob
+from history_compaction import ViewCompactionJob
+from jobs import jobs
+from bulk_loader import BulkLoader, read_ndjson, decode_resume, BULK_MAX_BATCH_SIZE, BULK_MAX_PARALLELISM
+from catalog_import import ProductImporter, read_request_body
+from streaming import stream_rows, stream_object, iter_query, json_response, wants_ndjson
+from search_index import (
+    search_index, SEARCH_BACKEND, SORT_FIELDS, paginate, price_buckets, encode_cursor, decode_cursor, sort_key
 )
 
-from cf_engine import CollaborativeFiltering
-from utils import hash_password, verify_password, create_access_token, decode_token
-import os, uuid, datetime, pyotp
+from auth import require_auth, invalidate_user, stats as auth_stats
+from cf_engine import CollaborativeFiltering, ModelNotReady
+from utils import (
+    hash_password, verify_password, needs_rehash, create_access_token, decode_token,
+    password_pool, PasswordPoolBusy, PasswordPoolTimeout
+)
+import os, uuid, datetime, pyotp, json, hashlib
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,20 +39,19 @@ CORS(app)
 # Rate limiter
 limiter = Limiter(key_func=get_remote_address, app=app, default_limits=["200 per day", "50 per hour"])
 
-# Mail configuration
-app.config.update(
-    MAIL_SERVER=os.getenv("MAIL_SERVER", "localhost"),
-    MAIL_PORT=int(os.getenv("MAIL_PORT", 25)),
-    MAIL_USERNAME=os.getenv("MAIL_USERNAME", ""),
-    MAIL_PASSWORD=os.getenv("MAIL_PASSWORD", ""),
-    MAIL_USE_TLS=False,
-    MAIL_USE_SSL=False,
-)
-mail = Mail(app)
-
-# Neo4j driver & CF engine
+# Neo4j driver, schema & CF engine
 driver = get_driver()
-cf = CollaborativeFiltering()
+cf = CollaborativeFiltering(in_memory=os.getenv("CF_IN_MEMORY", "false").lower() == "true")
+
+def startup():
+    """Стартовая работа веб-процесса: схема и загрузка CF-модели"""
+    ensure_schema()
+    cf.load_model()
+
+# spawn-воркеры пула паролей заново импортируют главный модуль под именем __mp_main__;
+# им схема и модель не нужны
+if __name__ != "__mp_main__":
+    startup()
 
 JWT_SECRET = os.getenv("JWT_SECRET", "supersecret")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
@@ -46,6 +60,11 @@ FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 # ------------------------
 # USERS
 # ------------------------
+@app.errorhandler(PasswordPoolBusy)
+@app.errorhandler(PasswordPoolTimeout)
+def password_pool_unavailable(e):
+    return jsonify({"error": "auth_busy"}), 503, {"Retry-After": "1"}
+
 def create_user_in_db(email, password, full_name, phone=None):
     user_id = str(uuid.uuid4())
     hashed = hash_password(password)
@@ -69,15 +88,8 @@ def get_user_by_email(email):
         res = session.execute_read(lambda tx: tx.run("MATCH (u:User {email:$email}) RETURN u", email=email).single())
         return res["u"] if res else None
 
-def create_login_history(user_id, ip, success=True):
-    with driver.session() as session:
-        session.execute_write(lambda tx: tx.run(
-            """
-            MATCH (u:User {user_id:$user_id})
-            CREATE (u)-[:LOGIN_EVENT {time:$time, ip:$ip, success:$success}]->(:Event)
-            """,
-            user_id=user_id, time=datetime.datetime.utcnow().isoformat(), ip=ip, success=success
-        ))
+def create_login_history(user_id, ip, success=True, kind="login"):
+    audit_writer.record(user_id, kind, ip=ip, success=success)
 
 @app.route("/api/register", methods=["POST"])
 @limiter.limit("10 per minute")
@@ -92,11 +104,7 @@ def register():
     user_id = create_user_in_db(email, password, full_name, phone)
     token = create_access_token(user_id, extra={"action":"verify_email"}, minutes=60*24)
     verify_link = f"{FRONTEND_URL}/verify-email?token={token}"
-    try:
-        msg = Message(subject="Verify your account", recipients=[email], body=f"Please click {verify_link}")
-        mail.send(msg)
-    except Exception as e:
-        app.logger.warning("Mail send failed: %s", e)
+    outbox.enqueue("Verify your account", [email], f"Please click {verify_link}")
     return jsonify({"msg":"registered", "user_id":user_id}), 201
 
 @app.route("/api/verify-email", methods=["POST"])
@@ -105,7 +113,7 @@ def verify_email():
     payload = decode_token(token)
     if not payload or payload.get("action")!="verify_email":
         return jsonify({"error":"invalid_token"}), 400
-    user_id = payload.get("sub")
+    user_id = payload.get("user_id")
     with driver.session() as session:
         session.execute_write(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) SET u.is_verified = true RETURN u", user_id=user_id))
     return jsonify({"msg":"verified"})
@@ -123,6 +131,11 @@ def login():
     if not verify_password(password, user["password"]):
         create_login_history(user["user_id"], request.remote_addr, success=False)
         return jsonify({"error":"invalid_credentials"}), 401
+    if needs_rehash(user["password"]):
+        # BCRYPT_ROUNDS поменялся — пароль известен только сейчас, перехэшируем его прозрачно
+        rehashed = hash_password(password)
+        with driver.session() as session:
+            session.execute_write(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) SET u.password=$hashed", user_id=user["user_id"], hashed=rehashed))
     if user.get("twofa_enabled", False):
         temp = create_access_token(user["user_id"], extra={"action":"2fa"}, minutes=5)
         return jsonify({"twofa_required": True, "token": temp}), 200
@@ -137,7 +150,7 @@ def verify_2fa():
     payload = decode_token(token)
     if not payload or payload.get("action")!="2fa":
         return jsonify({"error":"invalid_token"}), 400
-    user_id = payload.get("sub")
+    user_id = payload.get("user_id")
     with driver.session() as session:
         res = session.execute_read(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) RETURN u.twofa_secret as s, u.is_verified as v", user_id=user_id).single())
         if not res:
@@ -147,24 +160,21 @@ def verify_2fa():
         return jsonify({"error":"2fa_not_setup"}), 400
     totp = pyotp.TOTP(s)
     if not totp.verify(code):
-        create_login_history(user_id, request.remote_addr, success=False)
+        create_login_history(user_id, request.remote_addr, success=False, kind="2fa")
         return jsonify({"error":"invalid_2fa"}), 401
     access = create_access_token(user_id, extra={"roles":["user"]})
-    create_login_history(user_id, request.remote_addr, success=True)
+    create_login_history(user_id, request.remote_addr, success=True, kind="2fa")
     return jsonify({"access_token": access})
 
 @app.route("/api/setup-2fa", methods=["POST"])
+@require_auth
 def setup_2fa():
-    header = request.headers.get("Authorization","")
-    token = header.replace("Bearer ","")
-    payload = decode_token(token)
-    if not payload:
-        return jsonify({"error":"not_authenticated"}), 401
-    user_id = payload.get("sub")
+    user_id = g.user["user_id"]
     secret = pyotp.random_base32()
     uri = pyotp.TOTP(secret).provisioning_uri(name=f"user-{user_id}", issuer_name="MyShop")
     with driver.session() as session:
         session.execute_write(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) SET u.twofa_secret=$secret, u.twofa_enabled=true RETURN u", user_id=user_id, secret=secret))
+    invalidate_user(user_id)
     return jsonify({"otp_uri": uri, "secret": secret})
 
 @app.route("/api/request-reset", methods=["POST"])
@@ -176,11 +186,7 @@ def request_reset():
     user_id = dict(user)["user_id"]
     token = create_access_token(user_id, extra={"action":"reset_password"}, minutes=60)
     reset_link = f"{FRONTEND_URL}/reset-password?token={token}"
-    try:
-        msg = Message(subject="Password reset", recipients=[email], body=f"Reset: {reset_link}")
-        mail.send(msg)
-    except Exception as e:
-        app.logger.warning("Mail send failed: %s", e)
+    outbox.enqueue("Password reset", [email], f"Reset: {reset_link}")
     return jsonify({"msg":"ok"})
 
 @app.route("/api/reset-password", methods=["POST"])
@@ -190,20 +196,19 @@ def reset_password():
     payload = decode_token(token)
     if not payload or payload.get("action")!="reset_password":
         return jsonify({"error":"invalid_token"}), 400
-    user_id = payload.get("sub")
+    user_id = payload.get("user_id")
     hashed = hash_password(newpass)
+    # токены, выданные до смены пароля, перестают приниматься (см. auth.require_auth)
+    changed_at = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
     with driver.session() as session:
-        session.execute_write(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) SET u.password=$hashed RETURN u", user_id=user_id, hashed=hashed))
+        session.execute_write(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) SET u.password=$hashed, u.password_changed_at=$changed_at RETURN u", user_id=user_id, hashed=hashed, changed_at=changed_at))
+    invalidate_user(user_id)
     return jsonify({"msg":"password_changed"})
 
 @app.route("/api/profile", methods=["GET","PUT"])
+@require_auth
 def profile():
-    header = request.headers.get("Authorization","")
-    token = header.replace("Bearer ","")
-    payload = decode_token(token)
-    if not payload:
-        return jsonify({"error":"not_authenticated"}), 401
-    user_id = payload.get("sub")
+    user_id = g.user["user_id"]
     if request.method == "GET":
         with driver.session() as session:
             res = session.execute_read(lambda tx: tx.run("MATCH (u:User {user_id:$user_id}) RETURN u", user_id=user_id).single())
@@ -225,6 +230,7 @@ def profile():
         set_clause = ", ".join(qset)
         with driver.session() as session:
             session.execute_write(lambda tx: tx.run(f"MATCH (u:User {{user_id:$user_id}}) SET {set_clause} RETURN u", **params))
+        invalidate_user(user_id)
         return jsonify({"msg":"updated"})
 
 
@@ -235,7 +241,7 @@ def profile():
 def create_product():
     data = request.json
     with driver.session() as session:
-        session.run("""
+        session.execute_write(lambda tx: tx.run("""
             MERGE (c:Category {name: $category})
             CREATE (p:Product {
                 id:$id, name:$name, category:$category,
@@ -245,32 +251,69 @@ def create_product():
                 createdAt: datetime()
             })
             MERGE (p)-[:BELONGS_TO]->(c)
-        """, **data)
+        """, **data).consume())
+    product_cache.invalidate(data.get("id"))
+    search_index.refresh([data.get("id")])
+    promotions.invalidate()
     return jsonify({"message": "Product created"}), 201
 
+@app.route("/products/bulk", methods=["POST"])
+@require_auth(roles=["admin"])
+def bulk_products():
+    """Upsert каталога: NDJSON (по умолчанию) или CSV (Content-Type: text/csv), читается потоком"""
+    importer = ProductImporter(batch_size=request.args.get("batch_size", 2000, type=int))
+    stats = importer.load(read_request_body(request.stream, request.content_type))
+    return jsonify(stats), (207 if stats["failed"] else 200)
+
+def _product_cache_entry(node):
+    """Тело ответа, ETag и Last-Modified для карточки товара"""
+    product = dict(node)
+    changed = product.get("updatedAt") or product.get("createdAt")
+    body = json.dumps(product, sort_keys=True, ensure_ascii=False, default=str)
+    return {
+        "body": body,
+        "etag": hashlib.sha1(body.encode("utf-8")).hexdigest(),
+        "last_modified": changed.to_native() if hasattr(changed, "to_native") else None,
+    }
+
 @app.route("/products/<product_id>", methods=["GET"])
 def get_product(product_id):
-    with driver.session() as s:
-        result = s.run("MATCH (p:Product {id:$id}) RETURN p", id=product_id)
-        product = result.single()
-        if product:
-            return jsonify(product["p"])
-        return jsonify({"error": "Product not found"}), 404
+    entry = product_cache.get(product_id)
+    if entry is None:
+        # поколение до чтения: PUT / DELETE, закоммиченный во время чтения, не даст закэшировать старую карточку
+        generation = product_cache.generation(product_id)
+        with driver.session() as s:
+            product = s.execute_read(lambda tx: tx.run("MATCH (p:Product {id:$id}) RETURN p", id=product_id).single())
+        if not product:
+            return jsonify({"error": "Product not found"}), 404
+        entry = _product_cache_entry(product["p"])
+        product_cache.set(product_id, entry, generation=generation)
+    resp = app.response_class(entry["body"], mimetype="application/json")
+    resp.set_etag(entry["etag"])
+    resp.last_modified = entry["last_modified"]
+    resp.cache_control.no_cache = True  # клиент/CDN хранит, но перепроверяет через If-None-Match
+    return resp.make_conditional(request)
 
 @app.route("/products/<product_id>", methods=["PUT"])
 def update_product(product_id):
     data = request.json
     with driver.session() as s:
-        s.run("""
+        s.execute_write(lambda tx: tx.run("""
             MATCH (p:Product {id:$id})
-            SET p.name=$name, p.category=$category, p.price=$price, p.brand=$brand
-        """, **data, id=product_id)
+            SET p.name=$name, p.category=$category, p.price=$price, p.brand=$brand, p.updatedAt=datetime()
+        """, **data, id=product_id).consume())
+    product_cache.invalidate(product_id)
+    search_index.refresh([product_id])
+    promotions.invalidate()
     return jsonify({"message": "Product updated"})
 
 @app.route("/products/<product_id>", methods=["DELETE"])
 def delete_product(product_id):
     with driver.session() as s:
-        s.run("MATCH (p:Product {id:$id}) DETACH DELETE p", id=product_id)
+        s.execute_write(lambda tx: tx.run("MATCH (p:Product {id:$id}) DETACH DELETE p", id=product_id).consume())
+    product_cache.invalidate(product_id)
+    search_index.remove(product_id)
+    promotions.invalidate()
     return jsonify({"message": "Product deleted"})
 
 
@@ -280,48 +323,156 @@ def delete_product(product_id):
 @app.route("/products/<sku>/review", methods=['POST'])
 def add_review(sku):
     data = request.json
-    with driver.session() as s:
-        s.run("""
-            MATCH (p:Product {sku:$sku})
-            CREATE (r:Review {rating:$rating, comment:$comment, date:datetime()})
-            CREATE (p)-[:HAS_REVIEW]->(r)
-        """, sku=sku, rating=float(data.get("rating")), comment=data.get("comment",""))
+    try:
+        rating = float(data.get("rating"))
+    except (TypeError, ValueError):
+        rating = None
+    if rating is None or not 1 <= rating <= 5:
+        return jsonify({"error": "rating must be between 1 and 5"}), 400
+    product_id = Review.add(sku, rating, data.get("comment",""))
+    if product_id is None:
+        return jsonify({"error": "Product not found"}), 404
+    # rating товара изменился — карточка и поисковый индекс должны это увидеть
+    product_cache.invalidate(product_id)
+    search_index.refresh([product_id])
     return jsonify({"message": "Review added"}), 201
 
 @app.route("/products/<sku>/reviews", methods=['GET'])
 def get_reviews(sku):
-    with driver.session() as s:
-        result = s.run("""
-            MATCH (p:Product {sku:$sku})-[:HAS_REVIEW]->(r:Review)
-            RETURN r.rating AS rating, r.comment AS comment, r.date AS date
-        """, sku=sku)
-        reviews = [dict(r) for r in result]
-        avg_rating = sum(r["rating"] for r in reviews)/len(reviews) if reviews else 0
-    return jsonify({"reviews": reviews, "average_rating": round(avg_rating,2)})
+    """
+    Агрегаты (average_rating, review_count, bayesian_rating, rating_histogram) читаются с товара.
+    ?limit=&cursor= — страница отзывов (новые сначала) + next_cursor;
+    ?limit=&skip= — прежняя страница по смещению; без limit отзывы отдаются потоком.
+    """
+    limit = request.args.get("limit", type=int)
+    skip = request.args.get("skip", 0, type=int)
+    cursor = request.args.get("cursor")
+    head = Review.aggregates(sku)
+    if head is None:
+        return jsonify({"error": "Product not found"}), 404
+    if cursor is not None or (limit is not None and not skip and not wants_ndjson()):
+        try:
+            before = decode_cursor(cursor, "review_date") if cursor else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        reviews, last = Review.page(sku, max(1, min(limit or 20, 200)), before)
+        next_cursor = encode_cursor("review_date", last) if last else None
+        return json_response({**head, "reviews": reviews, "next_cursor": next_cursor})
+    query = """
+        MATCH (p:Product {sku:$sku})-[:HAS_REVIEW]->(r:Review)
+        RETURN coalesce(r.id, elementId(r)) AS id, r.rating AS rating, r.comment AS comment, r.date AS date
+        ORDER BY r.date DESC
+        SKIP $skip
+    """ + (" LIMIT $limit" if limit is not None else "")
+    reviews = iter_query(query, sku=sku, skip=skip, limit=limit)
+    if limit is not None and not wants_ndjson():
+        return json_response({"reviews": list(reviews), **head})
+    return stream_object(head, "reviews", reviews)
 
 # ------------------------
 # SEARCH
 # ------------------------
 @app.route("/search", methods=["GET"])
 def search_products():
+    """
+    Без limit/cursor — прежний ответ (весь список).
+    С limit или cursor — {"items", "next_cursor", "total", "facets"}: keyset-пагинация
+    по ключу сортировки и счётчики по category / brand / ценовым корзинам.
+    """
     q = request.args.get("q", "")
     category = request.args.get("category")
     brand = request.args.get("brand")
     min_price = request.args.get("min_price", type=float)
     max_price = request.args.get("max_price", type=float)
     sort_by = request.args.get("sort_by", "name")
-
-    query = "MATCH (p:Product) WHERE toLower(p.name) CONTAINS toLower($q)"
-    if category: query += " AND toLower(p.category)=toLower($category)"
-    if brand: query += " AND toLower(p.brand)=toLower($brand)"
-    if min_price is not None: query += " AND p.price >= $min_price"
-    if max_price is not None: query += " AND p.price <= $max_price"
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor")
+    paged = limit is not None or cursor is not None
+    fields = ("id", "name", "category", "brand", "price")
+
+    if paged:
+        limit = max(1, min(limit or 20, 200))
+        if sort_by not in SORT_FIELDS:
+            return jsonify({"error": f"sort_by must be one of {', '.join(SORT_FIELDS)}"}), 400
+
+    if SEARCH_BACKEND == "index":
+        hits = search_index.search(q, category=category, brand=brand, min_price=min_price, max_price=max_price)
+        if paged:
+            try:
+                page = paginate(hits, sort_by, limit, cursor)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            page["items"] = [{k: d[k] for k in fields} for d, _ in page["items"]]
+            return jsonify(page)
+        docs = [doc for doc, _ in hits]
+        if sort_by in ["price","name","rating"]:
+            # как ORDER BY в Cypher: null в конце
+            docs.sort(key=lambda d: sort_key(d, 0.0, sort_by))
+        return stream_rows({k: d[k] for k in fields} for d in docs)
+
+    where = "toLower(p.name) CONTAINS toLower($q)"
+    if category: where += " AND toLower(p.category)=toLower($category)"
+    if brand: where += " AND toLower(p.brand)=toLower($brand)"
+    if min_price is not None: where += " AND p.price >= $min_price"
+    if max_price is not None: where += " AND p.price <= $max_price"
+    params = dict(q=q, category=category, brand=brand, min_price=min_price, max_price=max_price)
+
+    if paged:
+        try:
+            return jsonify(_search_page_neo4j(where, params, sort_by, limit, cursor))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    query = "MATCH (p:Product) WHERE " + where
     query += f" RETURN p.id AS id, p.name AS name, p.category AS category, p.brand AS brand, p.price AS price"
-    if sort_by in ["price","name","rating"]: query += f" ORDER BY p.{sort_by} ASC"
-
+    if sort_by in ["price","name"]: query += f" ORDER BY p.{sort_by} ASC"
+    if sort_by == "rating": query += " ORDER BY p.rating IS NULL, p.rating DESC"
+
+    return stream_rows(iter_query(query, **params))
+
+def _search_page_neo4j(where, params, sort_by, limit, cursor):
+    """Keyset-страница и фасеты в Neo4j: ORDER BY ключ, id + WHERE ключ > курсор вместо SKIP"""
+    if sort_by == "relevance":
+        sort_by = "name"  # без полнотекстового индекса релевантности нет
+    # ключ сортировки: [null_last, значение, id] — как sort_key() в search_index
+    empty = "''" if sort_by == "name" else "0.0"
+    sign = "-" if sort_by == "rating" else ""  # рейтинг — по убыванию
+    key = f"[p.{sort_by} IS NULL, {sign}coalesce(p.{sort_by}, {empty}), p.id]"
+    after = list(decode_cursor(cursor, sort_by)) if cursor else None
     with driver.session() as s:
-        result = s.run(query, q=q, category=category, brand=brand, min_price=min_price, max_price=max_price)
-        return jsonify([r.data() for r in result])
+        rows = s.execute_read(lambda tx: tx.run(f"""
+            MATCH (p:Product) WHERE {where}
+            WITH p, {key} AS key
+            WHERE $after IS NULL OR key > $after
+            RETURN p.id AS id, p.name AS name, p.category AS category, p.brand AS brand, p.price AS price, key
+            ORDER BY key[0], key[1], key[2]
+            LIMIT $limit
+        """, **params, after=after, limit=limit + 1).data())
+        facets = s.execute_read(lambda tx: tx.run(f"""
+            MATCH (p:Product) WHERE {where}
+            WITH collect(p) AS ps
+            CALL {{ WITH ps UNWIND ps AS p WITH p.category AS value, count(*) AS count WHERE value IS NOT NULL
+                    RETURN collect({{value:value, count:count}}) AS category }}
+            CALL {{ WITH ps UNWIND ps AS p WITH p.brand AS value, count(*) AS count WHERE value IS NOT NULL
+                    RETURN collect({{value:value, count:count}}) AS brand }}
+            CALL {{ WITH ps UNWIND ps AS p UNWIND $buckets AS b
+                    WITH b, p WHERE p.price >= b.min AND (b.max IS NULL OR p.price < b.max)
+                    WITH b.label AS value, count(*) AS count
+                    RETURN collect({{value:value, count:count}}) AS price }}
+            RETURN size(ps) AS total, category, brand, price
+        """, **params, buckets=price_buckets()).single())
+    next_cursor = encode_cursor(sort_by, rows[limit - 1]["key"]) if len(rows) > limit else None
+    order = [b["label"] for b in price_buckets()]
+    return {
+        "items": [{k: r[k] for k in ("id", "name", "category", "brand", "price")} for r in rows[:limit]],
+        "next_cursor": next_cursor,
+        "total": facets["total"],
+        "facets": {
+            "category": sorted(facets["category"], key=lambda f: (-f["count"], str(f["value"]))),
+            "brand": sorted(facets["brand"], key=lambda f: (-f["count"], str(f["value"]))),
+            "price": sorted(facets["price"], key=lambda f: order.index(f["value"])),
+        },
+    }
 
 @app.route("/search/fulltext", methods=["GET"])
 def search_fulltext():
@@ -329,6 +480,12 @@ def search_fulltext():
     min_price = request.args.get("min_price", type=float)
     max_price = request.args.get("max_price", type=float)
     if not q: return jsonify([])
+    if SEARCH_BACKEND == "index":
+        hits = search_index.search(q, min_price=min_price, max_price=max_price)
+        return jsonify([
+            {**{k: d[k] for k in ("id", "name", "category", "brand", "price")}, "score": score}
+            for d, score in hits
+        ])
     query = """
         CALL db.index.fulltext.queryNodes("productFullTextIndex",$q) YIELD node, score
         WHERE ($min_price IS NULL OR node.price>=$min_price)
@@ -337,61 +494,104 @@ def search_fulltext():
         ORDER BY score DESC
     """
     with driver.session() as s:
-        result = s.run(query, q=q, min_price=min_price, max_price=max_price)
-        return jsonify([r.data() for r in result])
+        rows = s.execute_read(lambda tx: tx.run(query, q=q, min_price=min_price, max_price=max_price).data())
+    return jsonify(rows)
 
 
 # ------------------------
 # HISTORY / USER ACTIONS
 # ------------------------
+@app.errorhandler(IngestQueueFull)
+def ingest_queue_full(e):
+    return jsonify({"error": "ingest_queue_full"}), 503, {"Retry-After": "1"}
+
 @app.route("/history/view", methods=["POST"])
 def view_product():
     data = request.json
-    log_view(data["user_id"], data["product_id"])
+    ingestor.submit("view", data["user_id"], data["product_id"])
     return jsonify({"message":"View logged"})
 
 @app.route("/history/like", methods=["POST"])
 def like_product():
     data = request.json
-    log_like(data["user_id"], data["product_id"])
+    ingestor.submit("like", data["user_id"], data["product_id"])
     return jsonify({"message":"Product liked"})
 
 @app.route("/history/wishlist/add", methods=["POST"])
 def wishlist_add():
     data = request.json
-    add_to_wishlist(data["user_id"], data["product_id"])
+    ingestor.submit("wishlist_add", data["user_id"], data["product_id"])
     return jsonify({"message":"Added to wishlist"})
 
 @app.route("/history/wishlist/remove", methods=["POST"])
 def wishlist_remove():
     data = request.json
-    remove_from_wishlist(data["user_id"], data["product_id"])
+    ingestor.submit("wishlist_remove", data["user_id"], data["product_id"])
     return jsonify({"message":"Removed from wishlist"})
 
 @app.route("/history/purchase", methods=["POST"])
 def purchase():
     data = request.json
-    log_purchase(data["user_id"], data["product_id"])
+    ingestor.submit("purchase", data["user_id"], data["product_id"])
     return jsonify({"message":"Purchase logged"})
 
 @app.route("/history/return", methods=["POST"])
 def return_item():
     data = request.json
-    log_return(data["user_id"], data["product_id"])
+    ingestor.submit("return", data["user_id"], data["product_id"])
     return jsonify({"message":"Return logged"})
 
+@app.route("/history/bulk", methods=["POST"])
+@require_auth(roles=["admin"])
+def history_bulk():
+    """
+    NDJSON-поток событий: {"action", "user_id", "product_id", "time"} на строку.
+    Тело читается построчно, не целиком. ?resume=<resume из предыдущего ответа>
+    продолжает прерванную загрузку без повторной записи; ?skip=N — пропустить первые N записей.
+    """
+    try:
+        resume = decode_resume(request.args["resume"]) if request.args.get("resume") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    loader = BulkLoader(
+        batch_size=max(1, min(request.args.get("batch_size", 5000, type=int), BULK_MAX_BATCH_SIZE)),
+        parallelism=max(1, min(request.args.get("parallelism", 4, type=int), BULK_MAX_PARALLELISM)),
+    )
+    stats = loader.load(read_ndjson(request.stream), skip=request.args.get("skip", type=int), resume=resume)
+    return jsonify(stats), (500 if stats["aborted"] else 200)
+
 @app.route("/history/<user_id>", methods=["GET"])
 def get_history(user_id):
-    return jsonify(get_user_history(user_id))
+    """
+    ?limit=&before=<ISO time>&since=<ISO time>&action=view,like — страница истории
+    за интервал по выбранным действиям; без limit история отдаётся потоком
+    """
+    limit = request.args.get("limit", type=int)
+    before = request.args.get("before")
+    since = request.args.get("since")
+    actions = [a for value in request.args.getlist("action") for a in value.split(",") if a]
+    try:
+        History.history_types(actions)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if limit is not None and not wants_ndjson():
+        return json_response(History.get_user_history(user_id, limit=limit, before=before, since=since, actions=actions))
+    return stream_rows(History.iter_user_history(user_id, limit=limit, before=before, since=since, actions=actions))
 
 @app.route("/history/recommend/<user_id>", methods=["GET"])
 def recommend_history(user_id):
-    recs = recommend_products(user_id)
+    limit = request.args.get("limit", 5, type=int)
+    recs = recommendation_cache.get_or_compute(
+        user_id, "history", {"limit": limit},
+        lambda: Recommendation.recommend_products(user_id, limit=limit))
     return jsonify(recs)
 
 @app.route("/history/recommend_advanced/<user_id>", methods=["GET"])
 def recommend_advanced_history(user_id):
-    recs = recommend_products_advanced(user_id)
+    limit = request.args.get("limit", 5, type=int)
+    recs = recommendation_cache.get_or_compute(
+        user_id, "history_advanced", {"limit": limit},
+        lambda: Recommendation.recommend_products_advanced(user_id, limit=limit))
     return jsonify(recs)
 
 
@@ -401,55 +601,212 @@ def recommend_advanced_history(user_id):
 @app.route("/cart/add", methods=["POST"])
 def add_to_cart_route():
     data = request.json
-    add_to_cart(data["user_id"], data["product_id"], data["quantity"])
+    cart_store.add(data["user_id"], data["product_id"], data["quantity"])
     return jsonify({"message":"Item added to cart"})
 
 @app.route("/cart/remove", methods=["POST"])
 def remove_from_cart_route():
     data = request.json
-    remove_from_cart(data["user_id"], data["product_id"])
+    cart_store.remove(data["user_id"], data["product_id"])
     return jsonify({"message":"Item removed from cart"})
 
 @app.route("/cart/<user_id>", methods=["GET"])
 def get_cart_route(user_id):
-    return jsonify(get_cart(user_id))
+    return jsonify(cart_store.get(user_id))
 
 @app.route("/cart/checkout", methods=["POST"])
 def checkout_route():
     data = request.json
-    res = checkout(data["user_id"])
-    return jsonify(res)
+    key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    order = cart_store.checkout(data["user_id"], idempotency_key=key)
+    if order is None:
+        return jsonify({"error":"cart_empty"}), 400
+    return jsonify({"status":"success", "message":"Order placed successfully", **order}), 201 if order["created"] else 200
 
 
 # ------------------------
 # RECOMMENDATIONS
 # ------------------------
-@app.route("/recommend/item_based/<user_id>", methods=["GET"])
-def item_based(user_id):
-    recs = item_based_recommendations(user_id)
+@app.route("/recommend/item_based/<product_id>", methods=["GET"])
+def item_based(product_id):
+    limit = request.args.get("limit", 5, type=int)
+    recs = recommendation_cache.get_or_compute(
+        None, "item_based", {"product_id": product_id, "limit": limit},
+        lambda: Recommendation.item_based_recommendations(product_id, limit=limit))
     return jsonify(recs)
 
+def _promotion_page(user_id, name, limit):
+    """
+    Срез материализованного списка. Без параметра cursor — прежний ответ-массив,
+    с cursor (в т.ч. пустым для первой страницы) — {items, next_cursor, version}.
+    """
+    exclude = purchased_ids(user_id) if request.args.get("exclude_purchased", "false").lower() == "true" else None
+    try:
+        page = promotions.page(name, limit=limit, cursor=request.args.get("cursor") or None, exclude=exclude)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if "cursor" in request.args:
+        return jsonify(page)
+    return jsonify(page["items"])
+
 @app.route("/recommend/seasonal/<user_id>", methods=["GET"])
 def seasonal(user_id):
-    recs = seasonal_promotions(user_id)
-    return jsonify(recs)
+    season = request.args.get("season")
+    limit = request.args.get("limit", 5, type=int)
+    return _promotion_page(user_id, promotions.list_name(season), limit)
 
 @app.route("/recommend/manual/<user_id>", methods=["GET"])
 def manual(user_id):
-    recs = manual_adjustment(user_id)
+    limit = request.args.get("limit", type=int)
+    skip = request.args.get("skip", 0, type=int)
+    if (limit is not None and limit < 0) or skip < 0:
+        return jsonify({"error": "limit and skip must be >= 0"}), 400
+    if skip:
+        # старый постраничный режим по skip; курсор дешевле, skip оставлен для совместимости
+        items = promotions.page(MANUAL, limit=None if limit is None else skip + limit)["items"][skip:]
+        return stream_rows(items) if wants_ndjson() else jsonify(items)
+    if wants_ndjson():
+        return stream_rows(promotions.page(MANUAL, limit=limit)["items"])
+    return _promotion_page(user_id, MANUAL, limit)
+
+
+@app.errorhandler(ModelNotReady)
+def cf_model_not_ready(e):
+    return jsonify({"error": "model_not_ready", "message": str(e)}), 503, {"Retry-After": "60"}
+
+@app.route("/cf/recommend/<user_id>", methods=["GET"])
+def cf_recommend(user_id):
+    algo = request.args.get("algo", cf.current_algo)
+    limit = request.args.get("limit", 10, type=int)
+    if algo not in cf.algorithms:
+        return jsonify({"error": f"Algorithm {algo} not supported"}), 400
+    recs = recommendation_cache.get_or_compute(
+        user_id, "cf", {"algo": algo, "limit": limit},
+        lambda: cf.recommend(user_id, limit=limit, algo=algo))
     return jsonify(recs)
 
 
+# ------------------------
+# SEGMENTS
+# ------------------------
+@app.route("/users/<user_id>/segment", methods=["GET"])
+def user_segment(user_id):
+    profile = User.get_user_profile_segment(user_id)
+    if profile is None:
+        return jsonify({"error": "User not found"}), 404
+    return jsonify(profile)
+
+@app.route("/segments/<segment>/users", methods=["GET"])
+def segment_users(segment):
+    return stream_rows(User.iter_segment_users(segment, limit=request.args.get("limit", type=int)))
+
+
 # ------------------------
 # ADMIN
 # ------------------------
+def _submit_job(name, fn):
+    """Тяжёлую задачу — в фон: 202 и состояние, 409, если такая уже идёт"""
+    started, job = jobs.submit(name, fn)
+    return jsonify(job), (202 if started else 409)
+
+@app.route("/admin/ingest-stats", methods=["GET"])
+@require_auth(roles=["admin"])
+def ingest_stats():
+    return jsonify(ingestor.stats())
+
+@app.route("/admin/audit-stats", methods=["GET"])
+@require_auth(roles=["admin"])
+def audit_stats():
+    return jsonify(audit_writer.stats())
+
+@app.route("/admin/db-pool", methods=["GET"])
+@require_auth(roles=["admin"])
+def db_pool():
+    return jsonify(pool_metrics())
+
+@app.route("/admin/schema", methods=["GET"])
+@require_auth(roles=["admin"])
+def schema_report():
+    return jsonify({"indexes": SchemaManager.index_states(), "hot_queries": SchemaManager.scan_report()})
+
+@app.route("/admin/reviews/rebuild-aggregates", methods=["POST"])
+@require_auth(roles=["admin"])
+def rebuild_review_aggregates():
+    sku = request.args.get("sku")
+
+    def run():
+        products = Review.rebuild_aggregates(sku)
+        product_cache.clear()
+        search_index.build()
+        return {"products": products}
+    return _submit_job("review-aggregates", run)
+
+@app.route("/admin/segments/rebuild", methods=["POST"])
+@require_auth(roles=["admin"])
+def rebuild_segments():
+    batch_size = max(1, min(request.args.get("batch_size", 1000, type=int), 10000))
+
+    def run():
+        stats = SegmentationJob(batch_size).run()
+        return {**stats, "distribution": SegmentationJob.distribution()}
+    return _submit_job("segments", run)
+
+@app.route("/admin/history/compact-views", methods=["POST"])
+@require_auth(roles=["admin"])
+def compact_views():
+    batch_size = max(1, min(request.args.get("batch_size", 200, type=int), 5000))
+    return _submit_job("compact-views", lambda: ViewCompactionJob(batch_size).run())
+
+@app.route("/admin/jobs", methods=["GET"])
+@require_auth(roles=["admin"])
+def admin_jobs():
+    return jsonify(jobs.status())
+
+@app.route("/admin/cart-stats", methods=["GET"])
+@require_auth(roles=["admin"])
+def cart_stats():
+    return jsonify(cart_store.stats())
+
+@app.route("/admin/mail-stats", methods=["GET"])
+@require_auth(roles=["admin"])
+def mail_stats():
+    return jsonify(outbox.stats())
+
+@app.route("/admin/cache-stats", methods=["GET"])
+@require_auth(roles=["admin"])
+def cache_stats():
+    return jsonify({
+        "recommendations": recommendation_cache.stats(),
+        "products": product_cache.stats(),
+        "search_index": search_index.stats(),
+        "promotions": promotions.stats(),
+        "auth": auth_stats(),
+    })
+
+@app.route("/admin/password-pool-stats", methods=["GET"])
+@require_auth(roles=["admin"])
+def password_pool_stats():
+    return jsonify(password_pool.stats())
+
 @app.route("/admin/set-role", methods=["POST"])
+@require_auth(roles=["admin"])
 def set_role():
-    data = request.json
-    user_id = data["user_id"]
-    role = data["role"]
+    data = request.json or {}
+    user_id = data.get("user_id")
+    role = data.get("role")
+    if not user_id or not role:
+        return jsonify({"error": "user_id and role are required"}), 400
+    # роль — общий узел :Role, поэтому меняем связь, а не имя узла
     with driver.session() as s:
-        s.run("MATCH (u:User {user_id:$user_id})-[:HAS_ROLE]->(r) SET r.name=$role RETURN r", user_id=user_id, role=role)
+        s.execute_write(lambda tx: tx.run("""
+            MATCH (u:User {user_id:$user_id})
+            OPTIONAL MATCH (u)-[old:HAS_ROLE]->(:Role)
+            DELETE old
+            WITH DISTINCT u
+            MERGE (r:Role {name:$role})
+            MERGE (u)-[:HAS_ROLE]->(r)
+        """, user_id=user_id, role=role).consume())
+    invalidate_user(user_id)
     return jsonify({"message":"Role updated"})
 
 
@@ -0,0 +1,225 @@
+# audit.py
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from dotenv import load_dotenv
+from neo4j_conn_Final import driver
+
+load_dotenv()
+
+AUDIT_MODE = os.getenv("AUDIT_MODE", "async")  # async | sync
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", 1.0))
+AUDIT_PUT_TIMEOUT = float(os.getenv("AUDIT_PUT_TIMEOUT", 0.05))  # сколько вход ждёт место в очереди
+# события, не попавшие в очередь или не записанные в Neo4j; дописываются писателем позже
+AUDIT_SPILL_PATH = os.getenv("AUDIT_SPILL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit_spill.ndjson"))
+_STOP = object()
+
+
+def bucket_rows(events):
+    """
+    Сворачивает события в строки по (user_id, day): один MERGE дневного узла на строку.
+    Внутри дня события остаются в порядке поступления.
+    """
+    rows = {}
+    for e in events:
+        key = (e["user_id"], e["time"][:10])
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = {"user_id": e["user_id"], "day": key[1], "events": [], "failures": 0}
+        row["events"].append({"time": e["time"], "kind": e["kind"], "ip": e["ip"] or "", "success": e["success"]})
+        row["failures"] += 0 if e["success"] else 1
+    return list(rows.values())
+
+
+class AuditWriter:
+    """
+    Журнал входов и событий безопасности.
+    У пользователя один узел (:AuditDay {user_id, day}) в сутки со счётчиками
+    attempts / failures для быстрых выборок; сами события — отдельные узлы
+    (d)-[:HAS_EVENT]->(:AuditEvent), так что запись пачки не переписывает весь день.
+    Запись идёт фоновым потоком пачками. Если очередь не освободилась за
+    AUDIT_PUT_TIMEOUT или запись в Neo4j упала, события уходят в AUDIT_SPILL_PATH
+    и дописываются писателем после следующей удачной записи; dropped — только
+    то, что не удалось сохранить и на диск. stop() переносит в тот же файл всё,
+    что писатель не успел разобрать.
+    """
+
+    def __init__(self, mode=AUDIT_MODE, queue_size=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL, put_timeout=AUDIT_PUT_TIMEOUT, spill_path=AUDIT_SPILL_PATH):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.spill_path = spill_path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self.spilled = 0
+        self.restored = 0
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self.mode != "async":
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="audit-writer")
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stopping.set()
+        try:
+            self.queue.put_nowait(_STOP)  # будит писателя, если он ждёт в get
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        if thread.is_alive():
+            print("Audit writer did not finish in time")
+        # то, что писатель не успел взять, — в файл; его допишет следующий запуск
+        events = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                events.append(item)
+        if events:
+            self.spill(events)
+
+    def record(self, user_id, kind, ip=None, success=True, at=None):
+        event = {
+            "user_id": user_id, "kind": kind, "ip": ip, "success": bool(success),
+            "time": at or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        if self.mode != "async":
+            self.write([event])
+            return
+        self.start()
+        try:
+            self.queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            self.spill([event])
+            return
+        with self._lock:
+            self.enqueued += 1
+
+    def spill(self, events):
+        try:
+            with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as f:
+                for event in events:
+                    f.write(json.dumps(event) + "\n")
+        except OSError as e:
+            print(f"Audit spill failed for {len(events)} events: {e}")
+            with self._lock:
+                self.dropped += len(events)
+            return
+        with self._lock:
+            self.spilled += len(events)
+
+    def replay_spill(self):
+        """Дописывает события из AUDIT_SPILL_PATH; не записанные снова уйдут в файл"""
+        # файл забирается переименованием, чтобы не потерять строки, которые в этот
+        # момент дописывают вход или другой процесс
+        taken = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.replace(self.spill_path, taken)
+        except FileNotFoundError:
+            return 0
+        with open(taken, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        os.remove(taken)
+        with self._lock:
+            self.restored += len(events)
+        for i in range(0, len(events), self.batch_size):
+            self.write(events[i:i + self.batch_size])
+        return len(events)
+
+    def _run(self):
+        self.replay_spill()
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _STOP or self._stopping.is_set():
+                if item is not None and item is not _STOP:
+                    pending.append(item)
+                self.write(pending)
+                return
+            if item is not None:
+                pending.append(item)
+            if len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                if self.write(pending) and os.path.exists(self.spill_path):
+                    self.replay_spill()
+                pending = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def write(self, events):
+        """True, если события записаны; при ошибке они сохраняются в AUDIT_SPILL_PATH"""
+        if not events:
+            return False
+        started = time.monotonic()
+        try:
+            with driver.session() as s:
+                s.execute_write(self._write_rows, bucket_rows(events))
+            ok = True
+        except Exception as e:
+            print(f"Audit flush failed for {len(events)} events, spilling to {self.spill_path}: {e}")
+            ok = False
+            self.spill(events)
+        with self._lock:
+            if ok:
+                self.written += len(events)
+            else:
+                self.failed += len(events)
+            self.flushes += 1
+            self.last_flush_seconds = time.monotonic() - started
+        return ok
+
+    @staticmethod
+    def _write_rows(tx, rows):
+        tx.run("""
+            UNWIND $rows AS row
+            MATCH (u:User {user_id:row.user_id})
+            MERGE (d:AuditDay {user_id:row.user_id, day:date(row.day)})
+            ON CREATE SET d.attempts = 0, d.failures = 0
+            MERGE (u)-[:AUDIT_DAY]->(d)
+            SET d.attempts = d.attempts + size(row.events),
+                d.failures = d.failures + row.failures
+            WITH d, row
+            UNWIND row.events AS e
+            CREATE (d)-[:HAS_EVENT]->(:AuditEvent {time:datetime(e.time), kind:e.kind, ip:e.ip, success:e.success})
+        """, rows=rows).consume()
+
+    def stats(self):
+        return {
+            "mode": self.mode, "queue_depth": self.queue.qsize(), "queue_capacity": self.queue.maxsize,
+            "enqueued": self.enqueued, "written": self.written,
+            "failed": self.failed, "dropped": self.dropped,
+            "spilled": self.spilled, "restored": self.restored,
+            "flushes": self.flushes, "flush_latency_last": round(self.last_flush_seconds, 4),
+        }
+
+
+audit_writer = AuditWriter()
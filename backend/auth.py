@@ -0,0 +1,102 @@
+# auth.py
+import functools
+import hashlib
+import os
+import time
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+from neo4j_conn_Final import driver
+from cache import TTLCache
+from utils import decode_token, JWT_EXP_DELTA_SECONDS
+
+load_dotenv()
+
+AUTH_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", 50000))
+AUTH_USER_CACHE_TTL = int(os.getenv("AUTH_USER_CACHE_TTL", 60))
+AUTH_USER_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_USER_CACHE_MAX_ENTRIES", 20000))
+
+# проверенные claims по sha256 токена; запись живёт до exp токена
+token_cache = TTLCache(max_entries=AUTH_TOKEN_CACHE_MAX_ENTRIES, ttl=JWT_EXP_DELTA_SECONDS)
+# user_id -> {"user_id", "email", ..., "roles"}; сбрасывается явно при смене роли и пароля
+user_cache = TTLCache(max_entries=AUTH_USER_CACHE_MAX_ENTRIES, ttl=AUTH_USER_CACHE_TTL)
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def bearer_token():
+    header = request.headers.get("Authorization", "")
+    return header[7:].strip() if header.startswith("Bearer ") else None
+
+
+def verify_token(token):
+    """Claims проверенного токена или None. Подпись проверяется один раз на токен."""
+    if not token:
+        return None
+    key = token_digest(token)
+    claims = token_cache.get(key)
+    if claims is not None:
+        if claims["exp"] > time.time():
+            return claims
+        token_cache.pop(key)
+        return None
+    claims = decode_token(token)
+    if "error" in claims:
+        return None
+    token_cache.set(key, claims, ttl=max(0, claims["exp"] - time.time()))
+    return claims
+
+
+def load_user(user_id):
+    """Пользователь с ролями из кэша; None, если такого нет"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    with driver.session() as s:
+        record = s.execute_read(lambda tx: tx.run("""
+            MATCH (u:User {user_id:$user_id})
+            OPTIONAL MATCH (u)-[:HAS_ROLE]->(r:Role)
+            RETURN u {.user_id, .email, .full_name, .is_verified, .twofa_enabled, .password_changed_at} AS u,
+                   collect(r.name) AS roles
+        """, user_id=user_id).single())
+    if record is None:
+        return None
+    user = dict(record["u"], roles=record["roles"])
+    user_cache.set(user_id, user)
+    return user
+
+
+def invalidate_user(user_id):
+    """Вызывать после изменения ролей, пароля или 2FA пользователя"""
+    user_cache.pop(user_id)
+
+
+def require_auth(f=None, roles=None):
+    """
+    Декоратор маршрута: @require_auth или @require_auth(roles=["admin"]).
+    Кладёт пользователя в g.user, claims токена — в g.claims.
+    Токены с action (verify_email / reset_password / 2fa) для доступа не годятся;
+    токены, выданные до последней смены пароля, отклоняются.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            claims = verify_token(bearer_token())
+            if claims is None or claims.get("action"):
+                return jsonify({"error": "not_authenticated"}), 401
+            user = load_user(claims["user_id"])
+            if user is None or claims.get("iat", 0) < (user.get("password_changed_at") or 0):
+                return jsonify({"error": "not_authenticated"}), 401
+            if roles and not set(roles) & set(user["roles"]):
+                return jsonify({"error": "forbidden"}), 403
+            g.user = user
+            g.claims = claims
+            return view(*args, **kwargs)
+        return wrapper
+
+    return decorator(f) if f is not None else decorator
+
+
+def stats():
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
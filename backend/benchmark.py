@@ -0,0 +1,375 @@
+# benchmark.py
+import http.client
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BENCH_TARGET = os.getenv("BENCH_TARGET", "inprocess")  # inprocess | http://host:port
+BENCH_TIMEOUT = float(os.getenv("BENCH_TIMEOUT", 30.0))
+PERCENTILES = (50, 95, 99)
+
+# {name}, {name.field}, {name:prefix} — случайное значение переменной сценария;
+# в пределах одного запроса переменная выбирается один раз (email и password одной учётки)
+_PLACEHOLDER = re.compile(r"\{(\w+)(?:\.(\w+))?(?::(prefix))?\}")
+
+
+# ------------------------
+# Сценарий
+# ------------------------
+def _expand(values):
+    """Список значений или {"range": [from, to], "format": "user{}"}"""
+    if isinstance(values, dict):
+        start, end = values["range"]
+        fmt = values.get("format", "{}")
+        return [fmt.format(i) for i in range(start, end + 1)]
+    return list(values)
+
+
+def load_scenario(path):
+    with open(path, encoding="utf-8") as f:
+        scenario = json.load(f)
+    scenario.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    scenario["variables"] = {name: _expand(v) for name, v in scenario.get("variables", {}).items()}
+    for op in scenario["mix"]:
+        op.setdefault("method", "GET")
+        op.setdefault("weight", 1)
+        op.setdefault("name", f"{op['method']} {op['path']}")
+    return scenario
+
+
+def _pick(match, variables, rng, picked):
+    name, field, mode = match.groups()
+    if name not in picked:
+        picked[name] = rng.choice(variables[name])
+    value = picked[name]
+    if field:
+        value = value[field]
+    if mode == "prefix":
+        # набор поисковой строки: от двух символов до полного слова
+        value = str(value)
+        value = value[:rng.randint(min(2, len(value)), len(value))]
+    return value
+
+
+def render(template, variables, rng, picked, quote=False):
+    """Подставляет переменные в строку / dict / list; строка из одного плейсхолдера сохраняет тип значения"""
+    if isinstance(template, dict):
+        return {k: render(v, variables, rng, picked, quote) for k, v in template.items()}
+    if isinstance(template, list):
+        return [render(v, variables, rng, picked, quote) for v in template]
+    if not isinstance(template, str):
+        return template
+    match = _PLACEHOLDER.fullmatch(template)
+    if match and not quote:
+        return _pick(match, variables, rng, picked)
+
+    def sub(m):
+        value = str(_pick(m, variables, rng, picked))
+        return urllib.parse.quote(value, safe="") if quote else value
+    return _PLACEHOLDER.sub(sub, template)
+
+
+# ------------------------
+# Транспорты: один и тот же сценарий против живого сервера или приложения в процессе
+# ------------------------
+class HttpTransport:
+    """Keep-alive соединение на поток, как у браузера или балансировщика"""
+
+    def __init__(self, base_url, timeout=BENCH_TIMEOUT):
+        url = urllib.parse.urlsplit(base_url)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        conn = self._conn()
+        try:
+            conn.request(method, self.prefix + path, body=data, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def describe(self):
+        return f"{'https' if self.https else 'http'}://{self.host}:{self.port}{self.prefix}"
+
+
+class InProcessTransport:
+    """
+    Flask test client поверх AppFull.app: без сети и отдельного сервера, но с настоящими
+    Neo4j / кэшами. Лимитер по умолчанию выключен — все запросы идут с одного адреса.
+    """
+
+    def __init__(self, keep_rate_limits=False):
+        import AppFull
+        if not keep_rate_limits:
+            AppFull.limiter.enabled = False
+        self.app = AppFull.app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        resp = client.open(path, method=method, json=body, headers=headers)
+        resp.get_data()  # потоковые ответы считаются целиком
+        resp.close()
+        return resp.status_code
+
+    def describe(self):
+        return "inprocess"
+
+
+def make_transport(target, keep_rate_limits=False):
+    if target == "inprocess":
+        return InProcessTransport(keep_rate_limits)
+    return HttpTransport(target)
+
+
+# ------------------------
+# Прогон
+# ------------------------
+def percentile(sorted_values, p):
+    """Nearest-rank перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def _ok(op, status):
+    expect = op.get("expect")
+    if expect:
+        return status in expect
+    return 200 <= status < 400
+
+
+class Benchmark:
+    """
+    Закрытая модель нагрузки: concurrency потоков, каждый без пауз (или с think_time)
+    выбирает операцию по весам сценария и ждёт ответа. Первые warmup секунд не
+    учитываются. Прогон ограничен duration секундами или числом запросов requests.
+
+    python benchmark.py scenarios/mixed.json --out before.json
+    python benchmark.py scenarios/mixed.json --target http://127.0.0.1:5000 --baseline before.json
+    """
+
+    def __init__(self, scenario, transport, concurrency=None, duration=None, requests=None, warmup=None, seed=None):
+        self.scenario = scenario
+        self.transport = transport
+        self.concurrency = concurrency or scenario.get("concurrency", 8)
+        self.duration = duration if duration is not None else scenario.get("duration", 30)
+        self.requests = requests if requests is not None else scenario.get("requests")
+        self.warmup = warmup if warmup is not None else scenario.get("warmup", 2)
+        self.seed = seed if seed is not None else scenario.get("seed", 1)
+        self.think_time = scenario.get("think_time", 0.0)
+        if not self.duration and not self.requests:
+            raise ValueError("scenario needs duration or requests")
+        self._issued = 0
+        self._lock = threading.Lock()
+
+    def _request(self, op, rng, picked=None):
+        picked = {} if picked is None else picked
+        variables = self.scenario["variables"]
+        path = render(op["path"], variables, rng, picked, quote=True)
+        body = render(op.get("body"), variables, rng, picked)
+        headers = render(op.get("headers"), variables, rng, picked)
+        return self.transport.request(op["method"], path, body, headers)
+
+    def setup(self):
+        """
+        Однократные запросы перед прогоном (регистрация учёток и т.п.); статус не проверяется.
+        for_each: имя переменной — запрос повторяется для каждого её значения.
+        """
+        rng = random.Random(self.seed)
+        for op in self.scenario.get("setup", []):
+            op.setdefault("method", "POST")
+            name = op.get("for_each")
+            for value in (self.scenario["variables"][name] if name else [None]):
+                try:
+                    self._request(op, rng, {name: value} if name else None)
+                except Exception as e:
+                    print(f"Setup {op['path']} failed: {e}")
+
+    def _next(self, deadline):
+        if time.monotonic() >= deadline:
+            return False
+        if self.requests is None:
+            return True
+        with self._lock:
+            if self._issued >= self.requests:
+                return False
+            self._issued += 1
+            return True
+
+    def _worker(self, n, measure_from, deadline, samples):
+        rng = random.Random(f"{self.seed}:{n}")
+        mix = self.scenario["mix"]
+        weights = [op["weight"] for op in mix]
+        while self._next(deadline):
+            op = rng.choices(mix, weights)[0]
+            started = time.monotonic()
+            try:
+                status = self._request(op, rng)
+                ok = _ok(op, status)
+            except Exception as e:
+                status, ok = type(e).__name__, False
+            if started >= measure_from:
+                samples.append((op["name"], time.monotonic() - started, status, ok))
+            if self.think_time:
+                time.sleep(rng.uniform(0, 2 * self.think_time))
+
+    def run(self):
+        self.setup()
+        started = time.monotonic()
+        measure_from = started + self.warmup
+        # без duration прогон ограничен только числом запросов
+        deadline = measure_from + self.duration if self.duration else float("inf")
+        per_thread = [[] for _ in range(self.concurrency)]
+        threads = [threading.Thread(target=self._worker, args=(i, measure_from, deadline, per_thread[i]),
+                                    daemon=True, name=f"bench-{i}") for i in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = max(1e-9, time.monotonic() - max(measure_from, started))
+        return self._report([s for samples in per_thread for s in samples], elapsed)
+
+    def _report(self, samples, elapsed):
+        by_endpoint = {}
+        for name, latency, status, ok in samples:
+            by_endpoint.setdefault(name, []).append((latency, status, ok))
+        by_endpoint["_total"] = [(latency, status, ok) for _, latency, status, ok in samples]
+        endpoints = {}
+        for name, rows in by_endpoint.items():
+            latencies = sorted(latency for latency, _, _ in rows)
+            errors = sum(1 for _, _, ok in rows if not ok)
+            statuses = {}
+            for _, status, _ in rows:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            endpoints[name] = {
+                "count": len(rows), "errors": errors,
+                "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+                "throughput": round(len(rows) / elapsed, 2),
+                **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 2) if latencies else None for p in PERCENTILES},
+                "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+                "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+                "statuses": statuses,
+            }
+        return {
+            "scenario": self.scenario["name"], "target": self.transport.describe(), "commit": git_commit(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": sys.version.split()[0],
+            "concurrency": self.concurrency, "warmup": self.warmup, "seconds": round(elapsed, 3),
+            "endpoints": endpoints,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+# ------------------------
+# Вывод и сравнение
+# ------------------------
+def format_report(result):
+    lines = [f"{result['scenario']} @ {result['commit'] or '?'} -> {result['target']}: "
+             f"{result['concurrency']} workers, {result['seconds']}s"]
+    header = f"{'endpoint':<28}{'count':>8}{'rps':>10}{'err%':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"
+    lines.append(header)
+    lines.append("-" * len(header))
+    for name, e in sorted(result["endpoints"].items(), key=lambda x: (x[0] == "_total", x[0])):
+        lines.append(f"{name[:27]:<28}{e['count']:>8}{e['throughput']:>10}{e['error_rate'] * 100:>8.2f}"
+                     + "".join(f"{e[k] if e[k] is not None else '-':>10}" for k in ("p50_ms", "p95_ms", "p99_ms", "max_ms")))
+    return "\n".join(lines)
+
+
+def compare(baseline, result, threshold=10.0):
+    """
+    Сравнение с прошлым прогоном по общим эндпоинтам: регрессия — p95 вырос или
+    throughput упал больше чем на threshold процентов, либо error_rate вырос больше чем на 1 п.п.
+    """
+    rows = []
+    for name, e in result["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if base is None:
+            continue
+
+        def delta(key):
+            if not base.get(key) or e.get(key) is None:
+                return None
+            return round((e[key] - base[key]) / base[key] * 100, 1)
+        p95, rps = delta("p95_ms"), delta("throughput")
+        error_delta = round(e["error_rate"] - base["error_rate"], 4)
+        rows.append({
+            "endpoint": name, "p95_change_pct": p95, "throughput_change_pct": rps, "error_rate_change": error_delta,
+            "regression": (p95 is not None and p95 > threshold) or (rps is not None and rps < -threshold)
+                          or error_delta > 0.01,
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон по сценарию: перцентили, throughput и ошибки по эндпоинтам")
+    parser.add_argument("scenario", help="JSON-файл сценария, см. scenarios/")
+    parser.add_argument("--target", default=BENCH_TARGET, help="inprocess или базовый URL сервера")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--duration", type=float, help="секунд измерения (после прогрева)")
+    parser.add_argument("--requests", type=int, help="остановиться после стольких запросов")
+    parser.add_argument("--warmup", type=float)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--keep-rate-limits", action="store_true", help="inprocess: не выключать flask-limiter")
+    parser.add_argument("--out", help="записать результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=10.0, help="допустимое ухудшение, %%")
+    parser.add_argument("--fail-on-regression", action="store_true", help="код выхода 1 при регрессии")
+    args = parser.parse_args()
+
+    bench = Benchmark(load_scenario(args.scenario), make_transport(args.target, args.keep_rate_limits),
+                      concurrency=args.concurrency, duration=args.duration, requests=args.requests,
+                      warmup=args.warmup, seed=args.seed)
+    result = bench.run()
+    print(format_report(result))
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            result["comparison"] = compare(json.load(f), result, args.threshold)
+        for row in result["comparison"]:
+            print(f"{'REGRESSION' if row['regression'] else 'ok':<12}{row['endpoint']:<28}"
+                  f"p95 {row['p95_change_pct']}%  rps {row['throughput_change_pct']}%  err {row['error_rate_change']:+}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.fail_on_regression and any(row["regression"] for row in result.get("comparison", [])):
+        raise SystemExit(1)
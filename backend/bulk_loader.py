@@ -0,0 +1,246 @@
+# bulk_loader.py
+import base64
+import csv
+import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from neo4j_conn_Final import History
+from ingest import group_events
+
+load_dotenv()
+
+# синонимы: имена действий API и типы связей в графе
+ACTION_ALIASES = {
+    "view": "view", "viewed": "view",
+    "like": "like", "liked": "like",
+    "wishlist": "wishlist_add", "wishlisted": "wishlist_add", "wishlist_add": "wishlist_add",
+    "wishlist_remove": "wishlist_remove",
+    "purchase": "purchase", "purchased": "purchase",
+    "return": "return", "returned": "return",
+}
+MAX_REPORTED_ERRORS = 100
+# пределы для параметров из запроса /history/bulk (CLI ими не ограничен)
+BULK_MAX_BATCH_SIZE = int(os.getenv("BULK_MAX_BATCH_SIZE", 20000))
+BULK_MAX_PARALLELISM = int(os.getenv("BULK_MAX_PARALLELISM", 8))
+
+
+class BulkRecordError(ValueError):
+    pass
+
+
+def normalize_event(record):
+    """Проверяет запись и приводит её к {"action", "user_id", "product_id", "time"}"""
+    if not isinstance(record, dict):
+        raise BulkRecordError("record must be an object")
+    action = ACTION_ALIASES.get(str(record.get("action") or record.get("type") or "").lower())
+    if action is None:
+        raise BulkRecordError(f"unknown action {record.get('action') or record.get('type')!r}")
+    user_id, product_id = record.get("user_id"), record.get("product_id")
+    if not user_id or not product_id:
+        raise BulkRecordError("user_id and product_id are required")
+    return {"action": action, "user_id": str(user_id), "product_id": str(product_id), "time": record.get("time") or None}
+
+
+# ------------------------
+# Потоковое чтение источников
+# ------------------------
+def read_ndjson(lines):
+    """Генератор (номер строки, запись или исключение) по NDJSON-строкам"""
+    for n, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield n, normalize_event(json.loads(line))
+        except (ValueError, BulkRecordError) as e:
+            yield n, BulkRecordError(str(e))
+
+
+def read_csv(f):
+    """CSV с заголовком action,user_id,product_id[,time]"""
+    for n, row in enumerate(csv.DictReader(f), 2):
+        try:
+            yield n, normalize_event(row)
+        except BulkRecordError as e:
+            yield n, e
+
+
+def open_source(path):
+    f = open(path, newline="", encoding="utf-8")
+    if path.endswith(".csv"):
+        return f, read_csv(f)
+    return f, read_ndjson(f)
+
+
+# ------------------------
+# Пакетная запись с параллелизмом и чекпоинтами
+# ------------------------
+def encode_resume(state):
+    """Чекпоинт как непрозрачная строка для ?resume= в /history/bulk"""
+    raw = json.dumps({"parallelism": state["parallelism"], "lanes": state["lanes"]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_resume(token):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(state["parallelism"], int) or len(state["lanes"]) != state["parallelism"]:
+            raise ValueError
+        return {"parallelism": state["parallelism"], "lanes": [int(n) for n in state["lanes"]]}
+    except Exception:
+        raise ValueError("invalid resume token")
+
+
+class BulkLoader:
+    """
+    События раскладываются по parallelism полосам по хэшу user_id: внутри полосы
+    порядок сохраняется, полосы пишутся параллельно пачками batch_size, каждая
+    пачка — одной транзакцией. После каждой записанной пачки чекпоинт запоминает
+    для каждой полосы номер последней записанной записи, поэтому повторный запуск
+    (с тем же parallelism) пропускает ровно записанное и ничего не пишет дважды.
+    Ошибка записи останавливает полосу и загрузку.
+    """
+
+    def __init__(self, batch_size=5000, parallelism=4, checkpoint_path=None):
+        self.batch_size = batch_size
+        self.parallelism = max(1, parallelism)
+        self.checkpoint_path = checkpoint_path
+        self._lock = threading.Lock()
+
+    def read_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def write_checkpoint(self, state):
+        if not self.checkpoint_path:
+            return
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"records": min(state["lanes"]), **state, "updated_at": time.time()}, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def _start_lanes(self, state, skip):
+        """Номер последней записанной записи для каждой полосы"""
+        if skip is not None:
+            return [skip] * self.parallelism
+        state = state or {}
+        if state.get("parallelism") == self.parallelism and state.get("lanes"):
+            return list(state["lanes"])
+        # другой parallelism (или старый формат): только общий минимум, остаток может повториться
+        base = min(state["lanes"]) if state.get("lanes") else state.get("records", 0)
+        return [base] * self.parallelism
+
+    def load(self, records, skip=None, resume=None):
+        """
+        records — итератор (номер, событие | BulkRecordError).
+        resume — состояние из decode_resume; skip — пропустить первые N записей;
+        по умолчанию — продолжить с чекпоинта.
+        """
+        started = time.monotonic()
+        state = {"parallelism": self.parallelism,
+                 "lanes": self._start_lanes(resume if resume is not None else self.read_checkpoint(), skip)}
+        failed_lanes = [False] * self.parallelism
+        stats = {"records": 0, "skipped": 0, "written": 0, "failed": 0, "errors": []}
+        lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(self.parallelism)]
+        buffers = [[] for _ in range(self.parallelism)]
+        inflight = threading.BoundedSemaphore(self.parallelism * 2)
+        futures = []
+        resumed_below = min(state["lanes"])
+
+        def submit(lane):
+            batch, buffers[lane] = buffers[lane], []
+            if batch:
+                inflight.acquire()
+                futures.append(lanes[lane].submit(self._write, lane, batch, state, failed_lanes, stats, inflight))
+
+        try:
+            for n, event in records:
+                stats["records"] += 1
+                i = stats["records"]
+                if isinstance(event, Exception):
+                    if i > resumed_below:
+                        self._error(stats, n, event)
+                    continue
+                lane = zlib.crc32(event["user_id"].encode()) % self.parallelism
+                if i <= state["lanes"][lane]:
+                    stats["skipped"] += 1
+                    continue
+                buffers[lane].append((i, event))
+                if len(buffers[lane]) >= self.batch_size:
+                    submit(lane)
+                    if any(failed_lanes):
+                        break
+            if not any(failed_lanes):
+                for lane in range(self.parallelism):
+                    submit(lane)
+            for f in futures:
+                f.result()
+            ok = not any(failed_lanes)
+            if ok:
+                # всё прочитанное записано: каждая полоса продвигается до конца источника
+                with self._lock:
+                    state["lanes"] = [max(done, stats["records"]) for done in state["lanes"]]
+                    self.write_checkpoint(state)
+            stats["aborted"] = not ok
+        finally:
+            for lane in lanes:
+                lane.shutdown(wait=True)
+
+        stats["checkpoint"] = min(state["lanes"])
+        stats["resume"] = encode_resume(state)
+        stats["seconds"] = round(time.monotonic() - started, 3)
+        stats["events_per_second"] = round(stats["written"] / stats["seconds"]) if stats["seconds"] else 0
+        return stats
+
+    def _write(self, lane, batch, state, failed_lanes, stats, inflight):
+        try:
+            if failed_lanes[lane]:
+                # после ошибки полоса не пишет дальше, иначе чекпоинт перескочит непрописанную пачку
+                with self._lock:
+                    stats["failed"] += len(batch)
+                return
+            History.log_groups(group_events((e["action"], {k: v for k, v in e.items() if k != "action"})
+                                            for _, e in batch))
+            with self._lock:
+                stats["written"] += len(batch)
+                state["lanes"][lane] = batch[-1][0]
+                self.write_checkpoint(state)
+        except Exception as e:
+            failed_lanes[lane] = True
+            with self._lock:
+                stats["failed"] += len(batch)
+                self._error(stats, None, e)
+        finally:
+            inflight.release()
+
+    @staticmethod
+    def _error(stats, line, error):
+        if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+            stats["errors"].append({"line": line, "error": str(error)})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Загрузка истории взаимодействий из CSV / NDJSON")
+    parser.add_argument("path", help="файл .csv или .ndjson")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--checkpoint", help="файл чекпоинта (по умолчанию <path>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="игнорировать чекпоинт и начать сначала")
+    args = parser.parse_args()
+
+    loader = BulkLoader(args.batch_size, args.parallelism, args.checkpoint or args.path + ".checkpoint")
+    f, records = open_source(args.path)
+    with f:
+        result = loader.load(records, skip=0 if args.restart else None)
+    print(json.dumps(result, indent=2))
+    print("Run `python cf_engine.py` for a full PREFERS rebuild after a backfill.")
@@ -0,0 +1,317 @@
+# cache.py
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+load_dotenv()
+
+REC_CACHE_BACKEND = os.getenv("REC_CACHE_BACKEND", "memory")  # memory | redis
+REC_CACHE_TTL = int(os.getenv("REC_CACHE_TTL", 300))
+REC_CACHE_MAX_ENTRIES = int(os.getenv("REC_CACHE_MAX_ENTRIES", 10000))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 60))
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", 50000))
+
+
+# ------------------------
+# TTL + LRU кэш в памяти процесса
+# ------------------------
+class TTLCache:
+    """
+    Потокобезопасный словарь с TTL и LRU-вытеснением при max_entries.
+    invalidate(key) ещё и увеличивает поколение ключа: set с generation, взятым до
+    чтения из базы, не положит в кэш значение, устаревшее за время чтения.
+    """
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._generations = {}
+        self._generation_floor = 0  # поколение ключей, вытесненных из _generations
+        self._counter = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, self._generation_floor)
+
+    def set(self, key, value, ttl=None, generation=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and self._generations.get(key, self._generation_floor) != generation:
+                return False
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def invalidate(self, key):
+        """pop после записи в базу: незавершённые set(..., generation) по ключу не сохранятся"""
+        with self._lock:
+            self._data.pop(key, None)
+            self._counter += 1
+            self._generations[key] = self._counter
+            if len(self._generations) > self.max_entries:
+                self._generations.clear()
+                self._generation_floor = self._counter
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+            self._counter += 1
+            self._generation_floor = self._counter
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data), "max_entries": self.max_entries,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# ------------------------
+# Бэкенды кэша рекомендаций
+# ------------------------
+class MemoryCacheBackend:
+    """
+    Один воркер: записи группируются по пользователю для точечной инвалидации.
+    delete_group увеличивает поколение группы; set с generation пишет, только если
+    поколение с тех пор не менялось.
+    """
+
+    def __init__(self, max_entries=REC_CACHE_MAX_ENTRIES):
+        self.entries = TTLCache(max_entries=max_entries)
+        self._groups = {}
+        self._generations = {}
+        self._generation_floor = 0  # поколение групп, вытесненных из _generations
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def get(self, group, key):
+        return self.entries.get((group, key))
+
+    def generation(self, group):
+        with self._lock:
+            return self._generations.get(group, self._generation_floor)
+
+    def set(self, group, key, value, ttl, generation=None):
+        with self._lock:
+            if generation is not None and self._generations.get(group, self._generation_floor) != generation:
+                return False
+            self.entries.set((group, key), value, ttl)
+            self._groups.setdefault(group, set()).add(key)
+            if len(self._groups) > self.entries.max_entries:
+                self._prune()
+        return True
+
+    def _prune(self):
+        # убираем из индекса групп ключи, уже вытесненные из LRU
+        for group in list(self._groups):
+            keys = {k for k in self._groups[group] if (group, k) in self.entries}
+            if keys:
+                self._groups[group] = keys
+            else:
+                del self._groups[group]
+
+    def delete_group(self, group):
+        with self._lock:
+            keys = self._groups.pop(group, set())
+            self._counter += 1
+            self._generations[group] = self._counter
+            if len(self._generations) > self.entries.max_entries:
+                # забытые группы получают текущее поколение: незавершённые записи по ним просто не сохранятся
+                self._generations.clear()
+                self._generation_floor = self._counter
+            for key in keys:
+                self.entries.pop((group, key))
+
+    def clear(self):
+        with self._lock:
+            self._groups.clear()
+            self._generations.clear()
+            self._counter += 1
+            self._generation_floor = self._counter
+            self.entries.clear()
+
+    def stats(self):
+        s = self.entries.stats()
+        return {"backend": "memory", "size": s["size"], "max_entries": s["max_entries"], "evictions": s["evictions"]}
+
+
+class RedisCacheBackend:
+    """
+    Несколько воркеров: одна hash-запись rec:<group> на пользователя, TTL на поле хранится в значении.
+    Поколение группы — счётчик recgen:<group>; set с generation пишет через WATCH на нём.
+    """
+
+    PREFIX = "rec:"
+    GENERATION_PREFIX = "recgen:"
+    GENERATION_TTL = 86400  # дольше любого вычисления рекомендаций
+
+    def __init__(self, url=REDIS_URL):
+        if redis is None:
+            raise RuntimeError("redis не установлен")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, group, key):
+        raw = self.client.hget(self.PREFIX + group, key)
+        if raw is None:
+            return None
+        item = json.loads(raw)
+        if item["expires_at"] < time.time():
+            return None
+        return item["value"]
+
+    def generation(self, group):
+        return int(self.client.get(self.GENERATION_PREFIX + group) or 0)
+
+    def set(self, group, key, value, ttl, generation=None):
+        name = self.PREFIX + group
+        raw = json.dumps({"expires_at": time.time() + ttl, "value": value}, default=str)
+        with self.client.pipeline() as pipe:
+            try:
+                if generation is not None:
+                    pipe.watch(self.GENERATION_PREFIX + group)
+                    if int(pipe.get(self.GENERATION_PREFIX + group) or 0) != generation:
+                        return False
+                    pipe.multi()
+                pipe.hset(name, key, raw)
+                pipe.expire(name, ttl)
+                pipe.execute()
+            except redis.WatchError:
+                # invalidate_user успел между проверкой и записью
+                return False
+        return True
+
+    def delete_group(self, group):
+        pipe = self.client.pipeline()
+        pipe.delete(self.PREFIX + group)
+        pipe.incr(self.GENERATION_PREFIX + group)
+        pipe.expire(self.GENERATION_PREFIX + group, self.GENERATION_TTL)
+        pipe.execute()
+
+    def clear(self):
+        for name in self.client.scan_iter(self.PREFIX + "*"):
+            self.client.delete(name)
+            self.client.incr(self.GENERATION_PREFIX + name.decode()[len(self.PREFIX):])
+
+    def stats(self):
+        return {"backend": "redis", "groups": sum(1 for _ in self.client.scan_iter(self.PREFIX + "*"))}
+
+
+# ------------------------
+# Кэш рекомендаций
+# ------------------------
+class RecommendationCache:
+    """
+    Кэш результатов рекомендаций по пользователю.
+    Записи History (view / like / wishlist / purchase / return) сбрасывают только
+    записи этого пользователя; глобальные списки живут до истечения TTL.
+    Поколение группы берётся до вычисления: если invalidate_user пришёл, пока
+    считался ответ, результат отдаётся, но не сохраняется.
+    """
+
+    GLOBAL = "_global"
+
+    def __init__(self, backend=None, ttl=REC_CACHE_TTL):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, user_id, name, params, compute):
+        group = str(user_id) if user_id is not None else self.GLOBAL
+        key = f"{name}:{json.dumps(params, sort_keys=True, default=str)}"
+        try:
+            generation = self.backend.generation(group)
+            value = self.backend.get(group, key)
+        except Exception as e:
+            print(f"Recommendation cache unavailable: {e}")
+            return compute()
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+        with self._lock:
+            self.misses += 1
+        value = compute()
+        try:
+            self.backend.set(group, key, value, self.ttl, generation)
+        except Exception as e:
+            print(f"Recommendation cache unavailable: {e}")
+        return value
+
+    def invalidate_user(self, user_id):
+        try:
+            self.backend.delete_group(str(user_id))
+        except Exception as e:
+            print(f"Recommendation cache unavailable: {e}")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits, "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "ttl": self.ttl, **self.backend.stats(),
+        }
+
+
+def _make_backend():
+    if REC_CACHE_BACKEND == "redis":
+        return RedisCacheBackend()
+    return MemoryCacheBackend()
+
+
+recommendation_cache = RecommendationCache(_make_backend())
+
+
+# ------------------------
+# Кэш карточек товаров (GET /products/<id>)
+# ------------------------
+# значение: {"body": JSON-строка, "etag": ..., "last_modified": datetime}
+product_cache = TTLCache(max_entries=PRODUCT_CACHE_MAX_ENTRIES, ttl=PRODUCT_CACHE_TTL)
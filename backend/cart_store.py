@@ -0,0 +1,433 @@
+# cart_store.py
+import atexit
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from neo4j_conn_Final import driver, Cart
+from cache import TTLCache, REDIS_URL, PRODUCT_CACHE_TTL
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+load_dotenv()
+
+CART_STORE_BACKEND = os.getenv("CART_STORE_BACKEND", "auto")  # auto | memory | redis | neo4j (без горячего слоя)
+CART_TTL = float(os.getenv("CART_TTL", 86400))  # memory: записанная корзина, не тронутая столько секунд, выгружается
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # число воркеров gunicorn; memory допустим только при 1
+CART_FLUSH_INTERVAL = float(os.getenv("CART_FLUSH_INTERVAL", 1.0))
+CART_FLUSH_BATCH = int(os.getenv("CART_FLUSH_BATCH", 500))
+CART_MAX_ENTRIES = int(os.getenv("CART_MAX_ENTRIES", 100000))
+
+
+# ------------------------
+# Бэкенды горячего слоя: user_id -> {product_id: quantity} + "грязные" корзины.
+# Грязная корзина хранит номер версии (растёт при каждом изменении) и перестаёт быть
+# грязной только после успешной записи именно этой версии в Neo4j.
+# ------------------------
+class MemoryCartBackend:
+    """
+    Корзины в памяти процесса. Только для одного воркера (или sticky-сессий).
+    Порядок _carts — порядок последнего обращения; записанные в Neo4j корзины
+    выгружаются по LRU сверх max_entries и после ttl секунд без обращений.
+    """
+
+    def __init__(self, max_entries=CART_MAX_ENTRIES, ttl=CART_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._carts = OrderedDict()
+        self._touched = {}  # user_id -> time.monotonic() последнего обращения
+        self._dirty = {}  # user_id -> версия изменений, ещё не записанных в Neo4j
+        self._lock = threading.Lock()
+
+    def _touch(self, user_id, lines=None):
+        if lines is not None:
+            self._carts[user_id] = lines
+        self._carts.move_to_end(user_id)
+        self._touched[user_id] = time.monotonic()
+
+    def _expired(self, user_id, now):
+        return user_id not in self._dirty and now - self._touched[user_id] > self.ttl
+
+    def get(self, user_id):
+        with self._lock:
+            lines = self._carts.get(user_id)
+            if lines is None:
+                return None
+            if self._expired(user_id, time.monotonic()):
+                # следующий запрос перечитает корзину из Neo4j
+                self._drop(user_id)
+                return None
+            self._touch(user_id)
+            return dict(lines)
+
+    def put(self, user_id, lines):
+        with self._lock:
+            self._touch(user_id, dict(lines))
+            self._evict(keep=user_id)
+
+    def _drop(self, user_id):
+        del self._carts[user_id]
+        del self._touched[user_id]
+
+    def _evict(self, keep=None):
+        # вытесняются только корзины, уже записанные в Neo4j: грязные не трогаем никогда
+        now = time.monotonic()
+        extra = len(self._carts) - self.max_entries
+        for user_id in list(self._carts):
+            if now - self._touched[user_id] <= self.ttl and extra <= 0:
+                break  # дальше только более свежие корзины
+            if user_id in self._dirty or user_id == keep:
+                continue
+            self._drop(user_id)
+            extra -= 1
+
+    def load(self, user_id, lines):
+        """Кладёт корзину, прочитанную из Neo4j, если её ещё нет; возвращает текущую"""
+        with self._lock:
+            if user_id not in self._carts:
+                self._touch(user_id, dict(lines))
+                self._evict(keep=user_id)
+            return dict(self._carts[user_id])
+
+    def add(self, user_id, product_id, quantity, base=None):
+        # base — загруженная корзина на случай, если её успели вытеснить до изменения
+        with self._lock:
+            lines = self._carts.setdefault(user_id, dict(base or {}))
+            lines[product_id] = lines.get(product_id, 0) + quantity
+            self._touch(user_id)
+            self._dirty[user_id] = self._dirty.get(user_id, 0) + 1
+
+    def remove(self, user_id, product_id, base=None):
+        with self._lock:
+            self._carts.setdefault(user_id, dict(base or {})).pop(product_id, None)
+            self._touch(user_id)
+            self._dirty[user_id] = self._dirty.get(user_id, 0) + 1
+
+    def dirty_batch(self, limit):
+        """[(user_id, версия, lines)] — грязные корзины остаются грязными до clear_dirty"""
+        with self._lock:
+            return [(u, v, dict(self._carts[u])) for u, v in itertools.islice(self._dirty.items(), limit)]
+
+    def dirty_entry(self, user_id):
+        with self._lock:
+            version = self._dirty.get(user_id)
+            return None if version is None else (version, dict(self._carts[user_id]))
+
+    def clear_dirty(self, entries):
+        """Снимает отметку с записанных корзин, если с тех пор они не менялись"""
+        with self._lock:
+            for user_id, version in entries:
+                if self._dirty.get(user_id) == version:
+                    del self._dirty[user_id]
+            self._evict()
+
+    def dirty_count(self):
+        return len(self._dirty)
+
+    def stats(self):
+        return {"backend": "memory", "carts": len(self._carts), "max_entries": self.max_entries, "ttl": self.ttl}
+
+
+class RedisCartBackend:
+    """
+    Корзины в Redis: hash cart:<user_id> (product_id -> quantity, плюс служебное поле
+    _loaded) и hash cart:dirty_versions (user_id -> версия). Общие для всех воркеров и переживают
+    рестарт приложения.
+    """
+
+    PREFIX = "cart:"
+    DIRTY = "cart:dirty_versions"  # hash; прежнее множество cart:dirty не переиспользуется
+    LOADED = "_loaded"
+
+    def __init__(self, url=REDIS_URL):
+        if redis is None:
+            raise RuntimeError("redis не установлен")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        # снять отметку только с тех корзин, чья версия не изменилась после чтения
+        self._clear_dirty = self.client.register_script("""
+            for i = 1, #ARGV, 2 do
+                if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+                    redis.call('HDEL', KEYS[1], ARGV[i])
+                end
+            end
+        """)
+
+    def _lines(self, raw):
+        return {k: int(v) for k, v in raw.items() if k != self.LOADED}
+
+    def get(self, user_id):
+        raw = self.client.hgetall(self.PREFIX + user_id)
+        return self._lines(raw) if raw else None
+
+    def put(self, user_id, lines):
+        name = self.PREFIX + user_id
+        pipe = self.client.pipeline()
+        pipe.delete(name)
+        pipe.hset(name, mapping={self.LOADED: 1, **lines})
+        pipe.execute()
+
+    def load(self, user_id, lines):
+        name = self.PREFIX + user_id
+        with self.client.pipeline() as pipe:
+            try:
+                # другой воркер мог загрузить и уже изменить корзину — её не перетираем
+                pipe.watch(name)
+                if not pipe.exists(name):
+                    pipe.multi()
+                    pipe.hset(name, mapping={self.LOADED: 1, **lines})
+                    pipe.execute()
+            except redis.WatchError:
+                pass
+        return self.get(user_id) or {}
+
+    def add(self, user_id, product_id, quantity, base=None):
+        # Redis корзины не вытесняет, base не нужен
+        pipe = self.client.pipeline()
+        pipe.hincrby(self.PREFIX + user_id, product_id, quantity)
+        pipe.hincrby(self.DIRTY, user_id, 1)
+        pipe.execute()
+
+    def remove(self, user_id, product_id, base=None):
+        pipe = self.client.pipeline()
+        pipe.hdel(self.PREFIX + user_id, product_id)
+        pipe.hincrby(self.DIRTY, user_id, 1)
+        pipe.execute()
+
+    def dirty_batch(self, limit):
+        raw = self.client.hrandfield(self.DIRTY, limit, withvalues=True) or []
+        return [(u, int(v), self.get(u) or {}) for u, v in zip(raw[::2], raw[1::2])]
+
+    def dirty_entry(self, user_id):
+        version = self.client.hget(self.DIRTY, user_id)
+        return None if version is None else (int(version), self.get(user_id) or {})
+
+    def clear_dirty(self, entries):
+        if entries:
+            self._clear_dirty(keys=[self.DIRTY], args=[x for u, v in entries for x in (u, v)])
+
+    def dirty_count(self):
+        return self.client.hlen(self.DIRTY)
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+# ------------------------
+# Корзина с write-behind в Neo4j
+# ------------------------
+class CartStore:
+    """
+    /cart/<user_id> отвечает из горячего слоя; изменения помечают корзину грязной,
+    фоновый поток раз в CART_FLUSH_INTERVAL пишет в Neo4j итоговое состояние
+    грязных корзин (до CART_FLUSH_BATCH за транзакцию). Пишется состояние, а не
+    журнал операций, поэтому частые add/remove схлопываются в одну запись.
+    Checkout сначала синхронно сбрасывает корзину пользователя.
+
+    Гарантии при падении:
+      - memory: изменения, подтверждённые клиенту, но не записанные в Neo4j
+        (не старше CART_FLUSH_INTERVAL плюс время записи), теряются вместе с процессом;
+        уже записанные остаются в Neo4j и подхватываются при следующем чтении.
+      - redis: корзины и множество грязных живут в Redis, поэтому падение приложения
+        ничего не теряет — следующий процесс допишет их; теряется только то, что
+        потерял бы сам Redis (по его настройкам персистентности).
+      - в обоих случаях checkout видит все изменения, подтверждённые этому же
+        процессу (memory) или любому процессу (redis), т.к. сброс идёт перед заказом.
+      - корзина перестаёт быть грязной только после успешной записи, поэтому при ошибке
+        она пишется в следующий раз, а вытеснение из памяти её не трогает.
+    """
+
+    def __init__(self, backend, flush_interval=CART_FLUSH_INTERVAL, batch_size=CART_FLUSH_BATCH):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.products = TTLCache(max_entries=50000, ttl=PRODUCT_CACHE_TTL)
+        self._flush_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(64)]
+        self._thread = None
+        self._stop = threading.Event()
+        self.loads = 0
+        self.flushed = 0
+        self.flush_failures = 0
+        self.last_flush_seconds = 0.0
+
+    # ------------------------
+    # Операции корзины
+    # ------------------------
+    def _user_lock(self, user_id):
+        # загрузка из Neo4j и изменение корзины одного пользователя не должны перемежаться
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+    def _ensure_loaded(self, user_id):
+        lines = self.backend.get(user_id)
+        if lines is None:
+            lines = self.backend.load(user_id, {item["id"]: item["quantity"] for item in Cart.get_cart(user_id)})
+            with self._lock:
+                self.loads += 1
+        return lines
+
+    def add(self, user_id, product_id, quantity):
+        self.start()
+        with self._user_lock(user_id):
+            lines = self._ensure_loaded(user_id)
+            self.backend.add(user_id, product_id, int(quantity), base=lines)
+
+    def remove(self, user_id, product_id):
+        self.start()
+        with self._user_lock(user_id):
+            lines = self._ensure_loaded(user_id)
+            self.backend.remove(user_id, product_id, base=lines)
+
+    def get(self, user_id):
+        lines = self._ensure_loaded(user_id)
+        info = self._product_info(list(lines))
+        return [{"id": pid, "name": info.get(pid, {}).get("name"), "price": info.get(pid, {}).get("price"),
+                 "quantity": qty} for pid, qty in lines.items()]
+
+    def _product_info(self, product_ids):
+        # имя и цена для ответа; цена может отставать на PRODUCT_CACHE_TTL, заказ берёт её из Neo4j
+        found = {}
+        missing = []
+        for pid in product_ids:
+            info = self.products.get(pid)
+            if info is None:
+                missing.append(pid)
+            else:
+                found[pid] = info
+        if missing:
+            with driver.session() as s:
+                rows = s.execute_read(lambda tx: tx.run("""
+                    MATCH (p:Product) WHERE p.id IN $ids
+                    RETURN p.id AS id, p.name AS name, p.price AS price
+                """, ids=missing).data())
+            for row in rows:
+                self.products.set(row["id"], row)
+                found[row["id"]] = row
+        return found
+
+    def checkout(self, user_id, idempotency_key=None):
+        with self._user_lock(user_id), self._flush_lock:
+            entry = self.backend.dirty_entry(user_id)
+            if entry is not None:
+                version, lines = entry
+                self._write([(user_id, lines)])
+                self.backend.clear_dirty([(user_id, version)])
+            order = Cart.checkout(user_id, idempotency_key=idempotency_key)
+            # повтор по тому же ключу заказа не создаёт, а корзина в Neo4j остаётся как есть
+            if order is not None and order["created"]:
+                self.backend.put(user_id, {})
+        return order
+
+    # ------------------------
+    # Write-behind
+    # ------------------------
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="cart-flusher")
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Пишет все грязные корзины; возвращает число записанных"""
+        total = 0
+        with self._flush_lock:
+            started = time.monotonic()
+            # корзины, изменённые во время сброса, снова грязные — их допишет следующий цикл
+            for _ in range(self.backend.dirty_count() // self.batch_size + 1):
+                entries = self.backend.dirty_batch(self.batch_size)
+                if not entries:
+                    break
+                try:
+                    self._write([(u, lines) for u, _, lines in entries])
+                except Exception as e:
+                    print(f"Cart flush failed for {len(entries)} carts: {e}")
+                    with self._lock:
+                        self.flush_failures += 1
+                    break
+                self.backend.clear_dirty([(u, v) for u, v, _ in entries])
+                total += len(entries)
+            with self._lock:
+                self.flushed += total
+                if total:
+                    self.last_flush_seconds = time.monotonic() - started
+        return total
+
+    @staticmethod
+    def _write(carts):
+        rows = [{"user_id": u, "product_ids": list(lines),
+                 "lines": [{"product_id": p, "quantity": q} for p, q in lines.items()]} for u, lines in carts]
+        with driver.session() as s:
+            s.execute_write(lambda tx: tx.run("""
+                UNWIND $rows AS cart
+                MERGE (u:User {id:cart.user_id})
+                WITH u, cart
+                OPTIONAL MATCH (u)-[old:HAS_IN_CART]->(p:Product)
+                WHERE NOT p.id IN cart.product_ids
+                DELETE old
+                WITH DISTINCT u, cart
+                UNWIND cart.lines AS line
+                MATCH (p:Product {id:line.product_id})
+                MERGE (u)-[r:HAS_IN_CART]->(p)
+                SET r.quantity = line.quantity
+            """, rows=rows).consume())
+
+    def stats(self):
+        return {
+            **self.backend.stats(), "dirty": self.backend.dirty_count(),
+            "loads": self.loads, "flushed": self.flushed, "flush_failures": self.flush_failures,
+            "flush_latency_last": round(self.last_flush_seconds, 4), "flush_interval": self.flush_interval,
+        }
+
+
+class Neo4jCartStore:
+    """CART_STORE_BACKEND=neo4j: прежнее поведение, каждая операция сразу в Neo4j"""
+
+    add = staticmethod(Cart.add_to_cart)
+    remove = staticmethod(Cart.remove_from_cart)
+    get = staticmethod(Cart.get_cart)
+    checkout = staticmethod(Cart.checkout)
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        return {"backend": "neo4j"}
+
+
+def _make_store():
+    backend = CART_STORE_BACKEND
+    if backend == "auto":
+        # memory-корзину видит только свой воркер, поэтому при настроенном Redis — он
+        backend = "redis" if os.getenv("REDIS_URL") and redis is not None else "memory"
+    if backend == "neo4j":
+        return Neo4jCartStore()
+    if backend == "redis":
+        return CartStore(RedisCartBackend())
+    if WEB_CONCURRENCY > 1:
+        raise RuntimeError(
+            f"Cart store 'memory' is single-worker only (WEB_CONCURRENCY={WEB_CONCURRENCY}): "
+            "set REDIS_URL or CART_STORE_BACKEND=redis / neo4j")
+    return CartStore(MemoryCartBackend())
+
+
+cart_store = _make_store()
@@ -0,0 +1,203 @@
+# catalog_import.py
+import csv
+import io
+import json
+import time
+from neo4j_conn_Final import driver
+from cache import product_cache
+from search_index import search_index
+from promotions import promotions
+
+PRODUCT_FIELDS = ("id", "sku", "name", "category", "price", "brand", "description", "images", "tags", "options")
+LIST_FIELDS = ("images", "tags")
+MAX_REPORTED_ERRORS = 1000
+
+
+class ProductRecordError(ValueError):
+    pass
+
+
+def normalize_product(record):
+    """Проверяет запись каталога и приводит типы полей к тому, что хранится в Neo4j"""
+    if not isinstance(record, dict):
+        raise ProductRecordError("record must be an object")
+    product = {k: record[k] for k in PRODUCT_FIELDS if record.get(k) not in (None, "")}
+    if not product.get("id") and not product.get("sku"):
+        raise ProductRecordError("id or sku is required")
+    if not product.get("name"):
+        raise ProductRecordError("name is required")
+    for key in ("id", "sku", "category"):
+        if key in product:
+            product[key] = str(product[key])
+    if "price" in product:
+        try:
+            product["price"] = float(product["price"])
+        except (TypeError, ValueError):
+            raise ProductRecordError(f"invalid price {product['price']!r}")
+    for key in LIST_FIELDS:
+        if isinstance(product.get(key), str):
+            product[key] = [v.strip() for v in product[key].split("|") if v.strip()]
+    # свойства Neo4j не могут быть map — options храним JSON-строкой
+    if isinstance(product.get("options"), (dict, list)):
+        product["options"] = json.dumps(product["options"], ensure_ascii=False)
+    return product
+
+
+# ------------------------
+# Потоковое чтение источников
+# ------------------------
+def read_products_ndjson(lines):
+    for n, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield n, normalize_product(json.loads(line))
+        except ValueError as e:
+            yield n, ProductRecordError(str(e))
+
+
+def read_products_csv(f):
+    """CSV с заголовком из PRODUCT_FIELDS; images / tags через '|'"""
+    for n, row in enumerate(csv.DictReader(f), 2):
+        try:
+            yield n, normalize_product(row)
+        except ProductRecordError as e:
+            yield n, e
+
+
+def open_source(path):
+    f = open(path, newline="", encoding="utf-8")
+    if path.endswith(".csv"):
+        return f, read_products_csv(f)
+    return f, read_products_ndjson(f)
+
+
+def read_request_body(stream, content_type):
+    if "csv" in (content_type or ""):
+        return read_products_csv(io.TextIOWrapper(stream, encoding="utf-8", newline=""))
+    return read_products_ndjson(stream)
+
+
+# ------------------------
+# Пакетный upsert
+# ------------------------
+class ProductImporter:
+    """
+    Upsert товаров пачками: MERGE по id (или по sku, если id нет), поэтому
+    повторный прогон того же файла не создаёт дубликатов. Категории пачки
+    MERGE-ятся одним запросом до товаров и запоминаются на весь прогон.
+    Если пачка падает целиком, она переписывается построчно, чтобы найти
+    конкретные строки с ошибкой.
+    """
+
+    def __init__(self, batch_size=2000):
+        self.batch_size = batch_size
+        self.known_categories = set()
+
+    def load(self, records):
+        started = time.monotonic()
+        stats = {"records": 0, "upserted": 0, "failed": 0, "categories_created": 0, "errors": []}
+        batch = []
+        with driver.session() as s:
+            for n, product in records:
+                stats["records"] += 1
+                if isinstance(product, Exception):
+                    self._error(stats, n, None, product)
+                    continue
+                batch.append((n, product))
+                if len(batch) >= self.batch_size:
+                    self._flush(s, batch, stats)
+                    batch = []
+            if batch:
+                self._flush(s, batch, stats)
+        if stats["upserted"]:
+            # weight / season / promo могли измениться — материализованные подборки перестроятся;
+            # один раз на импорт, а не на каждую пачку
+            promotions.invalidate()
+        stats["seconds"] = round(time.monotonic() - started, 3)
+        return stats
+
+    def _flush(self, session, batch, stats):
+        categories = {p["category"] for _, p in batch if p.get("category")} - self.known_categories
+        if categories:
+            created = session.execute_write(self._write_categories, sorted(categories))
+            stats["categories_created"] += created
+            self.known_categories |= categories
+        try:
+            session.execute_write(self._write_products, [p for _, p in batch])
+            stats["upserted"] += len(batch)
+        except Exception:
+            for n, product in batch:
+                try:
+                    session.execute_write(self._write_products, [product])
+                    stats["upserted"] += 1
+                except Exception as e:
+                    self._error(stats, n, product.get("id") or product.get("sku"), e)
+        ids = [product.get("id") or product["sku"] for _, product in batch]
+        for product_id in ids:
+            product_cache.invalidate(product_id)
+        search_index.refresh(ids)
+
+    @staticmethod
+    def _write_categories(tx, names):
+        summary = tx.run("""
+            UNWIND $names AS name
+            MERGE (:Category {name:name})
+        """, names=names).consume()
+        return summary.counters.nodes_created
+
+    @staticmethod
+    def _write_products(tx, products):
+        by_id = [{"key": p["id"], "category": p.get("category"), "props": p} for p in products if p.get("id")]
+        by_sku = [{"key": p["sku"], "category": p.get("category"), "props": p} for p in products if not p.get("id")]
+        tail = """
+            SET p += row.props, p.updatedAt = datetime()
+            WITH p, row
+            OPTIONAL MATCH (p)-[old:BELONGS_TO]->(c:Category)
+            WHERE c.name <> row.category
+            DELETE old
+            WITH DISTINCT p, row
+            MATCH (c:Category {name:row.category})
+            MERGE (p)-[:BELONGS_TO]->(c)
+        """
+        if by_id:
+            tx.run("""
+                UNWIND $rows AS row
+                MERGE (p:Product {id:row.key})
+                ON CREATE SET p.createdAt = datetime()
+            """ + tail, rows=by_id)
+        if by_sku:
+            tx.run("""
+                UNWIND $rows AS row
+                MERGE (p:Product {sku:row.key})
+                ON CREATE SET p.id = row.key, p.createdAt = datetime()
+            """ + tail, rows=by_sku)
+
+    @staticmethod
+    def _error(stats, line, key, error):
+        stats["failed"] += 1
+        if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+            stats["errors"].append({"line": line, "key": key, "error": str(error)})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Импорт / upsert каталога товаров из CSV или NDJSON")
+    parser.add_argument("path", help="файл .csv или .ndjson")
+    parser.add_argument("--batch-size", type=int, default=2000)
+    parser.add_argument("--errors", help="записать отчёт об ошибках в этот файл (NDJSON)")
+    args = parser.parse_args()
+
+    importer = ProductImporter(args.batch_size)
+    f, records = open_source(args.path)
+    with f:
+        result = importer.load(records)
+    if args.errors:
+        with open(args.errors, "w", encoding="utf-8") as out:
+            for e in result["errors"]:
+                out.write(json.dumps(e, ensure_ascii=False) + "\n")
+    print(json.dumps({k: v for k, v in result.items() if k != "errors"}, indent=2))
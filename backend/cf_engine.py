@@ -1,9 +1,426 @@
-from neo4j_conn import driver
+from neo4j_conn_Final import driver, pop_dirty_preferences, restore_dirty_preferences
+import json
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    print("numpy не установлен, in-memory CF будет недоступен")
+
+
+# ------------------------
+# Разреженная матрица предпочтений в памяти
+# ------------------------
+class PreferenceMatrix:
+    """
+    Матрица User × Product в формате CSR (indptr / indices / data).
+    Строки — пользователи, столбцы — товары, значения — PREFERS.score.
+    Идентификаторы интернируются в плотные индексы.
+    """
+
+    def __init__(self, user_ids, product_ids, indptr, indices, data, products=None):
+        if np is None:
+            raise RuntimeError("numpy не установлен")
+        self.user_ids = list(user_ids)
+        self.product_ids = list(product_ids)
+        self.user_index = {uid: i for i, uid in enumerate(self.user_ids)}
+        self.product_index = {pid: i for i, pid in enumerate(self.product_ids)}
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float64)
+        # номер строки для каждого ненулевого элемента — для векторных R @ x и R.T @ y
+        self.rows = np.repeat(np.arange(len(self.user_ids), dtype=np.int32), np.diff(self.indptr))
+        self.user_norms = np.sqrt(self._row_sum(self.data * self.data))
+        self.item_norms = np.sqrt(self._col_sum(self.data * self.data))
+        self.products = products or {}
+
+    @classmethod
+    def from_triples(cls, triples, products=None):
+        """Строит CSR из последовательности (user_id, product_id, score)"""
+        user_ids, product_ids = [], []
+        user_index, product_index = {}, {}
+        rows, cols, vals = [], [], []
+        for user_id, product_id, score in triples:
+            if user_id not in user_index:
+                user_index[user_id] = len(user_ids)
+                user_ids.append(user_id)
+            if product_id not in product_index:
+                product_index[product_id] = len(product_ids)
+                product_ids.append(product_id)
+            rows.append(user_index[user_id])
+            cols.append(product_index[product_id])
+            vals.append(float(score or 0))
+
+        rows = np.asarray(rows, dtype=np.int32)
+        order = np.lexsort((np.asarray(cols, dtype=np.int32), rows))
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(user_ids)), out=indptr[1:])
+        return cls(
+            user_ids, product_ids, indptr,
+            np.asarray(cols, dtype=np.int32)[order],
+            np.asarray(vals, dtype=np.float64)[order],
+            products,
+        )
+
+    @classmethod
+    def load(cls):
+        """Загружает все PREFERS из Neo4j одним проходом"""
+        with driver.session() as s:
+            return s.execute_read(cls._read)
+
+    @classmethod
+    def _read(cls, tx):
+        # строки разбираются внутри транзакции: при повторе execute_read начинает с нуля
+        result = tx.run("""
+            MATCH (u:User)-[pref:PREFERS]->(p:Product)
+            RETURN u.id AS user_id, p.id AS product_id, pref.score AS score,
+                   p.name AS name, p.category AS category, p.price AS price
+        """)
+        products = {}
+        triples = []
+        for r in result:
+            triples.append((r["user_id"], r["product_id"], r["score"]))
+            products[r["product_id"]] = {"name": r["name"], "category": r["category"], "price": r["price"]}
+        return cls.from_triples(triples, products)
+
+    def triples(self):
+        """Обратное преобразование в (user_id, product_id, score)"""
+        for u, user_id in enumerate(self.user_ids):
+            items, prefs = self._row(u)
+            for i, score in zip(items, prefs):
+                yield user_id, self.product_ids[i], float(score)
+
+    def with_updates(self, changes):
+        """Новая матрица с применёнными изменениями (score <= 0 удаляет ячейку)"""
+        cells = {(u, p): score for u, p, score in self.triples()}
+        products = dict(self.products)
+        for change in changes:
+            key = (change["user_id"], change["product_id"])
+            if change["score"] and change["score"] > 0:
+                cells[key] = change["score"]
+                products[change["product_id"]] = {
+                    "name": change.get("name"), "category": change.get("category"), "price": change.get("price"),
+                }
+            else:
+                cells.pop(key, None)
+        return PreferenceMatrix.from_triples(((u, p, s) for (u, p), s in cells.items()), products)
+
+    # ------------------------
+    # Векторные операции над CSR
+    # ------------------------
+    def _row_sum(self, values):
+        return np.bincount(self.rows, weights=values, minlength=len(self.user_ids))
+
+    def _col_sum(self, values):
+        return np.bincount(self.indices, weights=values, minlength=len(self.product_ids))
+
+    def _row(self, u):
+        start, end = self.indptr[u], self.indptr[u + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def columns(self):
+        """CSC-представление: (col_ptr, rows, data) — пользователи каждого товара"""
+        order = np.argsort(self.indices, kind="stable")
+        col_ptr = np.zeros(len(self.product_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=len(self.product_ids)), out=col_ptr[1:])
+        return col_ptr, self.rows[order], self.data[order]
+
+    # ------------------------
+    # Рекомендации
+    # ------------------------
+    def user_based(self, user_id, limit=10):
+        """score(rec) = Σ_v cos(u, v) · pref(v, rec)"""
+        u = self.user_index.get(user_id)
+        if u is None:
+            return []
+        items, prefs = self._row(u)
+        x = np.zeros(len(self.product_ids))
+        x[items] = prefs
+        dot = self._row_sum(self.data * x[self.indices])
+        denom = self.user_norms * self.user_norms[u]
+        sim = np.divide(dot, denom, out=np.zeros_like(dot), where=denom > 0)
+        sim[u] = 0.0
+        scores = self._col_sum(self.data * sim[self.rows])
+        return self._top(scores, items, limit)
+
+    def item_based(self, user_id, limit=10):
+        """score(rec) = Σ_p pref(u, p) · cos(p, rec) по столбцам матрицы"""
+        u = self.user_index.get(user_id)
+        if u is None:
+            return []
+        items, prefs = self._row(u)
+        x = np.zeros(len(self.product_ids))
+        x[items] = prefs / self.item_norms[items]
+        y = self._row_sum(self.data * x[self.indices])
+        z = self._col_sum(self.data * y[self.rows])
+        scores = np.divide(z, self.item_norms, out=np.zeros_like(z), where=self.item_norms > 0)
+        return self._top(scores, items, limit)
+
+    def _top(self, scores, exclude, limit):
+        scores[exclude] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        # ORDER BY score DESC, id — как в Cypher-версии
+        ranked = sorted(candidates, key=lambda i: (-scores[i], self.product_ids[i]))[:limit]
+        out = []
+        for i in ranked:
+            pid = self.product_ids[i]
+            meta = self.products.get(pid, {})
+            out.append({
+                "id": pid, "name": meta.get("name"), "category": meta.get("category"),
+                "price": meta.get("price"), "score": float(scores[i]),
+            })
+        return out
+
+
+# ------------------------
+# Предрасчитанная item-item близость (SIMILAR_TO)
+# ------------------------
+class ItemSimilarity:
+    """
+    Офлайн-расчёт top-K соседей каждого товара по совместным взаимодействиям
+    (LIKED / PURCHASED / WISHLISTED). Результат хранится рёбрами
+    (p)-[:SIMILAR_TO {score, rank}]->(q), чтение — один индексный lookup.
+    """
+    METRICS = ("cosine", "jaccard")
+    WRITE_BATCH_SIZE = 500
+
+    def __init__(self, k=20, metric="cosine"):
+        if metric not in self.METRICS:
+            raise ValueError(f"Metric {metric} not supported")
+        self.k = k
+        self.metric = metric
+
+    @staticmethod
+    def load_interactions():
+        """Бинарная матрица User × Product по LIKED / PURCHASED / WISHLISTED"""
+        with driver.session() as s:
+            return s.execute_read(lambda tx: PreferenceMatrix.from_triples(
+                (r["user_id"], r["product_id"], 1.0) for r in tx.run("""
+                    MATCH (u:User)-[:LIKED|PURCHASED|WISHLISTED]->(p:Product)
+                    RETURN DISTINCT u.id AS user_id, p.id AS product_id
+                """)
+            ))
+
+    def neighbours(self, matrix):
+        """Генератор (product_id, [{"id", "score", "rank"}, ...]) для всех товаров"""
+        col_ptr, col_users, _ = matrix.columns()
+        degree = np.diff(col_ptr).astype(np.float64)
+
+        for i, product_id in enumerate(matrix.product_ids):
+            users = col_users[col_ptr[i]:col_ptr[i + 1]]
+            co_items = np.concatenate([matrix._row(u)[0] for u in users])
+            items, co = np.unique(co_items, return_counts=True)
+            keep = items != i
+            items, co = items[keep], co[keep].astype(np.float64)
+            if self.metric == "cosine":
+                scores = co / np.sqrt(degree[i] * degree[items])
+            else:
+                scores = co / (degree[i] + degree[items] - co)
+            top = np.argsort(-scores, kind="stable")[:self.k]
+            yield product_id, [
+                {"id": matrix.product_ids[items[j]], "score": float(scores[j]), "rank": rank + 1}
+                for rank, j in enumerate(top)
+            ]
+
+    def build(self):
+        """Пересчитывает SIMILAR_TO для всех товаров; возвращает статистику"""
+        started = time.monotonic()
+        matrix = self.load_interactions()
+        products = edges = 0
+        batch = []
+        with driver.session() as s:
+            for product_id, neighbours in self.neighbours(matrix):
+                batch.append({"product_id": product_id, "neighbours": neighbours})
+                products += 1
+                edges += len(neighbours)
+                if len(batch) >= self.WRITE_BATCH_SIZE:
+                    s.execute_write(self._write_batch, batch)
+                    batch = []
+            if batch:
+                s.execute_write(self._write_batch, batch)
+        stats = {"products": products, "edges": edges, "seconds": round(time.monotonic() - started, 3)}
+        print(f"Item similarity index built: {stats}")
+        return stats
+
+    @staticmethod
+    def _write_batch(tx, batch):
+        tx.run("""
+            UNWIND $batch AS row
+            MATCH (p:Product {id:row.product_id})
+            OPTIONAL MATCH (p)-[old:SIMILAR_TO]->()
+            DELETE old
+            WITH DISTINCT p, row
+            UNWIND row.neighbours AS n
+            MATCH (q:Product {id:n.id})
+            CREATE (p)-[:SIMILAR_TO {score:n.score, rank:n.rank}]->(q)
+        """, batch=batch)
+
+
+# ------------------------
+# Матричная факторизация (implicit ALS) + IVF-индекс для top-K
+# ------------------------
+class IVFIndex:
+    """
+    Инвертированный индекс по k-means кластерам векторов товаров.
+    Поиск просматривает только n_probe ближайших к запросу кластеров.
+    """
+
+    def __init__(self, centroids, list_ptr, list_items):
+        self.centroids = centroids
+        self.list_ptr = list_ptr
+        self.list_items = list_items
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, iterations=10, seed=42):
+        n = len(vectors)
+        n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(n, n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = cls._nearest(vectors, centroids)
+            for c in range(n_lists):
+                members = vectors[assign == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        assign = cls._nearest(vectors, centroids)
+        list_ptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=list_ptr[1:])
+        return cls(centroids, list_ptr, np.argsort(assign, kind="stable").astype(np.int32))
+
+    @staticmethod
+    def _nearest(vectors, centroids):
+        # ||v - c||² = ||v||² - 2 v·c + ||c||², ||v||² на argmin не влияет
+        dist = (centroids * centroids).sum(axis=1) - 2 * vectors @ centroids.T
+        return np.argmin(dist, axis=1)
+
+    def search(self, vectors, query, k, n_probe=8, exclude=()):
+        """Возвращает (индексы, скоры) top-k по скалярному произведению"""
+        n_probe = min(n_probe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        candidates = np.concatenate([self.list_items[self.list_ptr[c]:self.list_ptr[c + 1]] for c in lists])
+        if len(exclude):
+            candidates = candidates[~np.isin(candidates, exclude)]
+        scores = vectors[candidates] @ query
+        top = np.argsort(-scores, kind="stable")[:k]
+        return candidates[top], scores[top]
+
+
+class ModelNotReady(RuntimeError):
+    """ALS-модель ещё не обучена или её файл не читается"""
+
+
+class MatrixFactorization:
+    """
+    Implicit ALS (Hu, Koren, Volinsky) по PREFERS.score: confidence = 1 + alpha · score.
+    Обученная модель вместе с IVF-индексом сохраняется в один .npz-файл.
+    """
+
+    def __init__(self, factors=32, regularization=0.1, alpha=10.0, iterations=10, seed=42):
+        if np is None:
+            raise RuntimeError("numpy не установлен")
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.seed = seed
+        self.matrix = None
+        self.user_factors = None
+        self.item_factors = None
+        self.index = None
+
+    def fit(self, matrix):
+        rng = np.random.default_rng(self.seed)
+        n_users, n_items = len(matrix.user_ids), len(matrix.product_ids)
+        users = rng.normal(scale=0.01, size=(n_users, self.factors))
+        items = rng.normal(scale=0.01, size=(n_items, self.factors))
+        by_user = (matrix.indptr, matrix.indices, matrix.data)
+        by_item = matrix.columns()
+        for _ in range(self.iterations):
+            self._als_step(users, items, *by_user)
+            self._als_step(items, users, *by_item)
+        self.matrix = matrix
+        self.user_factors, self.item_factors = users, items
+        self.index = IVFIndex.build(items, seed=self.seed)
+        return self
+
+    def _als_step(self, solve, fixed, indptr, indices, data):
+        gram = fixed.T @ fixed
+        reg = self.regularization * np.eye(self.factors)
+        for u in range(len(solve)):
+            idx = indices[indptr[u]:indptr[u + 1]]
+            if not len(idx):
+                solve[u] = 0.0
+                continue
+            conf = 1.0 + self.alpha * data[indptr[u]:indptr[u + 1]]
+            y = fixed[idx]
+            a = gram + (y.T * (conf - 1.0)) @ y + reg
+            solve[u] = np.linalg.solve(a, y.T @ conf)
+
+    def recommend(self, user_id, limit=10, n_probe=8):
+        u = self.matrix.user_index.get(user_id)
+        if u is None:
+            return []
+        seen, _ = self.matrix._row(u)
+        items, scores = self.index.search(self.item_factors, self.user_factors[u], limit, n_probe, seen)
+        out = []
+        for i, score in zip(items, scores):
+            pid = self.matrix.product_ids[i]
+            meta = self.matrix.products.get(pid, {})
+            out.append({
+                "id": pid, "name": meta.get("name"), "category": meta.get("category"),
+                "price": meta.get("price"), "score": float(score),
+            })
+        return out
+
+    # ------------------------
+    # Сохранение / загрузка модели
+    # ------------------------
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        m = self.matrix
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                # id как строковые массивы: файл читается с allow_pickle=False
+                user_ids=np.array([str(x) for x in m.user_ids], dtype=str),
+                product_ids=np.array([str(x) for x in m.product_ids], dtype=str),
+                indptr=m.indptr, indices=m.indices, data=m.data,
+                products=np.array(json.dumps(m.products)),
+                user_factors=self.user_factors, item_factors=self.item_factors,
+                centroids=self.index.centroids, list_ptr=self.index.list_ptr, list_items=self.index.list_items,
+                params=np.array(json.dumps({
+                    "factors": self.factors, "regularization": self.regularization,
+                    "alpha": self.alpha, "iterations": self.iterations, "seed": self.seed,
+                })),
+            )
+
+    @classmethod
+    def load(cls, path):
+        # ValueError для файлов старого формата (object-массивы): модель нужно переобучить
+        with np.load(path, allow_pickle=False) as f:
+            model = cls(**json.loads(str(f["params"])))
+            model.matrix = PreferenceMatrix(
+                f["user_ids"].tolist(), f["product_ids"].tolist(),
+                f["indptr"], f["indices"], f["data"], json.loads(str(f["products"])),
+            )
+            model.user_factors = f["user_factors"]
+            model.item_factors = f["item_factors"]
+            model.index = IVFIndex(f["centroids"], f["list_ptr"], f["list_items"])
+        return model
+
 
 class CollaborativeFiltering:
-    def __init__(self):
-        self.algorithms = ["user_based", "item_based"]  # поддержка нескольких алгоритмов
+    DELTA_BATCH_SIZE = 1000
+
+    def __init__(self, in_memory=False, model_path=None):
+        self.algorithms = ["user_based", "item_based", "als"]  # поддержка нескольких алгоритмов
         self.current_algo = "user_based"
+        self.in_memory = in_memory
+        self.matrix = None
+        self.model_path = model_path or os.getenv("CF_MODEL_PATH", "models/cf_als.npz")
+        self.model = None
 
     def set_algorithm(self, algo_name):
         if algo_name in self.algorithms:
@@ -11,49 +428,265 @@ class CollaborativeFiltering:
         else:
             raise ValueError(f"Algorithm {algo_name} not supported")
 
+    def load_matrix(self):
+        """Загружает PREFERS в память; дальше recommend() не обращается к Neo4j"""
+        self.matrix = PreferenceMatrix.load()
+        print(f"Preference matrix loaded: {len(self.matrix.user_ids)} users, "
+              f"{len(self.matrix.product_ids)} products, {len(self.matrix.data)} scores.")
+
+    def train_model(self, **params):
+        """Обучает ALS на текущих PREFERS и сохраняет модель в model_path"""
+        started = time.monotonic()
+        self.model = MatrixFactorization(**params).fit(PreferenceMatrix.load())
+        self.model.save(self.model_path)
+        print(f"ALS model trained in {time.monotonic() - started:.1f}s, saved to {self.model_path}")
+        return self.model
+
+    def load_model(self):
+        """Загружает сохранённую модель, если файл есть"""
+        if os.path.exists(self.model_path):
+            try:
+                self.model = MatrixFactorization.load(self.model_path)
+            except (ValueError, KeyError) as e:
+                print(f"ALS model at {self.model_path} is unreadable, retrain with --train-als: {e}")
+        return self.model
+
     # ------------------------
     # Регулярное обновление матрицы предпочтений
     # ------------------------
-    def update_preference_matrix(self):
+    def update_preference_matrix(self, incremental=False):
         """
         Построение матрицы User × Product с учётом покупок и лайков
         Сохраняется в виде свойств или отдельного узла в Neo4j
+
+        incremental=True пересчитывает только пары (user, product), затронутые
+        после последнего запуска: лайки / покупки, записанные после watermark
+        (r.recorded_at, в том числе другими процессами), плюс пары, отмеченные
+        History.log_like / log_purchase в этом процессе.
+        Возвращает {"mode", "pairs", "changed", "seconds"}.
+        """
+        if incremental:
+            stats = self._update_preference_delta()
+            if stats is not None:
+                return stats
+
+        started = time.monotonic()
+        with driver.session() as s:
+            changed = s.execute_write(self._rebuild_preferences)
+        pop_dirty_preferences()
+        stats = {
+            "mode": "full",
+            "pairs": None,
+            "changed": changed,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        print(f"Preference matrix updated successfully: {stats}")
+        if self.in_memory:
+            self.load_matrix()
+        return stats
+
+    @classmethod
+    def _rebuild_preferences(cls, tx):
+        # пересчёт и watermark — одна транзакция: watermark не сдвинется без PREFERS
+        now = tx.run("RETURN datetime() AS now").single()["now"]
+        # пример: считать количество взаимодействий (лайки + покупки)
+        summary = tx.run("""
+            MATCH (u:User)-[r:PURCHASED|LIKED]->(p:Product)
+            WITH u, p, count(r) AS score
+            MERGE (u)-[pref:PREFERS]->(p)
+            SET pref.score = score
+        """).consume()
+        cls._set_watermark(tx, now)
+        return summary.counters.properties_set
+
+    def _update_preference_delta(self):
+        """None, если отмеченных пар было больше PREFERENCE_DIRTY_MAX — тогда нужен полный пересчёт"""
+        started = time.monotonic()
+        pairs, overflow = pop_dirty_preferences()
+        if overflow:
+            print("Dirty preference pairs overflowed, falling back to a full PREFERS rebuild")
+            return None
+        dirty = set(pairs)
+        try:
+            pairs, changes = self._write_preference_delta(dirty)
+        except Exception:
+            # watermark не сдвинут, а отмеченные в процессе пары возвращаются — следующий запуск повторит их
+            restore_dirty_preferences(dirty)
+            raise
+
+        stats = {
+            "mode": "incremental",
+            "pairs": len(pairs),
+            "changed": len(changes),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        print(f"Preference matrix updated incrementally: {stats}")
+        if self.in_memory and changes:
+            if self.matrix is None:
+                self.load_matrix()
+            else:
+                self.matrix = self.matrix.with_updates(changes)
+        return stats
+
+    def _write_preference_delta(self, dirty):
+        """Пересчитывает dirty плюс пары, записанные после watermark; (pairs, changes)"""
+        pairs = set(dirty)
+        with driver.session() as s:
+            now, recorded = s.execute_read(self._read_recorded_pairs)
+            pairs.update(recorded)
+
+            pairs = [{"user_id": u, "product_id": p} for u, p in pairs]
+            changes = []
+            for i in range(0, len(pairs), self.DELTA_BATCH_SIZE):
+                batch = pairs[i:i + self.DELTA_BATCH_SIZE]
+                changes.extend(s.execute_write(self._write_preference_batch, batch))
+            s.execute_write(self._set_watermark, now)
+        return pairs, changes
+
+    @staticmethod
+    def _read_recorded_pairs(tx):
+        """(now, пары (user, product) с рёбрами, записанными после watermark)"""
+        row = tx.run("""
+            OPTIONAL MATCH (state:CFState {name:'preferences'})
+            RETURN datetime() AS now, state.watermark AS watermark
+        """).single()
+        now, watermark = row["now"], row["watermark"]
+        if watermark is None:
+            return now, set()
+        # recorded_at — время записи ребра: так видны и исторические события, загруженные
+        # после прошлого запуска другим процессом. Фильтр по самому свойству (без coalesce)
+        # и по одному типу связи в ветке, чтобы работали relationship-индексы из schema.py;
+        # у рёбер, записанных до recorded_at, его проставляет --backfill-recorded-at
+        result = tx.run("""
+            MATCH (u:User)-[r:PURCHASED]->(p:Product) WHERE r.recorded_at >= $since
+            RETURN u.id AS user_id, p.id AS product_id
+            UNION
+            MATCH (u:User)-[r:LIKED]->(p:Product) WHERE r.recorded_at >= $since
+            RETURN u.id AS user_id, p.id AS product_id
+        """, since=watermark)
+        return now, {(r["user_id"], r["product_id"]) for r in result}
+
+    @staticmethod
+    def backfill_recorded_at(batch_size=10000):
         """
+        Разовая миграция: recorded_at = time у PURCHASED / LIKED, записанных до его появления.
+        Пачками, каждая — своя транзакция; возвращает число обновлённых рёбер.
+        """
+        total = 0
         with driver.session() as s:
-            # пример: считать количество взаимодействий (лайки + покупки)
-            s.run("""
-                MATCH (u:User)-[r:PURCHASED|LIKED]->(p:Product)
-                WITH u, p, count(r) AS score
+            while True:
+                updated = s.execute_write(lambda tx: tx.run("""
+                    MATCH ()-[r:PURCHASED|LIKED]->()
+                    WHERE r.recorded_at IS NULL
+                    WITH r LIMIT $batch_size
+                    SET r.recorded_at = coalesce(r.time, datetime())
+                    RETURN count(r) AS updated
+                """, batch_size=batch_size).single()["updated"])
+                total += updated
+                if updated < batch_size:
+                    return total
+
+    @staticmethod
+    def _write_preference_batch(tx, batch):
+        # пишем только реально изменившиеся score; пропавшие взаимодействия удаляют PREFERS
+        result = tx.run("""
+            UNWIND $batch AS pair
+            MATCH (u:User {id:pair.user_id}), (p:Product {id:pair.product_id})
+            OPTIONAL MATCH (u)-[r:PURCHASED|LIKED]->(p)
+            WITH u, p, count(r) AS score
+            OPTIONAL MATCH (u)-[old:PREFERS]->(p)
+            WITH u, p, score, old
+            WHERE coalesce(old.score, 0) <> score
+            FOREACH (_ IN CASE WHEN score > 0 THEN [1] ELSE [] END |
                 MERGE (u)-[pref:PREFERS]->(p)
                 SET pref.score = score
-            """)
-        print("Preference matrix updated successfully.")
+            )
+            FOREACH (_ IN CASE WHEN score = 0 THEN [1] ELSE [] END | DELETE old)
+            RETURN u.id AS user_id, p.id AS product_id, score,
+                   p.name AS name, p.category AS category, p.price AS price
+        """, batch=batch)
+        return [r.data() for r in result]
+
+    @staticmethod
+    def _set_watermark(tx, now):
+        tx.run("""
+            MERGE (state:CFState {name:'preferences'})
+            SET state.watermark = $now
+        """, now=now)
 
     # ------------------------
     # Выдача рекомендаций на основе выбранного алгоритма
     # ------------------------
-    def recommend(self, user_id, limit=10):
+    def recommend(self, user_id, limit=10, algo=None):
+        algo = algo or self.current_algo
+        if algo not in self.algorithms:
+            raise ValueError(f"Algorithm {algo} not supported")
+        if algo == "als":
+            if self.model is None and self.load_model() is None:
+                raise ModelNotReady(f"ALS model not found at {self.model_path}, run: python cf_engine.py --train-als")
+            return self.model.recommend(user_id, limit)
+        if self.in_memory:
+            if self.matrix is None:
+                self.load_matrix()
+            return getattr(self.matrix, algo)(user_id, limit)
+
         with driver.session() as s:
-            if self.current_algo == "user_based":
-                # user-based CF: похожие пользователи
-                result = s.run("""
-                    MATCH (u:User {id:$user_id})-[:PREFERS]->(p:Product)
-                    WITH u, collect(p) AS user_products
-                    MATCH (other:User)-[:PREFERS]->(p2:Product)
-                    WHERE other <> u AND any(prod IN p2 WHERE prod IN user_products)
-                    WITH p2 AS rec, count(*) AS score
-                    RETURN rec.id AS id, rec.name AS name, rec.category AS category, rec.price AS price, score
-                    ORDER BY score DESC
-                    LIMIT $limit
-                """, user_id=user_id, limit=limit)
-            else:
-                # item-based CF: похожие товары
-                result = s.run("""
-                    MATCH (u:User {id:$user_id})-[:PREFERS]->(p:Product)
-                    MATCH (p)-[:IN_CATEGORY]->(c:Category)<-[:IN_CATEGORY]-(rec:Product)
-                    WHERE NOT (u)-[:PREFERS]->(rec)
-                    RETURN rec.id AS id, rec.name AS name, rec.category AS category, rec.price AS price, count(*) AS score
-                    ORDER BY score DESC
-                    LIMIT $limit
-                """, user_id=user_id, limit=limit)
-            return [r.data() for r in result]
+            return s.execute_read(self._recommend_cypher, algo, user_id, limit)
+
+    @staticmethod
+    def _recommend_cypher(tx, algo, user_id, limit):
+        if algo == "user_based":
+            # user-based CF: косинусная близость пользователей по PREFERS.score
+            result = tx.run("""
+                MATCH (u:User {id:$user_id})-[r1:PREFERS]->(:Product)<-[r2:PREFERS]-(other:User)
+                WHERE other <> u
+                WITH u, other, sum(r1.score * r2.score) AS dot
+                MATCH (u)-[ru:PREFERS]->()
+                WITH u, other, dot, sqrt(sum(ru.score * ru.score)) AS u_norm
+                MATCH (other)-[ro:PREFERS]->()
+                WITH u, other, dot / (u_norm * sqrt(sum(ro.score * ro.score))) AS sim
+                MATCH (other)-[r:PREFERS]->(rec:Product)
+                WHERE NOT (u)-[:PREFERS]->(rec)
+                WITH rec, sum(sim * r.score) AS score
+                WHERE score > 0
+                RETURN rec.id AS id, rec.name AS name, rec.category AS category, rec.price AS price, score
+                ORDER BY score DESC, id
+                LIMIT $limit
+            """, user_id=user_id, limit=limit)
+        else:
+            # item-based CF: предрасчитанные соседи SIMILAR_TO (ItemSimilarity.build, --similarity),
+            # взвешенные PREFERS.score товаров пользователя
+            result = tx.run("""
+                MATCH (u:User {id:$user_id})-[ru:PREFERS]->(p:Product)-[sim:SIMILAR_TO]->(rec:Product)
+                WHERE NOT (u)-[:PREFERS]->(rec)
+                WITH rec, sum(ru.score * sim.score) AS score
+                WHERE score > 0
+                RETURN rec.id AS id, rec.name AS name, rec.category AS category, rec.price AS price, score
+                ORDER BY score DESC, id
+                LIMIT $limit
+            """, user_id=user_id, limit=limit)
+        return [r.data() for r in result]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Пересчёт матрицы предпочтений PREFERS")
+    parser.add_argument("--incremental", action="store_true", help="только затронутые пары (user, product)")
+    parser.add_argument("--similarity", action="store_true", help="пересчитать индекс SIMILAR_TO вместо PREFERS")
+    parser.add_argument("--k", type=int, default=20, help="число соседей на товар для --similarity")
+    parser.add_argument("--metric", choices=ItemSimilarity.METRICS, default="cosine")
+    parser.add_argument("--train-als", action="store_true", help="обучить ALS-модель и сохранить в CF_MODEL_PATH")
+    parser.add_argument("--factors", type=int, default=32)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--backfill-recorded-at", action="store_true",
+                        help="разово проставить recorded_at старым PURCHASED / LIKED (для --incremental)")
+    args = parser.parse_args()
+    if args.backfill_recorded_at:
+        print(f"recorded_at backfilled on {CollaborativeFiltering.backfill_recorded_at()} relationships")
+    elif args.train_als:
+        CollaborativeFiltering().train_model(factors=args.factors, iterations=args.iterations)
+    elif args.similarity:
+        ItemSimilarity(k=args.k, metric=args.metric).build()
+    else:
+        CollaborativeFiltering().update_preference_matrix(incremental=args.incremental)
@@ -0,0 +1,45 @@
+# history_compaction.py
+import json
+import time
+from neo4j_conn_Final import History, User
+
+BATCH_SIZE = 200  # у тяжёлых пользователей десятки тысяч рёбер VIEWED — пачки меньше, чем у сегментов
+
+
+class ViewCompactionJob:
+    """
+    Сворачивает накопленные параллельные VIEWED в сжатые рёбра (count / first_seen /
+    last_seen / recent). Пользователи читаются пачками по возрастанию id (keyset),
+    каждая пачка сворачивается своей транзакцией. Повторный запуск безопасен:
+    уже сжатые пары не трогаются.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def run(self):
+        started = time.monotonic()
+        stats = {"users": 0, "batches": 0, "pairs": 0, "edges_removed": 0}
+        after = None
+        while True:
+            ids = User.next_ids(after, self.batch_size)
+            if not ids:
+                break
+            result = History.compact_views(ids)
+            stats["users"] += len(ids)
+            stats["batches"] += 1
+            stats["pairs"] += result["pairs"]
+            stats["edges_removed"] += result["edges_removed"]
+            after = ids[-1]
+        stats["seconds"] = round(time.monotonic() - started, 3)
+        return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Сжатие просмотров VIEWED в одно ребро на пару пользователь-товар")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    print(json.dumps(ViewCompactionJob(args.batch_size).run(), indent=2))
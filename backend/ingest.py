@@ -0,0 +1,298 @@
+# ingest.py
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from dotenv import load_dotenv
+from neo4j_conn_Final import History
+
+load_dotenv()
+
+INGEST_MODE = os.getenv("INGEST_MODE", "async")  # async | sync
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 0.5))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 1))
+INGEST_PUT_TIMEOUT = float(os.getenv("INGEST_PUT_TIMEOUT", 1.0))
+INGEST_RETRY_BACKOFF = float(os.getenv("INGEST_RETRY_BACKOFF", 0.5))          # первая пауза после неудачной записи
+INGEST_RETRY_MAX_BACKOFF = float(os.getenv("INGEST_RETRY_MAX_BACKOFF", 30.0))
+# куда при остановке уходят события, которые так и не удалось записать; подхватываются при старте
+INGEST_SPILL_PATH = os.getenv("INGEST_SPILL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_spill.ndjson"))
+
+# порядок сброса групп: покупка должна быть записана раньше возврата
+ACTIONS = ("view", "like", "wishlist_add", "wishlist_remove", "purchase", "return")
+_OPPOSITE = {"wishlist_add": "wishlist_remove", "wishlist_remove": "wishlist_add"}
+_STOP = object()
+
+
+class IngestQueueFull(Exception):
+    """Очередь переполнена дольше INGEST_PUT_TIMEOUT — клиенту стоит повторить позже"""
+
+
+def group_events(items):
+    """
+    Раскладывает [(action, event)] на группы [(action, [event])] в порядке ACTIONS.
+    Если add/remove вишлиста одной пары встречаются в одном окне, окно закрывается,
+    чтобы не поменять их местами.
+    """
+    groups = []
+    pending = {action: [] for action in ACTIONS}
+    pairs = {action: set() for action in _OPPOSITE}
+
+    def close():
+        for action in ACTIONS:
+            if pending[action]:
+                groups.append((action, pending[action]))
+                pending[action] = []
+        for action in pairs:
+            pairs[action].clear()
+
+    for action, event in items:
+        opposite = _OPPOSITE.get(action)
+        if opposite:
+            pair = (event["user_id"], event["product_id"])
+            if pair in pairs[opposite]:
+                close()
+            pairs[action].add(pair)
+        pending[action].append(event)
+    close()
+    return groups
+
+
+# ------------------------
+# Фоновый писатель событий
+# ------------------------
+class _Writer(threading.Thread):
+    def __init__(self, ingestor, maxsize):
+        super().__init__(daemon=True, name="ingest-writer")
+        self.ingestor = ingestor
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.pending = []
+        self.backoff = 0.0
+        self.retry_at = None
+
+    def run(self):
+        deadline = time.monotonic() + self.ingestor.flush_interval
+        while True:
+            wait = max(0.0, deadline - time.monotonic())
+            if self.retry_at is not None and self.pending_count >= self.ingestor.batch_size:
+                # запись падает, а окно уже полное: новые события остаются в очереди, она
+                # заполняется, и submit отвечает IngestQueueFull вместо того, чтобы терять данные
+                item = _STOP if self.ingestor.stopping.wait(wait) else None
+            else:
+                try:
+                    item = self.queue.get(timeout=wait)
+                except queue.Empty:
+                    item = _STOP if self.ingestor.stopping.is_set() else None
+            if item is _STOP:
+                self.drain()
+                self.flush(final=True)
+                return
+            if item is not None:
+                self.add(*item)
+            now = time.monotonic()
+            if self.pending_count >= self.ingestor.batch_size or now >= deadline:
+                if self.retry_at is None or now >= self.retry_at:
+                    self.flush()
+                deadline = time.monotonic() + self.ingestor.flush_interval
+
+    def drain(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                self.add(*item)
+
+    def add(self, action, event):
+        self.pending.append((action, event))
+
+    @property
+    def pending_count(self):
+        return len(self.pending)
+
+    def flush(self, final=False):
+        """
+        Пишет накопленное по группам. При ошибке группа и все следующие за ней
+        возвращаются в начало pending (порядок сохраняется) и повторяются с
+        экспоненциальной паузой; при остановке они сбрасываются в INGEST_SPILL_PATH.
+        """
+        if not self.pending:
+            return
+        started = time.monotonic()
+        items, self.pending = self.pending, []
+        groups = group_events(items)
+        for n, (action, events) in enumerate(groups):
+            try:
+                History.log_batch(action, events)
+                self.ingestor.record_flush(len(events), ok=True)
+            except Exception as e:
+                self.pending = [(a, event) for a, rest in groups[n:] for event in rest] + self.pending
+                self.backoff = min(INGEST_RETRY_MAX_BACKOFF, self.backoff * 2 or INGEST_RETRY_BACKOFF)
+                self.retry_at = time.monotonic() + self.backoff
+                self.ingestor.record_flush(len(events), ok=False)
+                print(f"Ingest flush failed for {len(events)} {action} events, "
+                      f"{len(self.pending)} kept for retry in {self.backoff}s: {e}")
+                break
+        else:
+            self.backoff = 0.0
+            self.retry_at = None
+        self.ingestor.record_latency(time.monotonic() - started)
+        if final and self.pending:
+            self.ingestor.spill(self.pending)
+            self.pending = []
+
+
+class EventIngestor:
+    """
+    Ограниченная очередь событий истории с фоновыми писателями.
+    События одного пользователя всегда попадают к одному писателю (порядок сохраняется),
+    писатель группирует их по типу и пишет History.log_batch по размеру или по таймеру.
+    Неудачные записи повторяются, пока Neo4j не ответит; то, что не записалось
+    к остановке, сохраняется в INGEST_SPILL_PATH и дописывается при следующем старте.
+    В режиме sync события пишутся сразу в запросе.
+    """
+
+    def __init__(self, mode=INGEST_MODE, queue_size=INGEST_QUEUE_SIZE, batch_size=INGEST_BATCH_SIZE,
+                 flush_interval=INGEST_FLUSH_INTERVAL, workers=INGEST_WORKERS, put_timeout=INGEST_PUT_TIMEOUT,
+                 spill_path=INGEST_SPILL_PATH):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.workers = []
+        self._queue_size = queue_size
+        self._worker_count = max(1, workers)
+        self._lock = threading.Lock()
+        self._started = False
+        self.stopping = threading.Event()
+        self.spill_path = spill_path
+        self._spill_lock = threading.Lock()
+        self.spilled = 0
+        self.restored = 0
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._started or self.mode != "async":
+                return
+            maxsize = max(1, self._queue_size // self._worker_count)
+            self.stopping.clear()
+            self.workers = [_Writer(self, maxsize) for _ in range(self._worker_count)]
+            self._restore_spill()
+            for w in self.workers:
+                w.start()
+            self._started = True
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10.0):
+        """Дописывает всё, что осталось в очередях, и останавливает писателей"""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        self.stopping.set()
+        for w in self.workers:
+            try:
+                w.queue.put(_STOP, timeout=self.put_timeout)
+            except queue.Full:
+                pass  # писатель в паузе на полном окне: его разбудит stopping
+        for w in self.workers:
+            w.join(timeout)
+
+    def _worker_for(self, user_id):
+        return self.workers[zlib.crc32(str(user_id).encode()) % len(self.workers)]
+
+    def spill(self, items):
+        """Дописывает незаписанные события в INGEST_SPILL_PATH (по строке JSON на событие)"""
+        with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as f:
+            for action, event in items:
+                f.write(json.dumps({"action": action, "event": event}) + "\n")
+        with self._lock:
+            self.spilled += len(items)
+        print(f"Ingest spilled {len(items)} unwritten events to {self.spill_path}")
+
+    def _restore_spill(self):
+        # файл забирается переименованием, чтобы не съесть строки, которые в этот момент
+        # дописывает другой процесс
+        taken = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.replace(self.spill_path, taken)
+        except FileNotFoundError:
+            return
+        count = 0
+        with open(taken, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    self._worker_for(item["event"]["user_id"]).add(item["action"], item["event"])
+                    count += 1
+        os.remove(taken)
+        self.restored += count
+        print(f"Ingest restored {count} spilled events from {self.spill_path}")
+
+    def submit(self, action, user_id, product_id, at=None):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action {action}")
+        event = {
+            "user_id": user_id, "product_id": product_id,
+            "time": at or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        if self.mode != "async":
+            History.log_batch(action, [event])
+            self.record_flush(1, ok=True)
+            return
+        self.start()
+        worker = self._worker_for(user_id)
+        try:
+            worker.queue.put((action, event), timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise IngestQueueFull(f"ingest queue is full ({worker.queue.maxsize})")
+        with self._lock:
+            self.enqueued += 1
+
+    def record_flush(self, count, ok):
+        with self._lock:
+            if ok:
+                self.written += count
+            else:
+                self.failed += count
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self.flushes += 1
+            self.last_flush_seconds = seconds
+            self.flush_seconds_total += seconds
+            self.flush_seconds_max = max(self.flush_seconds_max, seconds)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "queue_depth": sum(w.queue.qsize() + w.pending_count for w in self.workers),
+            "queue_capacity": sum(w.queue.maxsize for w in self.workers),
+            "enqueued": self.enqueued, "written": self.written,
+            "failed": self.failed, "rejected": self.rejected,
+            "retrying": sum(w.pending_count for w in self.workers if w.retry_at is not None),
+            "spilled": self.spilled, "restored": self.restored,
+            "flushes": self.flushes,
+            "flush_latency_avg": round(self.flush_seconds_total / self.flushes, 4) if self.flushes else 0.0,
+            "flush_latency_max": round(self.flush_seconds_max, 4),
+            "flush_latency_last": round(self.last_flush_seconds, 4),
+        }
+
+
+ingestor = EventIngestor()
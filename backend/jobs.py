@@ -0,0 +1,46 @@
+# jobs.py
+import threading
+import time
+
+
+class BackgroundJobs:
+    """
+    Тяжёлые админские задачи (пересчёты, сжатие истории) в фоновом потоке:
+    запрос сразу получает 202, состояние смотрится через status(). Одновременно
+    идёт не больше одной задачи каждого вида. Состояние живёт в памяти процесса.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, name, fn):
+        """(True, состояние) — задача запущена; (False, состояние) — такая уже выполняется"""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is not None and job["status"] == "running":
+                return False, dict(job)
+            job = self._jobs[name] = {"name": name, "status": "running", "started_at": time.time(),
+                                      "finished_at": None, "result": None, "error": None}
+            snapshot = dict(job)
+        threading.Thread(target=self._run, args=(job, fn), daemon=True, name=f"job-{name}").start()
+        return True, snapshot
+
+    def _run(self, job, fn):
+        try:
+            result, error, status = fn(), None, "done"
+        except Exception as e:
+            print(f"Job {job['name']} failed: {e}")
+            result, error, status = None, str(e), "failed"
+        with self._lock:
+            job.update(status=status, result=result, error=error, finished_at=time.time())
+
+    def status(self, name=None):
+        with self._lock:
+            if name is not None:
+                job = self._jobs.get(name)
+                return dict(job) if job else None
+            return {n: dict(job) for n, job in self._jobs.items()}
+
+
+jobs = BackgroundJobs()
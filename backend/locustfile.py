@@ -5,7 +5,7 @@ class EcommerceUser(HttpUser):
 
     @task
     def get_recommendations(self):
-        self.client.get("/recommendations/user123?algo=user_based&limit=10")
+        self.client.get("/cf/recommend/user123?limit=10")
 
     @task
     def search_products(self):
@@ -0,0 +1,290 @@
+# mail_outbox.py
+import atexit
+import json
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+from email.message import EmailMessage
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAIL_SERVER = os.getenv("MAIL_SERVER", "localhost")
+MAIL_PORT = int(os.getenv("MAIL_PORT", 25))
+MAIL_USERNAME = os.getenv("MAIL_USERNAME", "")
+MAIL_PASSWORD = os.getenv("MAIL_PASSWORD", "")
+MAIL_USE_TLS = os.getenv("MAIL_USE_TLS", "false").lower() == "true"
+MAIL_DEFAULT_SENDER = os.getenv("MAIL_DEFAULT_SENDER", "noreply@localhost")
+MAIL_OUTBOX_PATH = os.getenv("MAIL_OUTBOX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mail_outbox.db"))
+MAIL_CONCURRENCY = int(os.getenv("MAIL_CONCURRENCY", 2))  # отправителей = одновременных SMTP-соединений
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 8))
+MAIL_RETRY_BASE = float(os.getenv("MAIL_RETRY_BASE", 5.0))  # задержка после 1-й ошибки, дальше x2
+MAIL_RETRY_MAX = float(os.getenv("MAIL_RETRY_MAX", 3600.0))
+MAIL_IDLE_CLOSE = float(os.getenv("MAIL_IDLE_CLOSE", 30.0))  # закрыть SMTP-соединение после простоя
+MAIL_SMTP_TIMEOUT = float(os.getenv("MAIL_SMTP_TIMEOUT", 10.0))
+# письмо в sending дольше аренды считается брошенным (процесс упал) и забирается снова;
+# должна быть заметно больше времени отправки одного письма
+MAIL_CLAIM_LEASE = float(os.getenv("MAIL_CLAIM_LEASE", 300.0))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipients TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    sent_at REAL,
+    claimed_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+
+def backoff(attempts):
+    return min(MAIL_RETRY_MAX, MAIL_RETRY_BASE * 2 ** (attempts - 1))
+
+
+class MailOutbox:
+    """
+    Исходящая почта через локальную очередь в SQLite.
+    enqueue() только вставляет строку — запрос не ждёт SMTP. Фоновые отправители
+    (не больше concurrency) забирают готовые письма, держат SMTP-соединение открытым
+    между письмами и повторяют неудачные с экспоненциальной задержкой.
+    Забор письма — один условный UPDATE, поэтому несколько процессов (воркеры gunicorn,
+    CLI) делят очередь без двойной отправки. Письмо, зависшее в sending после падения
+    процесса, снова забирается по истечении MAIL_CLAIM_LEASE (возможен повтор, но не потеря).
+    База открывается при первом обращении, а не при создании объекта.
+
+    Локальная проверка: python -m aiosmtpd -n -l localhost:8025 и MAIL_PORT=8025.
+    """
+
+    def __init__(self, path=MAIL_OUTBOX_PATH, concurrency=MAIL_CONCURRENCY, max_attempts=MAIL_MAX_ATTEMPTS):
+        self.path = path
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max_attempts
+        self.lease = MAIL_CLAIM_LEASE
+        self._init_lock = threading.Lock()
+        self._ready = False
+        self._wakeup = threading.Condition()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = False
+        self._local = threading.local()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.connections_opened = 0
+        self.send_seconds_total = 0.0
+
+    def _init_schema(self):
+        with self._init_lock:
+            if self._ready:
+                return
+            with self._connect() as db:
+                db.executescript(SCHEMA)
+                columns = {row[1] for row in db.execute("PRAGMA table_info(outbox)")}
+                if "claimed_at" not in columns:
+                    db.execute("ALTER TABLE outbox ADD COLUMN claimed_at REAL")
+            self._ready = True
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self._init_schema()
+            db = self._local.db = self._connect()
+        return db
+
+    # ------------------------
+    # Постановка в очередь
+    # ------------------------
+    def enqueue(self, subject, recipients, body):
+        now = time.time()
+        db = self._db()
+        with db:
+            cur = db.execute(
+                "INSERT INTO outbox (recipients, subject, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (json.dumps(list(recipients)), subject, body, now, now))
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return cur.lastrowid
+
+    # ------------------------
+    # Отправители
+    # ------------------------
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            self._threads = [threading.Thread(target=self._run, daemon=True, name=f"mail-sender-{i}")
+                             for i in range(self.concurrency)]
+            for t in self._threads:
+                t.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for t in threads:
+            t.join(timeout)
+
+    def _claim(self):
+        """Следующее готовое письмо, помеченное как sending, или (None, секунд до ближайшего)"""
+        db = self._db()
+        while True:
+            now = time.time()
+            expired = now - self.lease
+            row = db.execute("""
+                SELECT id, recipients, subject, body, attempts FROM outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND coalesce(claimed_at, 0) < ?)
+                ORDER BY next_attempt_at LIMIT 1
+            """, (now, expired)).fetchone()
+            if row is None:
+                nxt = db.execute("SELECT min(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+                return None, (nxt - now if nxt is not None else None)
+            # забирает тот, чей UPDATE изменил строку; остальные (потоки и процессы) ищут дальше
+            with db:
+                claimed = db.execute("""
+                    UPDATE outbox SET status = 'sending', claimed_at = ?
+                    WHERE id = ? AND ((status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND coalesce(claimed_at, 0) < ?))
+                """, (now, row[0], now, expired)).rowcount
+            if claimed:
+                return row, 0
+
+    def _run(self):
+        smtp = None
+        last_used = 0.0
+        try:
+            while not self._stopping:
+                row, wait = self._claim()
+                if row is None:
+                    if smtp is not None and time.monotonic() - last_used > MAIL_IDLE_CLOSE:
+                        smtp = self._close(smtp)
+                    with self._wakeup:
+                        self._wakeup.wait(min(wait, MAIL_IDLE_CLOSE) if wait is not None else MAIL_IDLE_CLOSE)
+                    continue
+                smtp = self._deliver(smtp, row)
+                last_used = time.monotonic()
+        finally:
+            self._close(smtp)
+
+    def _deliver(self, smtp, row):
+        message_id, recipients, subject, body, attempts = row
+        msg = EmailMessage()
+        msg["From"] = MAIL_DEFAULT_SENDER
+        msg["To"] = ", ".join(json.loads(recipients))
+        msg["Subject"] = subject
+        msg.set_content(body)
+        started = time.monotonic()
+        try:
+            if smtp is None:
+                smtp = self._open()
+            smtp.send_message(msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            # адрес отвергнут сервером — повтор не поможет
+            self._finish(message_id, attempts + 1, error=str(e), permanent=True)
+            return smtp
+        except Exception as e:
+            self._finish(message_id, attempts + 1, error=str(e))
+            return self._close(smtp)
+        self._finish(message_id, attempts + 1, seconds=time.monotonic() - started)
+        return smtp
+
+    def _finish(self, message_id, attempts, error=None, permanent=False, seconds=0.0):
+        db = self._db()
+        now = time.time()
+        with db:
+            if error is None:
+                db.execute("UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                           (attempts, now, message_id))
+            elif permanent or attempts >= self.max_attempts:
+                db.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                           (attempts, error, message_id))
+            else:
+                db.execute("UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                           (attempts, now + backoff(attempts), error, message_id))
+        with self._lock:
+            if error is None:
+                self.sent += 1
+                self.send_seconds_total += seconds
+            elif permanent or attempts >= self.max_attempts:
+                self.failed += 1
+                print(f"Mail {message_id} failed permanently: {error}")
+            else:
+                self.retried += 1
+
+    def _open(self):
+        smtp = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=MAIL_SMTP_TIMEOUT)
+        if MAIL_USE_TLS:
+            smtp.starttls()
+        if MAIL_USERNAME:
+            smtp.login(MAIL_USERNAME, MAIL_PASSWORD)
+        with self._lock:
+            self.connections_opened += 1
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+        return None
+
+    def stats(self):
+        db = self._db()
+        counts = dict(db.execute("SELECT status, count(*) FROM outbox GROUP BY status").fetchall())
+        oldest = db.execute("SELECT min(created_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        due = db.execute("SELECT count(*) FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?",
+                         (time.time(),)).fetchone()[0]
+        return {
+            "pending": counts.get("pending", 0), "due": due, "sending": counts.get("sending", 0),
+            "sent_total": counts.get("sent", 0), "failed_total": counts.get("failed", 0),
+            "oldest_pending_seconds": round(time.time() - oldest, 1) if oldest else None,
+            "sent": self.sent, "retried": self.retried, "failed": self.failed,
+            "connections_opened": self.connections_opened, "concurrency": self.concurrency,
+            "send_latency_avg": round(self.send_seconds_total / self.sent, 4) if self.sent else 0.0,
+        }
+
+
+outbox = MailOutbox()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Отправка писем из локальной очереди")
+    parser.add_argument("--stats", action="store_true", help="показать состояние очереди и выйти")
+    parser.add_argument("--retry-failed", action="store_true", help="вернуть failed-письма в очередь")
+    args = parser.parse_args()
+
+    if args.retry_failed:
+        with outbox._db() as db:
+            db.execute("UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'failed'",
+                       (time.time(),))
+    if not args.stats:
+        outbox.start()
+        # отправляем то, что готово сейчас; отложенные повторы остаются в очереди
+        while True:
+            s = outbox.stats()
+            if not s["due"] and not s["sending"]:
+                break
+            time.sleep(1)
+        outbox.stop()
+    print(json.dumps(outbox.stats(), indent=2))
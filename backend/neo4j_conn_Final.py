@@ -1,7 +1,11 @@
 # neo4j_conn_Final.py
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS
 import os
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
+from cache import recommendation_cache
 
 # ------------------------
 # LOAD ENV
@@ -11,7 +15,22 @@ NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
 NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
 
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+NEO4J_MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", 100))
+NEO4J_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", 60))
+NEO4J_CONNECTION_TIMEOUT = float(os.getenv("NEO4J_CONNECTION_TIMEOUT", 30))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", 3600))
+NEO4J_MAX_RETRY_TIME = float(os.getenv("NEO4J_MAX_RETRY_TIME", 30))  # сколько execute_read/write повторяет transient-ошибки
+NEO4J_FETCH_SIZE = int(os.getenv("NEO4J_FETCH_SIZE", 1000))
+
+driver = GraphDatabase.driver(
+    NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD),
+    max_connection_pool_size=NEO4J_MAX_POOL_SIZE,
+    connection_acquisition_timeout=NEO4J_ACQUISITION_TIMEOUT,
+    connection_timeout=NEO4J_CONNECTION_TIMEOUT,
+    max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+    max_transaction_retry_time=NEO4J_MAX_RETRY_TIME,
+    fetch_size=NEO4J_FETCH_SIZE,
+)
 
 def get_driver():
     return driver
@@ -19,6 +38,99 @@ def get_driver():
 def close_driver():
     driver.close()
 
+def read_session():
+    """Сессия для потокового чтения вне управляемой транзакции (генераторы): уходит на read-реплику"""
+    return driver.session(default_access_mode=READ_ACCESS)
+
+# ------------------------
+# POOL METRICS
+# ------------------------
+# драйвер не публикует метрики пула, поэтому время ожидания соединения
+# меряется обёрткой над acquire внутреннего пула (если его устройство знакомо)
+_pool_stats = {"acquired": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0, "timeouts": 0}
+_pool_lock = threading.Lock()
+
+def _instrument_pool():
+    pool = getattr(driver, "_pool", None)
+    acquire = getattr(pool, "acquire", None)
+    if acquire is None:
+        return False
+
+    def timed_acquire(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return acquire(*args, **kwargs)
+        except Exception:
+            with _pool_lock:
+                _pool_stats["timeouts"] += 1
+            raise
+        finally:
+            waited = time.monotonic() - started
+            with _pool_lock:
+                _pool_stats["acquired"] += 1
+                _pool_stats["wait_seconds_total"] += waited
+                _pool_stats["wait_seconds_max"] = max(_pool_stats["wait_seconds_max"], waited)
+
+    pool.acquire = timed_acquire
+    return True
+
+_pool_instrumented = _instrument_pool()
+
+def pool_metrics():
+    """in_use / idle по адресам серверов и статистика ожидания соединения"""
+    servers = {}
+    pool = getattr(driver, "_pool", None)
+    for address, connections in dict(getattr(pool, "connections", {}) or {}).items():
+        connections = list(connections)
+        in_use = sum(1 for c in connections if getattr(c, "in_use", False))
+        servers[str(address)] = {"in_use": in_use, "idle": len(connections) - in_use}
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    return {
+        "max_pool_size": NEO4J_MAX_POOL_SIZE,
+        "acquisition_timeout": NEO4J_ACQUISITION_TIMEOUT,
+        "instrumented": _pool_instrumented,
+        "servers": servers,
+        "in_use": sum(v["in_use"] for v in servers.values()),
+        "idle": sum(v["idle"] for v in servers.values()),
+        "acquired": stats["acquired"],
+        "acquire_failures": stats["timeouts"],
+        "acquire_wait_avg": round(stats["wait_seconds_total"] / stats["acquired"], 6) if stats["acquired"] else 0.0,
+        "acquire_wait_max": round(stats["wait_seconds_max"], 6),
+    }
+
+# ------------------------
+# DIRTY PREFERENCES (для инкрементального пересчёта PREFERS)
+# ------------------------
+# в веб-процессе множество никто не забирает, поэтому оно ограничено: при переполнении
+# новые пары не копятся, а следующий инкрементальный пересчёт становится полным
+PREFERENCE_DIRTY_MAX = int(os.getenv("PREFERENCE_DIRTY_MAX", 100000))
+_dirty_preferences = set()
+_dirty_overflow = False
+_dirty_lock = threading.Lock()
+
+def mark_preference_dirty(user_id, product_id):
+    """Запоминает пару (user, product), у которой изменились лайки/покупки"""
+    global _dirty_overflow
+    with _dirty_lock:
+        if len(_dirty_preferences) < PREFERENCE_DIRTY_MAX:
+            _dirty_preferences.add((user_id, product_id))
+        else:
+            _dirty_overflow = True
+
+def restore_dirty_preferences(pairs):
+    """Возвращает пары, пересчёт которых не удался, чтобы следующий запуск их подхватил"""
+    for user_id, product_id in pairs:
+        mark_preference_dirty(user_id, product_id)
+
+def pop_dirty_preferences():
+    """Забирает и очищает накопленные пары; (pairs, overflow) — overflow: часть пар не поместилась"""
+    global _dirty_preferences, _dirty_overflow
+    with _dirty_lock:
+        pairs, overflow = _dirty_preferences, _dirty_overflow
+        _dirty_preferences, _dirty_overflow = set(), False
+    return pairs, overflow
+
 # ------------------------
 # CART OPERATIONS
 # ------------------------
@@ -26,114 +138,341 @@ class Cart:
     @staticmethod
     def add_to_cart(user_id, product_id, quantity):
         with driver.session() as s:
-            s.run("""
+            s.execute_write(lambda tx: tx.run("""
                 MERGE (u:User {id:$user_id})
                 MERGE (p:Product {id:$product_id})
                 MERGE (u)-[r:HAS_IN_CART]->(p)
                 ON CREATE SET r.quantity=$quantity
                 ON MATCH SET r.quantity = r.quantity + $quantity
-            """, user_id=user_id, product_id=product_id, quantity=quantity)
+            """, user_id=user_id, product_id=product_id, quantity=quantity).consume())
 
     @staticmethod
     def remove_from_cart(user_id, product_id):
         with driver.session() as s:
-            s.run("""
+            s.execute_write(lambda tx: tx.run("""
                 MATCH (u:User {id:$user_id})-[r:HAS_IN_CART]->(p:Product {id:$product_id})
                 DELETE r
-            """, user_id=user_id, product_id=product_id)
+            """, user_id=user_id, product_id=product_id).consume())
 
     @staticmethod
     def get_cart(user_id):
         with driver.session() as s:
-            res = s.run("""
+            return s.execute_read(lambda tx: tx.run("""
                 MATCH (u:User {id:$user_id})-[r:HAS_IN_CART]->(p:Product)
                 RETURN p.id AS id, p.name AS name, p.price AS price, r.quantity AS quantity
-            """, user_id=user_id)
-            return [r.data() for r in res]
+            """, user_id=user_id).data())
+
+    CHECKOUT_LINE_BATCH = 500
 
     @staticmethod
-    def checkout(user_id):
+    def checkout(user_id, idempotency_key=None):
+        """
+        Оформляет заказ из корзины одной управляемой транзакцией (драйвер сам
+        повторяет её при transient-ошибках). Повтор с тем же idempotency_key
+        возвращает уже созданный заказ. None — корзина пуста.
+        """
+        key = idempotency_key or str(uuid.uuid4())
         with driver.session() as s:
-            s.run("""
-                MATCH (u:User {id:$user_id})-[r:HAS_IN_CART]->(p:Product)
-                WITH u, collect({id:p.id, name:p.name, quantity:r.quantity, price:p.price}) AS items
-                CREATE (o:Order {id: randomUUID(), date: datetime(), total: reduce(t=0, i IN items | t + i.price * i.quantity)})
-                CREATE (u)-[:PLACED_ORDER]->(o)
-                FOREACH (item IN items |
-                    MERGE (prod:Product {id:item.id})
-                    CREATE (o)-[:CONTAINS]->(prod)
-                )
-                WITH u
-                MATCH (u)-[r:HAS_IN_CART]->()
-                DELETE r
-            """, user_id=user_id)
-        return {"status":"success", "message":"Order placed successfully"}
+            return s.execute_write(Cart._checkout_tx, user_id, key)
+
+    @staticmethod
+    def _checkout_tx(tx, user_id, key):
+        # блокировка узла пользователя сериализует параллельные checkout одного пользователя,
+        # поэтому проверка ключа ниже видит заказ, созданный конкурирующей транзакцией
+        locked = tx.run("""
+            MATCH (u:User {id:$user_id})
+            SET u.last_checkout_at = datetime()
+            RETURN u.id AS id
+        """, user_id=user_id).single()
+        if locked is None:
+            return None
+        existing = tx.run("""
+            MATCH (:User {id:$user_id})-[:PLACED_ORDER]->(o:Order {idempotency_key:$key})
+            RETURN o.id AS order_id, o.total AS total, o.item_count AS items
+        """, user_id=user_id, key=key).single()
+        if existing is not None:
+            return dict(existing.data(), created=False)
+
+        lines = tx.run("""
+            MATCH (:User {id:$user_id})-[r:HAS_IN_CART]->(p:Product)
+            RETURN p.id AS id, r.quantity AS quantity, coalesce(p.price, 0.0) AS unit_price
+        """, user_id=user_id).data()
+        if not lines:
+            return None
+        total = round(sum(line["quantity"] * line["unit_price"] for line in lines), 2)
+        order_id = str(uuid.uuid4())
+        tx.run("""
+            MATCH (u:User {id:$user_id})
+            CREATE (u)-[:PLACED_ORDER]->(:Order {id:$order_id, user_id:$user_id, idempotency_key:$key, date:datetime(),
+                                                 total:$total, item_count:$items})
+        """, user_id=user_id, order_id=order_id, key=key, total=total, items=len(lines))
+        # строки заказа пачками: MATCH по id вместо MERGE не берёт лишних блокировок на товары
+        for i in range(0, len(lines), Cart.CHECKOUT_LINE_BATCH):
+            tx.run("""
+                MATCH (o:Order {id:$order_id})
+                UNWIND $lines AS line
+                MATCH (p:Product {id:line.id})
+                CREATE (o)-[:CONTAINS {quantity:line.quantity, unit_price:line.unit_price}]->(p)
+            """, order_id=order_id, lines=lines[i:i + Cart.CHECKOUT_LINE_BATCH])
+        tx.run("""
+            MATCH (:User {id:$user_id})-[r:HAS_IN_CART]->()
+            DELETE r
+        """, user_id=user_id)
+        return {"order_id": order_id, "total": total, "items": len(lines), "created": True}
 
 # ------------------------
 # USER HISTORY & ACTIONS
 # ------------------------
+HISTORY_VIEW_MODE = os.getenv("HISTORY_VIEW_MODE", "raw")  # raw (ребро на каждый просмотр) | compact
+HISTORY_VIEW_TAIL = int(os.getenv("HISTORY_VIEW_TAIL", 20))     # сколько последних просмотров хранить в v.recent, 0 — не хранить
+# имя действия в API -> тип связи; только эти связи считаются историей
+HISTORY_ACTIONS = {"view": "VIEWED", "like": "LIKED", "wishlist": "WISHLISTED", "purchase": "PURCHASED", "return": "RETURNED"}
+
+def _recent_tail(var, expr):
+    """SET-фрагмент для ограниченного хвоста времён просмотров (пусто, если хвост выключен)"""
+    if HISTORY_VIEW_TAIL <= 0:
+        return ""
+    return f", {var}.recent = [t IN {expr} WHERE t IS NOT NULL][-{HISTORY_VIEW_TAIL}..]"
+
+# сжатый просмотр: одно ребро VIEWED на пару (user, product) со счётчиком;
+# time = last_seen, поэтому история и сортировки по r.time работают как раньше.
+# Параллельные рёбра, оставшиеся от raw-режима, сворачиваются в то же ребро при первом
+# же просмотре пары, поэтому включать compact можно и до ViewCompactionJob —
+# счётчики не задваиваются (джоб лишь сворачивает сразу всё, а не по мере просмотров)
+_COMPACT_VIEW_QUERY = """
+    UNWIND $events AS e
+    WITH e.user_id AS user_id, e.product_id AS product_id, coalesce(datetime(e.time), datetime()) AS t
+    ORDER BY t
+    WITH user_id, product_id, collect(t) AS times
+    MERGE (u:User {id:user_id})
+    MERGE (p:Product {id:product_id})
+    WITH u, p, times
+    OPTIONAL MATCH (u)-[old:VIEWED]->(p)
+    WITH u, p, times, old ORDER BY coalesce(old.last_seen, old.time)
+    WITH u, p, times, collect(old) AS edges
+    WITH u, p, edges,
+         reduce(n = size(times), e IN edges | n + coalesce(e.count, 1)) AS count,
+         reduce(m = times[0], e IN edges |
+                CASE WHEN coalesce(e.first_seen, e.time) < m THEN coalesce(e.first_seen, e.time) ELSE m END) AS first_seen,
+         reduce(m = times[-1], e IN edges |
+                CASE WHEN coalesce(e.last_seen, e.time) > m THEN coalesce(e.last_seen, e.time) ELSE m END) AS last_seen,
+         reduce(acc = [], e IN edges | acc + coalesce(e.recent, [e.time])) + times AS recent
+    FOREACH (e IN edges[1..] | DELETE e)
+    WITH u, p, count, first_seen, last_seen, recent
+    MERGE (u)-[v:VIEWED]->(p)
+    SET v.count = count, v.first_seen = first_seen, v.last_seen = last_seen, v.time = last_seen%s
+""" % _recent_tail("v", "recent")
+
+_RAW_VIEW_QUERY = """
+    UNWIND $events AS e
+    MERGE (u:User {id:e.user_id})
+    MERGE (p:Product {id:e.product_id})
+    CREATE (u)-[:VIEWED {time:coalesce(datetime(e.time), datetime())}]->(p)
+"""
+
 class History:
     @staticmethod
     def log_view(user_id, product_id):
         with driver.session() as s:
-            s.run("""
-                MERGE (u:User {id:$user_id})
-                MERGE (p:Product {id:$product_id})
-                CREATE (u)-[:VIEWED {time:datetime()}]->(p)
-            """, user_id=user_id, product_id=product_id)
+            s.execute_write(lambda tx: tx.run(
+                History.BATCH_QUERIES["view"], events=[{"user_id": user_id, "product_id": product_id, "time": None}]
+            ).consume())
+        recommendation_cache.invalidate_user(user_id)
 
     @staticmethod
     def log_like(user_id, product_id):
         with driver.session() as s:
-            s.run("""
+            s.execute_write(lambda tx: tx.run("""
                 MERGE (u:User {id:$user_id})
                 MERGE (p:Product {id:$product_id})
-                MERGE (u)-[:LIKED]->(p)
-            """, user_id=user_id, product_id=product_id)
+                MERGE (u)-[r:LIKED]->(p)
+                ON CREATE SET r.time = datetime(), r.recorded_at = datetime()
+            """, user_id=user_id, product_id=product_id).consume())
+        recommendation_cache.invalidate_user(user_id)
+        mark_preference_dirty(user_id, product_id)
 
     @staticmethod
     def add_to_wishlist(user_id, product_id):
         with driver.session() as s:
-            s.run("""
+            s.execute_write(lambda tx: tx.run("""
                 MERGE (u:User {id:$user_id})
                 MERGE (p:Product {id:$product_id})
                 MERGE (u)-[:WISHLISTED]->(p)
-            """, user_id=user_id, product_id=product_id)
+            """, user_id=user_id, product_id=product_id).consume())
+        recommendation_cache.invalidate_user(user_id)
 
     @staticmethod
     def remove_from_wishlist(user_id, product_id):
         with driver.session() as s:
-            s.run("""
+            s.execute_write(lambda tx: tx.run("""
                 MATCH (u:User {id:$user_id})-[r:WISHLISTED]->(p:Product {id:$product_id})
                 DELETE r
-            """, user_id=user_id, product_id=product_id)
+            """, user_id=user_id, product_id=product_id).consume())
+        recommendation_cache.invalidate_user(user_id)
 
     @staticmethod
     def log_purchase(user_id, product_id):
         with driver.session() as s:
-            s.run("""
+            s.execute_write(lambda tx: tx.run("""
                 MERGE (u:User {id:$user_id})
                 MERGE (p:Product {id:$product_id})
-                CREATE (u)-[:PURCHASED {time:datetime()}]->(p)
-            """, user_id=user_id, product_id=product_id)
+                CREATE (u)-[:PURCHASED {time:datetime(), recorded_at:datetime()}]->(p)
+            """, user_id=user_id, product_id=product_id).consume())
+        recommendation_cache.invalidate_user(user_id)
+        mark_preference_dirty(user_id, product_id)
+        User.refresh_segments([user_id])
 
     @staticmethod
     def log_return(user_id, product_id):
+        # тот же запрос, что и в пачке: один RETURNED, сколько бы PURCHASED ни было у пары
+        with driver.session() as s:
+            s.execute_write(lambda tx: tx.run(
+                History.BATCH_QUERIES["return"], events=[{"user_id": user_id, "product_id": product_id, "time": None}]
+            ).consume())
+        recommendation_cache.invalidate_user(user_id)
+        User.refresh_segments([user_id])
+
+    # запросы для пакетной записи однотипных событий (ingest.EventIngestor, /history/bulk);
+    # recorded_at — время записи (time может быть историческим), по нему инкрементальный
+    # пересчёт PREFERS находит новые лайки / покупки из любого процесса
+    BATCH_QUERIES = {
+        "view": _RAW_VIEW_QUERY if HISTORY_VIEW_MODE == "raw" else _COMPACT_VIEW_QUERY,
+        "like": """
+            UNWIND $events AS e
+            MERGE (u:User {id:e.user_id})
+            MERGE (p:Product {id:e.product_id})
+            MERGE (u)-[r:LIKED]->(p)
+            ON CREATE SET r.time = coalesce(datetime(e.time), datetime()), r.recorded_at = datetime()
+        """,
+        "wishlist_add": """
+            UNWIND $events AS e
+            MERGE (u:User {id:e.user_id})
+            MERGE (p:Product {id:e.product_id})
+            MERGE (u)-[:WISHLISTED]->(p)
+        """,
+        "wishlist_remove": """
+            UNWIND $events AS e
+            MATCH (u:User {id:e.user_id})-[r:WISHLISTED]->(p:Product {id:e.product_id})
+            DELETE r
+        """,
+        "purchase": """
+            UNWIND $events AS e
+            MERGE (u:User {id:e.user_id})
+            MERGE (p:Product {id:e.product_id})
+            CREATE (u)-[:PURCHASED {time:coalesce(datetime(e.time), datetime()), recorded_at:datetime()}]->(p)
+        """,
+        "return": """
+            UNWIND $events AS e
+            MATCH (u:User {id:e.user_id})-[:PURCHASED]->(p:Product {id:e.product_id})
+            WITH DISTINCT u, p, e
+            CREATE (u)-[:RETURNED {time:coalesce(datetime(e.time), datetime())}]->(p)
+        """,
+    }
+
+    @staticmethod
+    def log_batch(action, events):
+        """
+        Пишет пачку событий одного типа одной транзакцией UNWIND.
+        events: [{"user_id", "product_id", "time" (ISO-строка или None)}]
+        """
+        History.log_groups([(action, events)])
+
+    @staticmethod
+    def log_groups(groups):
+        """
+        Пишет группы [(action, events)] одной транзакцией вместе с пересчётом сегментов:
+        пачка записывается целиком или никак, поэтому повтор после ошибки не дублирует события.
+        """
+        groups = [(action, events) for action, events in groups if events]
+        if not groups:
+            return
+        segment_users = {e["user_id"] for action, events in groups if action in ("purchase", "return") for e in events}
+
+        def work(tx):
+            for action, events in groups:
+                tx.run(History.BATCH_QUERIES[action], events=events).consume()
+            if segment_users:
+                User.refresh_segments(segment_users, tx)
         with driver.session() as s:
-            s.run("""
-                MATCH (u:User {id:$user_id})-[r:PURCHASED]->(p:Product {id:$product_id})
-                CREATE (u)-[:RETURNED {time:datetime()}]->(p)
-            """, user_id=user_id, product_id=product_id)
+            s.execute_write(work)
+        for action, events in groups:
+            if action in ("like", "purchase"):
+                for e in events:
+                    mark_preference_dirty(e["user_id"], e["product_id"])
+        for user_id in {e["user_id"] for _, events in groups for e in events}:
+            recommendation_cache.invalidate_user(user_id)
+
+    # сворачивает параллельные VIEWED пары (user, product) в одно сжатое ребро —
+    # разово после перехода с raw на compact, чтобы не ждать, пока пару снова просмотрят
+    COMPACT_VIEWS_QUERY = """
+        UNWIND $user_ids AS user_id
+        MATCH (u:User {id:user_id})-[v:VIEWED]->(p:Product)
+        WITH u, p, v ORDER BY coalesce(v.last_seen, v.time)
+        WITH u, p, collect(v) AS edges
+        WHERE size(edges) > 1 OR edges[0].count IS NULL
+        WITH edges, head(edges) AS keep,
+             reduce(n = 0, e IN edges | n + coalesce(e.count, 1)) AS count,
+             reduce(m = null, e IN edges |
+                    CASE WHEN m IS NULL OR coalesce(e.first_seen, e.time) < m THEN coalesce(e.first_seen, e.time) ELSE m END
+             ) AS first_seen,
+             coalesce(last(edges).last_seen, last(edges).time) AS last_seen,
+             reduce(acc = [], e IN edges | acc + coalesce(e.recent, [e.time])) AS recent
+        SET keep.count = count, keep.first_seen = first_seen, keep.last_seen = last_seen, keep.time = last_seen%s
+        FOREACH (e IN tail(edges) | DELETE e)
+        RETURN count(*) AS pairs
+    """ % _recent_tail("keep", "recent")
 
     @staticmethod
-    def get_user_history(user_id):
+    def compact_views(user_ids, tx=None):
+        """{"pairs": сколько пар свёрнуто, "edges_removed": сколько лишних рёбер удалено}"""
+        def work(tx):
+            result = tx.run(History.COMPACT_VIEWS_QUERY, user_ids=list(user_ids))
+            pairs = result.single()["pairs"]
+            return {"pairs": pairs, "edges_removed": result.consume().counters.relationships_deleted}
+        if tx is not None:
+            return work(tx)
         with driver.session() as s:
-            res = s.run("""
-                MATCH (u:User {id:$user_id})-[r]->(p:Product)
-                RETURN type(r) AS action, p.id AS product_id, r.time AS time
-                ORDER BY r.time DESC
-            """, user_id=user_id)
-            return [r.data() for r in res]
+            return s.execute_write(work)
+
+    @staticmethod
+    def history_types(actions=None):
+        """Типы связей для фильтра истории: "view"/"like"/... или сами типы; ValueError на неизвестное"""
+        if not actions:
+            return list(HISTORY_ACTIONS.values())
+        types = []
+        for action in actions:
+            rel_type = HISTORY_ACTIONS.get(action, str(action).upper())
+            if rel_type not in HISTORY_ACTIONS.values():
+                raise ValueError(f"unknown action: {action}")
+            if rel_type not in types:
+                types.append(rel_type)
+        return types
+
+    @staticmethod
+    def iter_user_history(user_id, limit=None, before=None, since=None, actions=None):
+        """
+        Генератор истории из курсора Neo4j (новые сначала).
+        before / since — ISO-время: страница строго раньше before и не раньше since;
+        actions — фильтр по действиям. Сжатый просмотр — одна строка с count / first_seen,
+        его time — последний просмотр.
+        """
+        # тип связи в шаблоне, а не WHERE type(r): Neo4j раскрывает только нужные рёбра
+        query = """
+            MATCH (u:User {id:$user_id})-[r:%s]->(p:Product)
+            WHERE ($before IS NULL OR r.time < datetime($before)) AND ($since IS NULL OR r.time >= datetime($since))
+            RETURN type(r) AS action, p.id AS product_id, r.time AS time,
+                   coalesce(r.count, 1) AS count, coalesce(r.first_seen, r.time) AS first_seen, r.recent AS recent
+            ORDER BY r.time DESC
+        """ % "|".join(History.history_types(actions))
+        if limit is not None:
+            query += " LIMIT $limit"
+        with read_session() as s:
+            for r in s.run(query, user_id=user_id, limit=limit, before=before, since=since):
+                yield r.data()
+
+    @staticmethod
+    def get_user_history(user_id, limit=None, before=None, since=None, actions=None):
+        return list(History.iter_user_history(user_id, limit, before, since, actions))
 
 # ------------------------
 # RECOMMENDATIONS
@@ -142,9 +481,9 @@ class Recommendation:
     @staticmethod
     def recommend_products(user_id, limit=5):
         with driver.session() as s:
-            result = s.run("""
+            return s.execute_read(lambda tx: tx.run("""
                 MATCH (u:User {id:$user_id})-[:VIEWED|LIKED]->(p:Product)
-                WITH collect(p) AS user_products
+                WITH u, collect(DISTINCT p) AS user_products
                 MATCH (other:User)-[:LIKED]->(p2:Product)
                 WHERE other.id <> $user_id AND p2 IN user_products
                 MATCH (other)-[:LIKED]->(rec:Product)
@@ -152,85 +491,283 @@ class Recommendation:
                 RETURN rec.id AS product_id, rec.name AS name, rec.category AS category, rec.price AS price, count(*) AS score
                 ORDER BY score DESC
                 LIMIT $limit
-            """, user_id=user_id, limit=limit)
-            return [r.data() for r in result]
+            """, user_id=user_id, limit=limit).data())
 
     @staticmethod
     def recommend_products_advanced(user_id, limit=5):
         with driver.session() as s:
-            result = s.run("""
+            return s.execute_read(lambda tx: tx.run("""
                 MATCH (u:User {id:$user_id})
-                OPTIONAL MATCH (u)-[l:LIKED]->(p1:Product)
-                OPTIONAL MATCH (u)-[w:WISHLISTED]->(p2:Product)
-                OPTIONAL MATCH (u)-[v:VIEWED]->(p3:Product)
-                WITH u, collect(p1) AS liked, collect(p2) AS wish, collect(p3) AS viewed
-                UNWIND liked + wish + viewed AS user_products
-                MATCH (other:User)-[o_l:LIKED|:WISHLISTED]->(user_products)
+                // товары пользователя — множество: сколько раз он их смотрел, на счёт не влияет,
+                // поэтому raw- и compact-просмотры дают одинаковый результат
+                OPTIONAL MATCH (u)-[:LIKED|WISHLISTED|VIEWED]->(own:Product)
+                WITH u, collect(DISTINCT own) AS user_products
+                UNWIND user_products AS up
+                MATCH (other:User)-[:LIKED|WISHLISTED]->(up)
                 WHERE other.id <> $user_id
-                MATCH (other)-[r:LIKED|:WISHLISTED|:VIEWED]->(rec:Product)
+                MATCH (other)-[r:LIKED|WISHLISTED|VIEWED]->(rec:Product)
                 WHERE NOT ( (u)-[:PURCHASED]->(rec) OR (u)-[:RETURNED]->(rec) OR rec IN user_products )
                 WITH rec,
                      sum(
                          CASE WHEN type(r)="LIKED" THEN 3
                               WHEN type(r)="WISHLISTED" THEN 2
-                              WHEN type(r)="VIEWED" THEN 1
+                              WHEN type(r)="VIEWED" THEN coalesce(r.count, 1)
                          END
                      ) AS score
                 RETURN rec.id AS product_id, rec.name AS name, rec.category AS category, rec.price AS price, score
                 ORDER BY score DESC
                 LIMIT $limit
-            """, user_id=user_id, limit=limit)
-            return [r.data() for r in result]
+            """, user_id=user_id, limit=limit).data())
 
     @staticmethod
     def item_based_recommendations(product_id, limit=5):
         with driver.session() as s:
-            result = s.run("""
+            # предрасчитанные соседи (cf_engine.ItemSimilarity), добор по категории для холодных товаров
+            return s.execute_read(lambda tx: tx.run("""
                 MATCH (p:Product {id:$product_id})
-                MATCH (p)-[:IN_CATEGORY]->(c:Category)<-[:IN_CATEGORY]-(rec:Product)
-                WHERE rec.id <> $product_id
-                RETURN rec.id AS id, rec.name AS name, rec.price AS price, rec.category AS category
-                LIMIT $limit
-            """, product_id=product_id, limit=limit)
-            return [r.data() for r in result]
+                OPTIONAL MATCH (p)-[sim:SIMILAR_TO]->(rec:Product)
+                WITH p, rec, sim ORDER BY sim.score DESC LIMIT $limit
+                WITH p, [x IN collect({rec:rec, score:sim.score}) WHERE x.rec IS NOT NULL] AS similar
+                OPTIONAL MATCH (p)-[:IN_CATEGORY]->(:Category)<-[:IN_CATEGORY]-(other:Product)
+                WHERE other.id <> $product_id AND size(similar) < $limit
+                  AND NOT other IN [x IN similar | x.rec]
+                WITH similar, collect(DISTINCT {rec:other, score:0.0})[..($limit - size(similar))] AS fallback
+                UNWIND similar + fallback AS x
+                WITH x WHERE x.rec IS NOT NULL
+                RETURN x.rec.id AS id, x.rec.name AS name, x.rec.price AS price, x.rec.category AS category, x.score AS score
+            """, product_id=product_id, limit=limit).data())
+
+# ------------------------
+# REVIEWS
+# ------------------------
+REVIEW_PRIOR_COUNT = float(os.getenv("REVIEW_PRIOR_COUNT", 10))  # вес априорной оценки в байесовском среднем
+REVIEW_PRIOR_MEAN = float(os.getenv("REVIEW_PRIOR_MEAN", 3.5))
+
+def _rating_bucket(x):
+    """
+    Cypher-выражение корзины гистограммы 1..5 для оценки x. Считается только в Cypher: его
+    round() округляет половину вверх, а Python — к чётному (2.5 -> 2), и add с rebuild расходились.
+    """
+    return f"CASE WHEN round({x}) < 1 THEN 1 WHEN round({x}) > 5 THEN 5 ELSE toInteger(round({x})) END"
+
+class Review:
+    """
+    Агрегаты отзывов хранятся на товаре и обновляются в той же транзакции, что и отзыв:
+    review_count, rating_sum, rating_hist (5 корзин), rating_avg и rating —
+    байесовское среднее (REVIEW_PRIOR_*), по нему сортируется поиск.
+    """
+
+    AGGREGATE_FIELDS = """
+        p.rating_avg = p.rating_sum / p.review_count,
+        p.rating = ($prior_mean * $prior_count + p.rating_sum) / ($prior_count + p.review_count)
+    """
 
     @staticmethod
-    def seasonal_promotions(season=None, limit=5):
+    def add(sku, rating, comment=""):
+        """Возвращает id товара или None, если товара с таким sku нет"""
         with driver.session() as s:
-            result = s.run("""
-                MATCH (p:Product)
-                WHERE $season IS NULL OR p.season = $season OR p.promo = true
-                RETURN p.id AS id, p.name AS name, p.price AS price, p.category AS category
-                LIMIT $limit
-            """, season=season, limit=limit)
-            return [r.data() for r in result]
+            record = s.execute_write(lambda tx: tx.run("""
+                MATCH (p:Product {sku:$sku})
+                // блокировка товара до чтения агрегатов: параллельные отзывы не теряют инкременты
+                SET p._lock = true
+                WITH p
+                CREATE (p)-[:HAS_REVIEW]->(:Review {id:randomUUID(), rating:$rating, comment:$comment, date:datetime()})
+                SET p.review_count = coalesce(p.review_count, 0) + 1,
+                    p.rating_sum = coalesce(p.rating_sum, 0.0) + $rating,
+                    p.rating_hist = [i IN range(1, 5) | coalesce(p.rating_hist[i - 1], 0) +
+                                     CASE WHEN i = """ + _rating_bucket("$rating") + """ THEN 1 ELSE 0 END]
+                SET """ + Review.AGGREGATE_FIELDS + """
+                REMOVE p._lock
+                RETURN p.id AS id
+            """, sku=sku, rating=rating, comment=comment,
+                 prior_mean=REVIEW_PRIOR_MEAN, prior_count=REVIEW_PRIOR_COUNT).single())
+        return record["id"] if record else None
 
     @staticmethod
-    def manual_adjustment():
+    def rebuild_aggregates(sku=None):
+        """Пересчёт агрегатов из отзывов (для данных, созданных до их появления); возвращает число товаров"""
         with driver.session() as s:
-            result = s.run("""
+            return s.execute_write(lambda tx: tx.run("""
                 MATCH (p:Product)
-                WHERE exists(p.weight) AND p.weight > 0
-                RETURN p.id AS id, p.name AS name, p.price AS price, p.category AS category, p.weight AS weight
-                ORDER BY p.weight DESC
-            """)
-            return [r.data() for r in result]
+                WHERE $sku IS NULL OR p.sku = $sku
+                OPTIONAL MATCH (p)-[:HAS_REVIEW]->(r:Review)
+                WITH p, collect(r.rating) AS ratings
+                SET p.review_count = size(ratings),
+                    p.rating_sum = reduce(t = 0.0, x IN ratings | t + x),
+                    p.rating_hist = [i IN range(1, 5) | size([x IN ratings WHERE """ + _rating_bucket("x") + """ = i])]
+                WITH p WHERE p.review_count > 0
+                SET """ + Review.AGGREGATE_FIELDS + """
+                RETURN count(p) AS products
+            """, sku=sku, prior_mean=REVIEW_PRIOR_MEAN, prior_count=REVIEW_PRIOR_COUNT).single()["products"])
+
+    # те же агрегаты, посчитанные по отзывам без записи — для товаров, которым
+    # rebuild_aggregates ещё не сохранил их (POST /admin/reviews/rebuild-aggregates)
+    COMPUTED_AGGREGATES_QUERY = """
+        MATCH (p:Product {sku:$sku})
+        OPTIONAL MATCH (p)-[:HAS_REVIEW]->(r:Review)
+        WITH collect(r.rating) AS ratings
+        WITH ratings, size(ratings) AS n, reduce(t = 0.0, x IN ratings | t + x) AS total
+        RETURN n AS review_count,
+               CASE WHEN n > 0 THEN total / n END AS average_rating,
+               CASE WHEN n > 0 THEN ($prior_mean * $prior_count + total) / ($prior_count + n) END AS bayesian_rating,
+               [i IN range(1, 5) | size([x IN ratings WHERE """ + _rating_bucket("x") + """ = i])] AS rating_histogram
+    """
+
+    @staticmethod
+    def aggregates(sku):
+        """Агрегаты одним чтением свойств товара; None, если товара нет. Ничего не пишет."""
+        with driver.session() as s:
+            record = s.execute_read(lambda tx: tx.run("""
+                MATCH (p:Product {sku:$sku})
+                RETURN p.review_count AS review_count, p.rating_avg AS average_rating,
+                       p.rating AS bayesian_rating, p.rating_hist AS rating_histogram
+            """, sku=sku).single())
+            if record is not None and record["review_count"] is None:
+                record = s.execute_read(lambda tx: tx.run(
+                    Review.COMPUTED_AGGREGATES_QUERY, sku=sku,
+                    prior_mean=REVIEW_PRIOR_MEAN, prior_count=REVIEW_PRIOR_COUNT).single())
+        if record is None:
+            return None
+        return {
+            "average_rating": round(record["average_rating"] or 0, 2),
+            "review_count": record["review_count"],
+            "bayesian_rating": round(record["bayesian_rating"] or 0, 3) if record["review_count"] else None,
+            "rating_histogram": dict(zip(["1", "2", "3", "4", "5"], record["rating_histogram"] or [0] * 5)),
+        }
+
+    @staticmethod
+    def page(sku, limit, before=None):
+        """
+        Страница отзывов, новые сначала. before — (ISO-дата, id) последнего отзыва
+        предыдущей страницы; возвращает (отзывы, ключ последнего или None).
+        """
+        with driver.session() as s:
+            rows = s.execute_read(lambda tx: tx.run("""
+                MATCH (:Product {sku:$sku})-[:HAS_REVIEW]->(r:Review)
+                WITH r, coalesce(r.id, elementId(r)) AS rid
+                WHERE $before_date IS NULL OR [r.date, rid] < [datetime($before_date), $before_id]
+                RETURN rid AS id, r.rating AS rating, r.comment AS comment, r.date AS date
+                ORDER BY r.date DESC, rid DESC
+                LIMIT $limit
+            """, sku=sku, limit=limit + 1,
+                 before_date=before[0] if before else None, before_id=before[1] if before else None).data())
+        last = rows[limit - 1] if len(rows) > limit else None
+        return rows[:limit], ((last["date"].iso_format(), last["id"]) if last else None)
 
 # ------------------------
 # USER SEGMENTATION
 # ------------------------
+SEGMENT_ACTIVE_MIN = int(os.getenv("SEGMENT_ACTIVE_MIN", 3))    # с скольких покупок (за вычетом возвратов) "active"
+SEGMENT_VIP_MIN = int(os.getenv("SEGMENT_VIP_MIN", 11))         # ... и "vip"
+# границы RFM-оценок 1..4 (0 — не покупал): давность в днях, число покупок, сумма
+SEGMENT_RECENCY_DAYS = [int(x) for x in os.getenv("SEGMENT_RECENCY_DAYS", "30,90,180").split(",")]
+SEGMENT_FREQUENCY = [int(x) for x in os.getenv("SEGMENT_FREQUENCY", "1,3,10").split(",")]
+SEGMENT_MONETARY = [float(x) for x in os.getenv("SEGMENT_MONETARY", "100,500,2000").split(",")]
+
 class User:
+    """
+    Сегмент и RFM-измерения хранятся на пользователе (u.segment, u.rfm_*) и
+    пересчитываются по одному пользователю при покупке / возврате и целиком —
+    пакетной задачей segments.py. Чтение сегмента — это чтение свойства.
+    """
+
+    # RFM по истории: общая часть пересчёта (SEGMENT_QUERY) и чтения без записи (SEGMENT_PROFILE_QUERY)
+    SEGMENT_COMPUTE = """
+        UNWIND $user_ids AS uid
+        MATCH (u:User {id:uid})
+        OPTIONAL MATCH (u)-[pu:PURCHASED]->(p:Product)
+        WITH u, count(pu) AS purchases, sum(coalesce(p.price, 0.0)) AS spent, max(pu.time) AS last_purchase
+        OPTIONAL MATCH (u)-[:RETURNED]->(rp:Product)
+        // purchases / spent — ключи группировки: внутри агрегатного выражения их Neo4j 5 не принимает
+        WITH u, last_purchase, purchases, spent, count(rp) AS returns, sum(coalesce(rp.price, 0.0)) AS returned
+        WITH u, last_purchase, purchases - returns AS frequency, spent - returned AS monetary
+        WITH u, last_purchase,
+             CASE WHEN frequency < 0 THEN 0 ELSE frequency END AS frequency,
+             CASE WHEN monetary < 0 THEN 0.0 ELSE monetary END AS monetary,
+             CASE WHEN last_purchase IS NULL THEN NULL
+                  ELSE duration.inDays(last_purchase, datetime()).days END AS recency_days
+        WITH u, frequency, monetary, recency_days,
+             CASE WHEN frequency < $active_min THEN 'newbie'
+                  WHEN frequency < $vip_min THEN 'active'
+                  ELSE 'vip' END AS segment,
+             CASE WHEN recency_days IS NULL THEN 0
+                  ELSE 1 + size([b IN $recency_bounds WHERE recency_days <= b]) END AS r,
+             CASE WHEN frequency = 0 THEN 0 ELSE 1 + size([b IN $frequency_bounds WHERE frequency > b]) END AS f,
+             CASE WHEN monetary = 0 THEN 0 ELSE 1 + size([b IN $monetary_bounds WHERE monetary > b]) END AS m
+    """
+
+    SEGMENT_QUERY = SEGMENT_COMPUTE + """
+        SET u.segment = segment,
+            u.rfm_recency_days = recency_days,
+            u.rfm_frequency = frequency,
+            u.rfm_monetary = monetary,
+            u.rfm_r = r, u.rfm_f = f, u.rfm_m = m,
+            u.segment_updated_at = datetime()
+        RETURN count(u) AS users
+    """
+
+    SEGMENT_PROFILE_QUERY = SEGMENT_COMPUTE + """
+        RETURN segment, recency_days, frequency, monetary, [r, f, m] AS rfm
+    """
+
     @staticmethod
-    def get_user_segment(user_id):
+    def _segment_params(user_ids):
+        return dict(
+            user_ids=list(user_ids), active_min=SEGMENT_ACTIVE_MIN, vip_min=SEGMENT_VIP_MIN,
+            recency_bounds=SEGMENT_RECENCY_DAYS, frequency_bounds=SEGMENT_FREQUENCY, monetary_bounds=SEGMENT_MONETARY,
+        )
+
+    @staticmethod
+    def next_ids(after, limit):
+        """Следующие limit id пользователей после after (keyset по u.id) — для пакетных задач"""
+        with driver.session() as s:
+            return s.execute_read(lambda tx: [r["id"] for r in tx.run("""
+                MATCH (u:User) WHERE u.id IS NOT NULL AND ($after IS NULL OR u.id > $after)
+                RETURN u.id AS id ORDER BY u.id LIMIT $limit
+            """, after=after, limit=limit)])
+
+    @staticmethod
+    def refresh_segments(user_ids, tx=None):
+        """Пересчитывает сегмент указанных пользователей; возвращает, скольким записан"""
+        params = User._segment_params(user_ids)
+        if tx is not None:
+            return tx.run(User.SEGMENT_QUERY, **params).single()["users"]
         with driver.session() as s:
-            res = s.run("""
-                MATCH (u:User {id:$user_id})-[:PURCHASED]->(p:Product)
-                RETURN count(p) AS purchases
-            """, user_id=user_id)
-            count = res.single()["purchases"]
-            if count < 3:
-                return "newbie"
-            elif count <= 10:
-                return "active"
-            else:
-                return "vip"
+            return s.execute_write(lambda tx: tx.run(User.SEGMENT_QUERY, **params).single()["users"])
+
+    @staticmethod
+    def get_user_profile_segment(user_id):
+        """
+        {"segment", "recency_days", "frequency", "monetary", "rfm"} или None, если пользователя нет.
+        Только чтение: если сегмент ещё не сохранён, он считается по истории и не записывается —
+        это делает задача segments.py.
+        """
+        with driver.session() as s:
+            record = s.execute_read(lambda tx: tx.run("""
+                MATCH (u:User {id:$user_id})
+                RETURN u.segment AS segment, u.rfm_recency_days AS recency_days, u.rfm_frequency AS frequency,
+                       u.rfm_monetary AS monetary, [u.rfm_r, u.rfm_f, u.rfm_m] AS rfm
+            """, user_id=user_id).single())
+            if record is not None and record["segment"] is None:
+                record = s.execute_read(lambda tx: tx.run(
+                    User.SEGMENT_PROFILE_QUERY, **User._segment_params([user_id])).single())
+        return record.data() if record is not None else None
+
+    @staticmethod
+    def get_user_segment(user_id):
+        profile = User.get_user_profile_segment(user_id)
+        return profile["segment"] if profile else "newbie"
+
+    @staticmethod
+    def iter_segment_users(segment, limit=None):
+        """Пользователи сегмента по индексу user_segment_index"""
+        query = """
+            MATCH (u:User) WHERE u.segment = $segment
+            RETURN u.id AS user_id, u.rfm_recency_days AS recency_days, u.rfm_frequency AS frequency,
+                   u.rfm_monetary AS monetary
+        """
+        if limit is not None:
+            query += " LIMIT $limit"
+        with read_session() as s:
+            for r in s.run(query, segment=segment, limit=limit):
+                yield r.data()
@@ -0,0 +1,13 @@
+# password_worker.py
+# Функции, которые выполняются в процессах PasswordPool. Модуль намеренно без
+# зависимостей проекта и без кода на уровне импорта: spawn-воркер импортирует
+# его заново, и ничего, кроме bcrypt, подтягиваться не должно.
+import bcrypt
+
+
+def hashpw(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def checkpw(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
@@ -0,0 +1,199 @@
+# promotions.py
+import bisect
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from neo4j_conn_Final import driver
+from search_index import encode_cursor, decode_cursor
+
+load_dotenv()
+
+PROMO_REBUILD_INTERVAL = int(os.getenv("PROMO_REBUILD_INTERVAL", 300))
+PROMO_VERSION_CHECK_INTERVAL = float(os.getenv("PROMO_VERSION_CHECK_INTERVAL", 5))  # как часто сверяться с общей версией
+PROMO_BUMP_DELAY = float(os.getenv("PROMO_BUMP_DELAY", 1))  # invalidate() за это окно дают одно увеличение общей версии
+MANUAL = "manual"
+ALL_SEASONS = "_all"
+PROMO_ONLY = "_promo"
+FIELDS = ("id", "name", "price", "category", "weight")
+
+
+def _key(product):
+    # больший вес выше, внутри веса — по id; так же, как ORDER BY p.weight DESC, p.id
+    return (-(product.get("weight") or 0.0), str(product["id"]))
+
+
+class PromotionLists:
+    """
+    Материализованные глобальные списки: ручное ранжирование по weight и подборки
+    по сезону (season = X или promo = true). Строятся одним запросом, хранятся в памяти
+    отсортированными, отдаются срезом по keyset-курсору. version растёт при каждой
+    перестройке; изменения товаров (create / update / delete / импорт) помечают списки
+    устаревшими, кроме того они перестраиваются раз в PROMO_REBUILD_INTERVAL.
+
+    Списки у каждого процесса свои, поэтому invalidate() ещё и увеличивает общую
+    версию в Neo4j (узел :Meta {id:"promotions"}); остальные воркеры и CLI-импорт
+    сверяются с ней не чаще раза в PROMO_VERSION_CHECK_INTERVAL и перестраиваются,
+    если она ушла вперёд. Запись в :Meta откладывается на PROMO_BUMP_DELAY: все
+    invalidate() за это окно сливаются в одну, а не пишут общий узел на каждый товар.
+    """
+
+    SHARED_KEY = "promotions"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.lists = {}
+        self.keys = {}
+        self.version = 0
+        self.built_at = None
+        self._stale = True
+        self.shared_version = None    # общая версия, с которой построены списки
+        self._shared_seen = None
+        self._shared_checked_at = None
+        self._bump_timer = None       # отложенное увеличение общей версии
+
+    @staticmethod
+    def read_shared_version():
+        with driver.session() as s:
+            record = s.execute_read(lambda tx: tx.run("""
+                MATCH (m:Meta {id:$key}) RETURN m.version AS version
+            """, key=PromotionLists.SHARED_KEY).single())
+        return record["version"] if record is not None else 0
+
+    @staticmethod
+    def bump_shared_version():
+        with driver.session() as s:
+            s.execute_write(lambda tx: tx.run("""
+                MERGE (m:Meta {id:$key})
+                SET m.version = coalesce(m.version, 0) + 1
+            """, key=PromotionLists.SHARED_KEY).consume())
+
+    @staticmethod
+    def fetch():
+        with driver.session() as s:
+            return s.execute_read(lambda tx: tx.run("""
+                MATCH (p:Product)
+                WHERE p.weight > 0 OR p.season IS NOT NULL OR p.promo = true
+                RETURN p.id AS id, p.name AS name, p.price AS price, p.category AS category,
+                       p.weight AS weight, p.season AS season, coalesce(p.promo, false) AS promo
+            """).data())
+
+    def build(self, products=None):
+        # invalidate() во время чтения из Neo4j снова пометит списки устаревшими
+        self._stale = False
+        shared = self._check_shared(force=True)
+        products = self.fetch() if products is None else products
+        promo = [p for p in products if p["promo"]]
+        lists = {MANUAL: [p for p in products if (p.get("weight") or 0) > 0]}
+        lists[ALL_SEASONS] = [p for p in products if p["promo"] or p.get("season") is not None]
+        lists[PROMO_ONLY] = promo
+        for season in {p["season"] for p in products if p.get("season") is not None}:
+            lists[str(season)] = [p for p in products if p.get("season") == season] + \
+                                 [p for p in promo if p.get("season") != season]
+        keys = {}
+        for name in lists:
+            lists[name] = [{k: p.get(k) for k in FIELDS} for p in sorted(lists[name], key=_key)]
+            keys[name] = [_key(p) for p in lists[name]]
+        with self._lock:
+            self.lists = lists
+            self.keys = keys
+            self.version += 1
+            self.built_at = time.monotonic()
+            self.shared_version = shared
+        return self.version
+
+    def invalidate(self):
+        self._stale = True
+        if PROMO_BUMP_DELAY <= 0:
+            self._bump()
+            return
+        with self._lock:
+            if self._bump_timer is None:
+                # таймер не daemon: CLI-импорт при выходе дождётся отложенной записи
+                self._bump_timer = threading.Timer(PROMO_BUMP_DELAY, self._flush_bump)
+                self._bump_timer.start()
+
+    def _flush_bump(self):
+        with self._lock:
+            self._bump_timer = None
+        self._bump()
+
+    def _bump(self):
+        try:
+            self.bump_shared_version()
+        except Exception as e:
+            # остальные процессы увидят изменения не позже PROMO_REBUILD_INTERVAL
+            print(f"Promotion version bump failed: {e}")
+
+    def _check_shared(self, force=False):
+        """Общая версия (не чаще раза в PROMO_VERSION_CHECK_INTERVAL); при недоступности Neo4j — последняя известная"""
+        now = time.monotonic()
+        if force or self._shared_checked_at is None or now - self._shared_checked_at > PROMO_VERSION_CHECK_INTERVAL:
+            self._shared_checked_at = now
+            try:
+                self._shared_seen = self.read_shared_version()
+            except Exception as e:
+                print(f"Promotion version check failed: {e}")
+        return self._shared_seen
+
+    def _needs_build(self):
+        if self._stale or self.built_at is None or time.monotonic() - self.built_at > PROMO_REBUILD_INTERVAL:
+            return True
+        return self._check_shared() != self.shared_version
+
+    def _ensure_built(self):
+        if self._needs_build():
+            # перестраивает один запрос, остальные ждут его и берут готовые списки
+            with self._build_lock:
+                if self._needs_build():
+                    self.build()
+
+    def list_name(self, season):
+        if season is None:
+            return ALL_SEASONS
+        return str(season)
+
+    def page(self, name, limit=None, cursor=None, exclude=None):
+        """
+        {"items", "next_cursor", "version"}; exclude — id товаров, которые не показывать
+        этому пользователю (например, уже купленные). Для сезона без своих товаров — только promo.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError("limit must be >= 0")
+        self._ensure_built()
+        with self._lock:
+            if name not in self.lists:
+                name = PROMO_ONLY
+            items, keys = self.lists.get(name, []), self.keys.get(name, [])
+            version = self.version
+        start = bisect.bisect_right(keys, tuple(decode_cursor(cursor, name))) if cursor else 0
+        out = []
+        last = start - 1  # последняя отданная позиция; при limit=0 курсор остаётся на месте
+        for i in range(start, len(items)):
+            if exclude and items[i]["id"] in exclude:
+                continue
+            if limit is not None and len(out) == limit:
+                next_cursor = encode_cursor(name, keys[last]) if last >= 0 else cursor
+                return {"items": out, "next_cursor": next_cursor, "version": version}
+            out.append(items[i])
+            last = i
+        return {"items": out, "next_cursor": None, "version": version}
+
+    def stats(self):
+        return {
+            "version": self.version, "lists": {name: len(items) for name, items in self.lists.items()},
+            "stale": self._stale,
+            "age_seconds": round(time.monotonic() - self.built_at, 1) if self.built_at else None,
+        }
+
+
+def purchased_ids(user_id):
+    with driver.session() as s:
+        return s.execute_read(lambda tx: {r["id"] for r in tx.run("""
+            MATCH (:User {id:$user_id})-[:PURCHASED]->(p:Product)
+            RETURN DISTINCT p.id AS id
+        """, user_id=user_id)})
+
+
+promotions = PromotionLists()
@@ -0,0 +1,203 @@
+# schema.py
+import json
+import os
+from dotenv import load_dotenv
+from neo4j_conn_Final import driver
+
+load_dotenv()
+
+SCHEMA_BOOTSTRAP = os.getenv("SCHEMA_BOOTSTRAP", "true").lower() == "true"
+SCHEMA_AWAIT_TIMEOUT = int(os.getenv("SCHEMA_AWAIT_TIMEOUT", 300))
+
+# (имя, метка, свойства) — уникальность заодно создаёт range-индекс под MATCH/MERGE по ключу
+CONSTRAINTS = [
+    # имена совпадают с neo4j_setup/base_schema.txt, чтобы IF NOT EXISTS узнавал уже созданные
+    ("user_id_unique", "User", ("user_id",)),
+    ("user_email_unique", "User", ("email",)),
+    ("user_graph_id_unique", "User", ("id",)),  # история, корзина, CF: (:User {id})
+    ("product_id_unique", "Product", ("id",)),
+    ("product_sku_unique", "Product", ("sku",)),
+    ("category_name_unique", "Category", ("name",)),
+    ("role_name_unique", "Role", ("name",)),
+    ("order_id_unique", "Order", ("id",)),
+    # ключ идемпотентности уникален в пределах пользователя: одинаковые ключи двух клиентов не конфликтуют
+    ("order_user_idempotency_key_unique", "Order", ("user_id", "idempotency_key")),
+    ("audit_day_unique", "AuditDay", ("user_id", "day")),
+    ("meta_id_unique", "Meta", ("id",)),  # общие версии (promotions.PromotionLists)
+    ("cf_state_name_unique", "CFState", ("name",)),
+]
+
+# глобальная уникальность ключа заставляла чужой заказ с тем же ключом ронять checkout
+DROPPED_CONSTRAINTS = ["order_idempotency_key_unique"]
+
+INDEXES = [
+    ("product_name_index", "Product", ("name",)),
+    ("product_category_index", "Product", ("category",)),
+    ("product_brand_index", "Product", ("brand",)),
+    ("product_price_index", "Product", ("price",)),
+    ("product_rating_index", "Product", ("rating",)),  # сортировка поиска по байесовскому рейтингу
+    ("user_segment_index", "User", ("segment",)),
+    ("product_weight_index", "Product", ("weight",)),
+    ("product_season_index", "Product", ("season",)),
+]
+
+# (имя, тип связи, свойства) — range-индексы на связях
+RELATIONSHIP_INDEXES = [
+    # инкрементальный пересчёт PREFERS: рёбра, записанные после watermark (cf_engine)
+    ("purchased_recorded_at_index", "PURCHASED", ("recorded_at",)),
+    ("liked_recorded_at_index", "LIKED", ("recorded_at",)),
+]
+
+FULLTEXT_INDEXES = [
+    ("productFullTextIndex", "Product", ("name", "category", "brand")),
+]
+
+# горячие обращения из neo4j_conn_Final / AppFull в минимальном виде: для каждого
+# EXPLAIN должен показать поиск по индексу, а не NodeByLabelScan / AllNodesScan
+HOT_QUERIES = [
+    ("login / profile: User by user_id", "MATCH (u:User {user_id:$v}) RETURN u"),
+    ("login: User by email", "MATCH (u:User {email:$v}) RETURN u"),
+    ("history / cart / CF: User by id", "MATCH (u:User {id:$v}) RETURN u"),
+    ("products / history: Product by id", "MATCH (p:Product {id:$v}) RETURN p"),
+    ("reviews / import: Product by sku", "MATCH (p:Product {sku:$v}) RETURN p"),
+    ("catalog: Category by name", "MATCH (c:Category {name:$v}) RETURN c"),
+    ("set-role: Role by name", "MATCH (r:Role {name:$v}) RETURN r"),
+    ("checkout: Order by id", "MATCH (o:Order {id:$v}) RETURN o"),
+    ("checkout: Order by idempotency key", "MATCH (o:Order {user_id:$v, idempotency_key:$v}) RETURN o"),
+    ("audit: AuditDay by user and day", "MATCH (d:AuditDay {user_id:$v, day:date()}) RETURN d"),
+    ("CF: watermark", "MATCH (s:CFState {name:$v}) RETURN s"),
+    ("promotions: shared version", "MATCH (m:Meta {id:$v}) RETURN m"),
+    ("CF incremental: purchases since watermark", "MATCH ()-[r:PURCHASED]->() WHERE r.recorded_at >= datetime() RETURN r"),
+    ("CF incremental: likes since watermark", "MATCH ()-[r:LIKED]->() WHERE r.recorded_at >= datetime() RETURN r"),
+    ("segments: Users by segment", "MATCH (u:User) WHERE u.segment = $v RETURN u"),
+    ("recommend/manual: Products by weight",
+     "MATCH (p:Product) WHERE p.weight IS NOT NULL AND p.weight > 0 RETURN p ORDER BY p.weight DESC"),
+    ("recommend/seasonal: Products by season", "MATCH (p:Product) WHERE p.season = $v RETURN p"),
+    ("search: Products by category", "MATCH (p:Product) WHERE p.category = $v RETURN p"),
+    ("search: Products by rating", "MATCH (p:Product) WHERE p.rating IS NOT NULL RETURN p ORDER BY p.rating DESC"),
+    ("search/fulltext", "CALL db.index.fulltext.queryNodes('productFullTextIndex', $v) YIELD node RETURN node"),
+]
+SCAN_OPERATORS = {"AllNodesScan", "NodeByLabelScan", "DirectedRelationshipTypeScan", "UndirectedRelationshipTypeScan"}
+
+
+def _props(var, props):
+    return ", ".join(f"{var}.{p}" for p in props)
+
+
+def schema_statements():
+    statements = [f"DROP CONSTRAINT {name} IF EXISTS" for name in DROPPED_CONSTRAINTS]
+    for name, label, props in CONSTRAINTS:
+        target = f"({_props('n', props)})" if len(props) > 1 else _props("n", props)
+        statements.append(f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE {target} IS UNIQUE")
+    for name, label, props in INDEXES:
+        statements.append(f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({_props('n', props)})")
+    for name, rel_type, props in RELATIONSHIP_INDEXES:
+        statements.append(f"CREATE INDEX {name} IF NOT EXISTS FOR ()-[r:{rel_type}]-() ON ({_props('r', props)})")
+    for name, label, props in FULLTEXT_INDEXES:
+        statements.append(f"CREATE FULLTEXT INDEX {name} IF NOT EXISTS FOR (n:{label}) ON EACH [{_props('n', props)}]")
+    return statements
+
+
+class SchemaManager:
+    """
+    Идемпотентно создаёт ограничения и индексы, ждёт, пока они станут ONLINE,
+    и проверяет планы горячих запросов. Основной путь — шаг деплоя:
+    python schema.py [--check]; при старте приложения (SCHEMA_BOOTSTRAP) операторы
+    только отправляются, без ожидания заполнения индексов.
+    """
+
+    @staticmethod
+    def apply():
+        """Создаёт отсутствующие ограничения / индексы; возвращает, сколько создано"""
+        created = 0
+        with driver.session() as s:
+            for statement in schema_statements():
+                # схемные операторы нельзя смешивать с записью данных — каждый в своей транзакции
+                summary = s.run(statement).consume()
+                created += summary.counters.constraints_added + summary.counters.indexes_added
+        return created
+
+    @staticmethod
+    def await_online(timeout=SCHEMA_AWAIT_TIMEOUT):
+        with driver.session() as s:
+            s.run("CALL db.awaitIndexes($timeout)", timeout=timeout).consume()
+
+    @staticmethod
+    def index_states():
+        with driver.session() as s:
+            return s.execute_read(lambda tx: tx.run("""
+                SHOW INDEXES YIELD name, type, state, populationPercent, labelsOrTypes, properties
+                RETURN name, type, state, populationPercent, labelsOrTypes, properties
+                ORDER BY name
+            """).data())
+
+    @staticmethod
+    def _operators(plan):
+        stack = [plan] if plan else []
+        while stack:
+            node = stack.pop()
+            yield node["operatorType"].split("@")[0]
+            stack.extend(node.get("children", []))
+
+    @staticmethod
+    def scan_report():
+        """[{name, query, operators, scans}] — scans непустой, если запросу не хватает индекса"""
+        report = []
+        with driver.session() as s:
+            for name, query in HOT_QUERIES:
+                try:
+                    plan = s.run("EXPLAIN " + query, v="x").consume().plan
+                except Exception as e:
+                    report.append({"name": name, "query": query, "error": str(e), "scans": []})
+                    continue
+                operators = list(SchemaManager._operators(plan))
+                report.append({"name": name, "query": query, "operators": operators,
+                               "scans": [op for op in operators if op in SCAN_OPERATORS]})
+        return report
+
+    @staticmethod
+    def ensure(timeout=SCHEMA_AWAIT_TIMEOUT):
+        created = SchemaManager.apply()
+        SchemaManager.await_online(timeout)
+        not_online = [i["name"] for i in SchemaManager.index_states() if i["state"] != "ONLINE"]
+        return {"created": created, "not_online": not_online}
+
+
+def ensure_schema():
+    """
+    Вызов при старте приложения: ошибка схемы не должна ронять процесс. Индексы
+    заполняются в фоне; ждать их (до SCHEMA_AWAIT_TIMEOUT) — дело python schema.py
+    на деплое, иначе импорт AppFull блокировался бы на больших базах.
+    """
+    if not SCHEMA_BOOTSTRAP:
+        return None
+    try:
+        created = SchemaManager.apply()
+        not_online = [i["name"] for i in SchemaManager.index_states() if i["state"] != "ONLINE"]
+        result = {"created": created, "not_online": not_online}
+        print(f"Schema applied: {result}")
+        return result
+    except Exception as e:
+        print(f"Schema bootstrap failed: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ограничения и индексы Neo4j для горячих запросов")
+    parser.add_argument("--check", action="store_true", help="ничего не создавать, только отчёт")
+    parser.add_argument("--print", action="store_true", help="вывести CREATE-операторы и выйти")
+    parser.add_argument("--timeout", type=int, default=SCHEMA_AWAIT_TIMEOUT)
+    args = parser.parse_args()
+
+    if args.print:
+        print(";\n".join(schema_statements()) + ";")
+        raise SystemExit(0)
+    result = {} if args.check else SchemaManager.ensure(args.timeout)
+    report = SchemaManager.scan_report()
+    result["indexes"] = SchemaManager.index_states()
+    result["scanning_queries"] = [r for r in report if r["scans"] or r.get("error")]
+    print(json.dumps(result, indent=2, default=str))
+    if result["scanning_queries"]:
+        raise SystemExit(1)
@@ -0,0 +1,375 @@
+# search_index.py
+import base64
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import time
+from dotenv import load_dotenv
+from neo4j_conn_Final import driver
+
+load_dotenv()
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "index")  # index | neo4j
+SEARCH_INDEX_REBUILD_INTERVAL = int(os.getenv("SEARCH_INDEX_REBUILD_INTERVAL", 300))
+# нижние границы ценовых корзин для фасетов: 0-50, 50-100, ..., 1000+
+# typeahead: последний терм короче SEARCH_PREFIX_MIN ищется только точным совпадением,
+# префикс раскрывается не более чем в SEARCH_PREFIX_MAX_EXPANSIONS самых частых термов
+SEARCH_PREFIX_MIN = int(os.getenv("SEARCH_PREFIX_MIN", 3))
+SEARCH_PREFIX_MAX_EXPANSIONS = int(os.getenv("SEARCH_PREFIX_MAX_EXPANSIONS", 50))
+SEARCH_PRICE_BUCKETS = [float(x) for x in os.getenv("SEARCH_PRICE_BUCKETS", "0,50,100,250,500,1000").split(",")]
+SORT_FIELDS = ("name", "price", "rating", "relevance")
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# вес поля в tf: совпадение в названии важнее совпадения в описании
+FIELD_WEIGHTS = {"name": 3.0, "brand": 2.0, "category": 2.0, "tags": 1.5, "description": 1.0}
+STORED_FIELDS = ("id", "name", "category", "brand", "price", "rating")
+
+
+def tokenize(text):
+    if text is None:
+        return []
+    if isinstance(text, (list, tuple)):
+        text = " ".join(str(t) for t in text)
+    return TOKEN_RE.findall(str(text).lower())
+
+
+def _key(value):
+    return str(value).lower() if value is not None else None
+
+
+def price_buckets():
+    """[{"label", "min", "max"}] по SEARCH_PRICE_BUCKETS; у последней корзины max = None"""
+    bounds = sorted(SEARCH_PRICE_BUCKETS)
+    out = []
+    for i, lo in enumerate(bounds):
+        hi = bounds[i + 1] if i + 1 < len(bounds) else None
+        out.append({"label": f"{lo:g}-{hi:g}" if hi is not None else f"{lo:g}+", "min": lo, "max": hi})
+    return out
+
+
+def price_bucket(price):
+    if price is None:
+        return None
+    label = None
+    for bucket in price_buckets():
+        if price >= bucket["min"]:
+            label = bucket["label"]
+    return label
+
+
+# ------------------------
+# Курсоры keyset-пагинации
+# ------------------------
+def encode_cursor(sort_by, key):
+    raw = json.dumps([sort_by, list(key)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort_by):
+    """Ключ последней выданной строки; ValueError, если курсор битый или от другой сортировки"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, key = json.loads(raw)
+    except Exception:
+        raise ValueError("invalid cursor")
+    if cursor_sort != sort_by:
+        raise ValueError("cursor does not match sort_by")
+    return tuple(key)
+
+
+def sort_key(doc, score, sort_by):
+    """Полный ключ сортировки, id в конце делает его уникальным; null — в конце, как в Cypher"""
+    if sort_by == "relevance":
+        return (-score, doc["id"])
+    value = doc.get(sort_by)
+    if sort_by == "name":
+        return (value is None, str(value or ""), doc["id"])
+    if sort_by == "rating":
+        # лучшие сначала (рейтинг — байесовское среднее, см. neo4j_conn_Final.Review)
+        return (value is None, -float(value or 0), doc["id"])
+    return (value is None, float(value or 0), doc["id"])
+
+
+def paginate(hits, sort_by="name", limit=20, cursor=None):
+    """
+    Одна страница результатов поиска + фасеты по всему результату за один проход.
+    Цена страницы не зависит от её номера: курсор — ключ последней строки, а не OFFSET.
+    """
+    after = decode_cursor(cursor, sort_by) if cursor else None
+    facets = {"category": {}, "brand": {}, "price": {}}
+    keyed = []
+    for doc, score in hits:
+        for name, value in (("category", doc["category"]), ("brand", doc["brand"]), ("price", price_bucket(doc["price"]))):
+            if value is not None:
+                facets[name][value] = facets[name].get(value, 0) + 1
+        key = sort_key(doc, score, sort_by)
+        if after is None or key > after:
+            keyed.append((key, doc, score))
+    page = heapq.nsmallest(limit + 1, keyed, key=lambda x: x[0])
+    next_cursor = encode_cursor(sort_by, page[limit - 1][0]) if len(page) > limit else None
+    return {
+        "items": [(doc, score) for _, doc, score in page[:limit]],
+        "next_cursor": next_cursor,
+        "total": len(hits),
+        "facets": {
+            "category": _facet_list(facets["category"]),
+            "brand": _facet_list(facets["brand"]),
+            "price": [{"value": b["label"], "count": facets["price"][b["label"]]}
+                      for b in price_buckets() if b["label"] in facets["price"]],
+        },
+    }
+
+
+def _facet_list(counts):
+    return [{"value": v, "count": c} for v, c in sorted(counts.items(), key=lambda x: (-x[1], str(x[0])))]
+
+
+# ------------------------
+# Инвертированный индекс каталога
+# ------------------------
+class SearchIndex:
+    """
+    Индекс в памяти процесса поверх каталога из Neo4j (Neo4j остаётся источником истины).
+    postings: term -> {product_id: взвешенный tf}, ранжирование BM25,
+    последний терм запроса ищется по префиксу (typeahead).
+    Фильтры category / brand / price — пересечение множеств id.
+    """
+
+    STATE = ("docs", "doc_terms", "doc_len", "total_len", "postings", "terms", "by_category", "by_brand", "prices")
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._reset()
+        self.built_at = None
+        self._rebuilding = False
+        # id, изменённые во время идущих перестроек: по множеству на каждую build()
+        self._touched_during_build = []
+
+    def _reset(self):
+        self.docs = {}
+        self.doc_terms = {}
+        self.doc_len = {}
+        self.total_len = 0.0
+        self.postings = {}
+        self.terms = []  # отсортированный словарь для поиска по префиксу
+        self.by_category = {}
+        self.by_brand = {}
+        self.prices = []  # отсортированные (price, id)
+
+    # ------------------------
+    # Построение и обновление
+    # ------------------------
+    @staticmethod
+    def fetch(product_ids=None):
+        with driver.session() as s:
+            return s.execute_read(lambda tx: [r["p"] for r in tx.run("""
+                MATCH (p:Product)
+                WHERE $ids IS NULL OR p.id IN $ids
+                RETURN p {.id, .name, .category, .brand, .price, .rating, .tags, .description} AS p
+            """, ids=product_ids)])
+
+    def build(self, products=None):
+        """
+        Полная перестройка из Neo4j (или из переданного списка). Товары, обновлённые
+        через refresh / remove, пока строился новый индекс, после замены перечитываются
+        ещё раз: снимок мог быть прочитан до их записи.
+        """
+        touched = set()
+        with self._lock:
+            self._touched_during_build.append(touched)
+        try:
+            products = self.fetch() if products is None else products
+            fresh = SearchIndex(self.k1, self.b)
+            for product in products:
+                fresh._add(product)
+            with self._lock:
+                for attr in self.STATE:
+                    setattr(self, attr, getattr(fresh, attr))
+                self.built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._touched_during_build.remove(touched)
+        if touched:
+            self.refresh(touched)
+        return len(products)
+
+    def ensure_built(self):
+        if self.built_at is None:
+            with self._lock:
+                if self.built_at is None:
+                    self.build()
+        elif time.monotonic() - self.built_at > SEARCH_INDEX_REBUILD_INTERVAL and not self._rebuilding:
+            # периодическая перестройка подхватывает записи других воркеров
+            self._rebuilding = True
+            threading.Thread(target=self._background_rebuild, daemon=True).start()
+
+    def _background_rebuild(self):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"Search index rebuild failed: {e}")
+        finally:
+            self._rebuilding = False
+
+    def refresh(self, product_ids):
+        """Перечитывает указанные товары из Neo4j; отсутствующие удаляются из индекса"""
+        product_ids = [str(pid) for pid in product_ids if pid is not None]
+        with self._lock:
+            for touched in self._touched_during_build:
+                touched.update(product_ids)
+        if self.built_at is None:
+            return
+        found = {str(p["id"]): p for p in self.fetch(product_ids)}
+        with self._lock:
+            for pid in product_ids:
+                self._remove(pid)
+                if pid in found:
+                    self._add(found[pid])
+
+    def remove(self, product_id):
+        with self._lock:
+            for touched in self._touched_during_build:
+                touched.add(str(product_id))
+            self._remove(str(product_id))
+
+    def _add(self, product):
+        pid = str(product["id"])
+        tf = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(product.get(field)):
+                tf[term] = tf.get(term, 0.0) + weight
+        self.docs[pid] = {f: product.get(f) for f in STORED_FIELDS}
+        self.docs[pid]["id"] = pid
+        self.doc_terms[pid] = tf
+        self.doc_len[pid] = sum(tf.values())
+        self.total_len += self.doc_len[pid]
+        for term, weight in tf.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                bisect.insort(self.terms, term)
+            posting[pid] = weight
+        self.by_category.setdefault(_key(product.get("category")), set()).add(pid)
+        self.by_brand.setdefault(_key(product.get("brand")), set()).add(pid)
+        if product.get("price") is not None:
+            bisect.insort(self.prices, (float(product["price"]), pid))
+
+    def _remove(self, pid):
+        doc = self.docs.pop(pid, None)
+        if doc is None:
+            return
+        for term in self.doc_terms.pop(pid):
+            posting = self.postings[term]
+            posting.pop(pid, None)
+            if not posting:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+        self.total_len -= self.doc_len.pop(pid)
+        self.by_category.get(_key(doc["category"]), set()).discard(pid)
+        self.by_brand.get(_key(doc["brand"]), set()).discard(pid)
+        if doc["price"] is not None:
+            i = bisect.bisect_left(self.prices, (float(doc["price"]), pid))
+            if i < len(self.prices) and self.prices[i] == (float(doc["price"]), pid):
+                del self.prices[i]
+
+    # ------------------------
+    # Поиск
+    # ------------------------
+    def _expand(self, term, limit=SEARCH_PREFIX_MAX_EXPANSIONS):
+        """
+        Термы словаря с данным префиксом: сам терм (если есть) и до limit самых частых
+        продолжений. Для префикса короче SEARCH_PREFIX_MIN — только точное совпадение.
+        """
+        if len(term) < SEARCH_PREFIX_MIN:
+            return [term] if term in self.postings else []
+        i = bisect.bisect_left(self.terms, term)
+        out = []
+        while i < len(self.terms) and self.terms[i].startswith(term):
+            out.append(self.terms[i])
+            i += 1
+        if len(out) <= limit:
+            return out
+        top = heapq.nlargest(limit, (t for t in out if t != term), key=lambda t: (len(self.postings[t]), t))
+        return ([term] if term in self.postings else []) + top
+
+    def _price_ids(self, min_price, max_price):
+        # (x,) < (x, id), поэтому границы по одной цене ищутся без знания id
+        lo = 0 if min_price is None else bisect.bisect_left(self.prices, (float(min_price),))
+        hi = len(self.prices) if max_price is None else bisect.bisect_left(
+            self.prices, (math.nextafter(float(max_price), math.inf),))
+        return {pid for _, pid in self.prices[lo:hi]}
+
+    def _bm25(self, tf, df, dl, n, avgdl):
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        return idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / avgdl))
+
+    def search(self, q="", category=None, brand=None, min_price=None, max_price=None, prefix=True):
+        """
+        Возвращает [(документ, score)] в порядке убывания score (без q — score 0).
+        Под блокировкой берётся только снимок нужных постингов; BM25 считается вне её,
+        чтобы тяжёлый запрос не держал остальные поиски и refresh.
+        """
+        self.ensure_built()
+        terms = tokenize(q)
+        with self._lock:
+            filters = []
+            if category:
+                filters.append(set(self.by_category.get(_key(category), ())))
+            if brand:
+                filters.append(set(self.by_brand.get(_key(brand), ())))
+            if min_price is not None or max_price is not None:
+                filters.append(self._price_ids(min_price, max_price))
+            if not terms:
+                candidates = set.intersection(*filters) if filters else set(self.docs)
+                return [(self.docs[pid], 0.0) for pid in candidates]
+
+            n = len(self.docs) or 1
+            avgdl = (self.total_len / n) or 1.0
+            term_postings = []
+            for i, term in enumerate(terms):
+                expansions = self._expand(term) if prefix and i == len(terms) - 1 else (
+                    [term] if term in self.postings else [])
+                if not expansions:
+                    return []
+                term_postings.append([dict(self.postings[t]) for t in expansions])
+            doc_len = {pid: self.doc_len[pid] for postings in term_postings for posting in postings for pid in posting}
+
+        scores = None
+        for postings in term_postings:
+            term_scores = {}
+            for posting in postings:
+                df = len(posting)
+                for pid, tf in posting.items():
+                    if scores is not None and pid not in scores:
+                        continue
+                    s = self._bm25(tf, df, doc_len[pid], n, avgdl)
+                    if s > term_scores.get(pid, 0.0):
+                        term_scores[pid] = s
+            if scores is None:
+                scores = term_scores
+            else:
+                # AND: документ должен содержать все термы запроса
+                scores = {pid: scores[pid] + s for pid, s in term_scores.items()}
+            if not scores:
+                return []
+        for ids in sorted(filters, key=len):
+            scores = {pid: s for pid, s in scores.items() if pid in ids}
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        with self._lock:
+            # товар могли удалить, пока считались оценки
+            return [(self.docs[pid], s) for pid, s in ranked if pid in self.docs]
+
+    def stats(self):
+        return {
+            "documents": len(self.docs), "terms": len(self.postings),
+            "age_seconds": round(time.monotonic() - self.built_at, 1) if self.built_at else None,
+        }
+
+
+search_index = SearchIndex()
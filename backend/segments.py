@@ -0,0 +1,51 @@
+# segments.py
+import json
+import time
+from neo4j_conn_Final import driver, User
+
+BATCH_SIZE = 1000
+
+
+class SegmentationJob:
+    """
+    Полный пересчёт сегментов: пользователи читаются пачками по возрастанию id
+    (keyset, без SKIP), каждая пачка пересчитывается и записывается своей транзакцией,
+    поэтому прогон по миллионам пользователей не держит их в памяти.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def run(self):
+        started = time.monotonic()
+        stats = {"users": 0, "batches": 0}
+        after = None
+        while True:
+            ids = User.next_ids(after, self.batch_size)
+            if not ids:
+                break
+            stats["users"] += User.refresh_segments(ids)
+            stats["batches"] += 1
+            after = ids[-1]
+        stats["seconds"] = round(time.monotonic() - started, 3)
+        return stats
+
+    @staticmethod
+    def distribution():
+        with driver.session() as s:
+            return s.execute_read(lambda tx: {r["segment"]: r["users"] for r in tx.run("""
+                MATCH (u:User) WHERE u.segment IS NOT NULL
+                RETURN u.segment AS segment, count(*) AS users
+            """)})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Пересчёт сегментов пользователей (RFM)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    result = SegmentationJob(args.batch_size).run()
+    result["distribution"] = SegmentationJob.distribution()
+    print(json.dumps(result, indent=2))
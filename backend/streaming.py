@@ -0,0 +1,87 @@
+# streaming.py
+import json
+from flask import Response, request, stream_with_context
+from neo4j_conn_Final import read_session
+
+NDJSON = "application/x-ndjson"
+CHUNK_ROWS = 200  # сколько строк склеивать в один chunk ответа
+
+
+def json_default(value):
+    """neo4j DateTime / Date и прочие не-JSON значения"""
+    if hasattr(value, "iso_format"):
+        return value.iso_format()
+    return str(value)
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=json_default)
+
+
+def json_response(value, status=200):
+    """Обычный (не потоковый) JSON-ответ с тем же сериализатором"""
+    return Response(dumps(value), status=status, mimetype="application/json")
+
+
+def wants_ndjson():
+    return NDJSON in request.headers.get("Accept", "")
+
+
+def iter_query(query, **params):
+    """
+    Строки результата прямо из курсора Neo4j: драйвер тянет их пачками fetch_size,
+    в памяти не держится весь результат. Сессия живёт, пока читается генератор.
+    Поток нельзя повторить с середины, поэтому здесь auto-commit чтение, а не execute_read.
+    """
+    with read_session() as s:
+        for record in s.run(query, **params):
+            yield record.data()
+
+
+def _chunks(parts):
+    buf = []
+    for part in parts:
+        buf.append(part)
+        if len(buf) >= CHUNK_ROWS:
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+
+
+def _json_array(rows):
+    yield "["
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + dumps(row)
+    yield "]"
+
+
+def _ndjson(rows):
+    for row in rows:
+        yield dumps(row) + "\n"
+
+
+def stream_rows(rows):
+    """Ответ-массив, отдаваемый по мере чтения rows; NDJSON при Accept: application/x-ndjson"""
+    if wants_ndjson():
+        return Response(stream_with_context(_chunks(_ndjson(rows))), mimetype=NDJSON)
+    return Response(stream_with_context(_chunks(_json_array(rows))), mimetype="application/json")
+
+
+def stream_object(head, key, rows):
+    """
+    Объект {**head, key: [...rows]} с потоковым массивом внутри.
+    В NDJSON первой строкой идёт head, дальше — по строке на элемент.
+    """
+    if wants_ndjson():
+        parts = [dumps(head) + "\n"]
+        return Response(stream_with_context(_chunks(_prefixed(parts, _ndjson(rows)))), mimetype=NDJSON)
+    prefix = dumps(head)[:-1] + ("," if head else "") + dumps(key) + ":"
+    parts = _prefixed([prefix], _json_array(rows), ["}"])
+    return Response(stream_with_context(_chunks(parts)), mimetype="application/json")
+
+
+def _prefixed(head, body, tail=()):
+    yield from head
+    yield from body
+    yield from tail
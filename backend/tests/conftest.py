@@ -0,0 +1,35 @@
+# tests/conftest.py
+import os
+import sys
+import uuid
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+# тесты с графом ходят только в отдельную базу: NEO4J_TEST_URI (и при необходимости
+# NEO4J_USER / NEO4J_PASSWORD); без неё такие тесты пропускаются
+if os.getenv("NEO4J_TEST_URI"):
+    os.environ["NEO4J_URI"] = os.environ["NEO4J_TEST_URI"]
+
+
+@pytest.fixture
+def neo4j_driver():
+    pytest.importorskip("neo4j")
+    if not os.getenv("NEO4J_TEST_URI"):
+        pytest.skip("NEO4J_TEST_URI не задан")
+    from neo4j_conn_Final import driver
+    try:
+        driver.verify_connectivity()
+    except Exception as e:
+        pytest.skip(f"Neo4j недоступен: {e}")
+    return driver
+
+
+@pytest.fixture
+def graph(neo4j_driver):
+    """Префикс id для узлов теста; после теста всё с этим префиксом удаляется"""
+    prefix = f"t{uuid.uuid4().hex[:8]}-"
+    yield prefix
+    with neo4j_driver.session() as s:
+        s.run("MATCH (n) WHERE n.id STARTS WITH $prefix DETACH DELETE n", prefix=prefix).consume()
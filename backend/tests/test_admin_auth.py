@@ -0,0 +1,34 @@
+# tests/test_admin_auth.py
+import pytest
+
+BULK_ROUTES = ["/products/bulk", "/history/bulk"]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    pytest.importorskip("flask")
+    import schema
+    monkeypatch.setattr(schema, "SCHEMA_BOOTSTRAP", False)  # импорт AppFull не должен ходить в Neo4j
+    import AppFull
+    return AppFull.app.test_client()
+
+
+@pytest.fixture
+def user_token(monkeypatch):
+    import auth
+    from utils import create_access_token
+    monkeypatch.setattr(auth, "load_user", lambda user_id: {"user_id": user_id, "roles": ["customer"]})
+    return create_access_token("u1")
+
+
+@pytest.mark.parametrize("route", BULK_ROUTES)
+def test_bulk_routes_reject_anonymous(client, route):
+    response = client.post(route, data=b"", content_type="application/x-ndjson")
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize("route", BULK_ROUTES)
+def test_bulk_routes_reject_non_admins(client, user_token, route):
+    response = client.post(route, data=b"", content_type="application/x-ndjson",
+                           headers={"Authorization": f"Bearer {user_token}"})
+    assert response.status_code == 403
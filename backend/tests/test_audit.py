@@ -0,0 +1,114 @@
+# tests/test_audit.py
+import json
+import time
+
+import pytest
+
+
+class FakeDriver:
+    """driver.session().execute_write(fn, rows): пишет строки в written или падает, пока down"""
+
+    def __init__(self):
+        self.down = False
+        self.written = []
+
+    def session(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute_write(self, fn, rows):
+        if self.down:
+            raise RuntimeError("neo4j unavailable")
+        self.written.extend(e["kind"] for row in rows for e in row["events"])
+
+
+@pytest.fixture
+def neo4j(monkeypatch):
+    import audit
+    fake = FakeDriver()
+    monkeypatch.setattr(audit, "driver", fake)
+    return fake
+
+
+def _writer(tmp_path, **kwargs):
+    from audit import AuditWriter
+    params = dict(mode="async", queue_size=100, batch_size=10, flush_interval=0.01, put_timeout=0.01,
+                  spill_path=str(tmp_path / "audit_spill.ndjson"))
+    params.update(kwargs)
+    return AuditWriter(**params)
+
+
+def _wait(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_bucket_rows_groups_events_per_user_day():
+    from audit import bucket_rows
+    events = [
+        {"user_id": "u1", "kind": "login", "ip": None, "success": False, "time": "2026-01-01T10:00:00+00:00"},
+        {"user_id": "u1", "kind": "login", "ip": "1.2.3.4", "success": True, "time": "2026-01-01T10:01:00+00:00"},
+        {"user_id": "u1", "kind": "login", "ip": "1.2.3.4", "success": True, "time": "2026-01-02T09:00:00+00:00"},
+    ]
+    rows = bucket_rows(events)
+    assert [(r["day"], len(r["events"]), r["failures"]) for r in rows] == [("2026-01-01", 2, 1), ("2026-01-02", 1, 0)]
+    assert rows[0]["events"][0]["ip"] == ""
+
+
+def test_failed_writes_are_spilled_and_replayed(tmp_path, neo4j):
+    neo4j.down = True
+    writer = _writer(tmp_path)
+    for kind in ("a", "b", "c"):
+        writer.record("u1", kind)
+    assert _wait(lambda: writer.stats()["spilled"] == 3)
+
+    neo4j.down = False
+    writer.record("u1", "d")
+    assert _wait(lambda: len(neo4j.written) == 4)
+    writer.stop()
+    assert sorted(neo4j.written) == ["a", "b", "c", "d"]
+    assert writer.stats()["dropped"] == 0 and not (tmp_path / "audit_spill.ndjson").exists()
+
+
+def test_full_queue_spills_instead_of_dropping(tmp_path, neo4j, monkeypatch):
+    writer = _writer(tmp_path, queue_size=1)
+    monkeypatch.setattr(writer, "start", lambda: None)  # писателя нет — очередь никто не разбирает
+    writer.record("u1", "queued")
+    writer.record("u1", "overflow")
+    assert writer.stats()["spilled"] == 1 and writer.stats()["dropped"] == 0
+    assert writer.replay_spill() == 1
+    assert neo4j.written == ["overflow"]
+
+
+def test_stop_spills_what_the_writer_did_not_take(tmp_path, neo4j):
+    import threading
+    writer = _writer(tmp_path, queue_size=3, put_timeout=0)
+    release = threading.Event()
+    written = []
+
+    def slow_write(events):
+        # Neo4j не отвечает: писатель занят первой пачкой, очередь заполняется
+        release.wait(5)
+        written.extend(e["kind"] for e in events)
+        return True
+
+    writer.write = slow_write
+    writer.record("u1", "taken")
+    assert _wait(lambda: writer.queue.qsize() == 0)
+    for kind in ("a", "b", "c"):
+        writer.record("u1", kind)
+    assert writer.queue.full()
+
+    threading.Timer(0.05, release.set).start()
+    writer.stop(timeout=1.0)
+    with open(tmp_path / "audit_spill.ndjson", encoding="utf-8") as f:
+        spilled = [json.loads(line)["kind"] for line in f if line.strip()]
+    assert spilled and sorted(written + spilled) == ["a", "b", "c", "taken"]
+    assert writer.queue.empty() and writer.stats()["dropped"] == 0
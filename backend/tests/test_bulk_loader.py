@@ -0,0 +1,55 @@
+# tests/test_bulk_loader.py
+import pytest
+
+bulk_loader = pytest.importorskip("bulk_loader")
+from bulk_loader import BulkLoader, decode_resume
+
+
+def events(n):
+    return [(i, {"action": "purchase", "user_id": f"u{i % 7}", "product_id": f"p{i}", "time": None})
+            for i in range(1, n + 1)]
+
+
+class Sink:
+    def __init__(self, fail_on_call=None):
+        self.written = []
+        self.calls = 0
+        self.fail_on_call = fail_on_call
+
+    def log_groups(self, groups):
+        self.calls += 1
+        if self.calls == self.fail_on_call:
+            raise RuntimeError("neo4j unavailable")
+        for _, batch in groups:
+            self.written.extend(e["product_id"] for e in batch)
+
+
+@pytest.mark.parametrize("parallelism", [1, 3])
+def test_resume_after_failure_writes_each_event_once(monkeypatch, tmp_path, parallelism):
+    checkpoint = str(tmp_path / "load.checkpoint")
+    sink = Sink(fail_on_call=4)
+    monkeypatch.setattr(bulk_loader.History, "log_groups", sink.log_groups)
+
+    first = BulkLoader(batch_size=5, parallelism=parallelism, checkpoint_path=checkpoint).load(events(100))
+    assert first["aborted"]
+
+    sink.fail_on_call = None
+    second = BulkLoader(batch_size=5, parallelism=parallelism, checkpoint_path=checkpoint).load(events(100))
+    assert not second["aborted"]
+    assert sorted(sink.written) == sorted(f"p{i}" for i in range(1, 101))
+    assert second["checkpoint"] == 100
+
+
+def test_resume_token_round_trip(monkeypatch):
+    sink = Sink(fail_on_call=2)
+    monkeypatch.setattr(bulk_loader.History, "log_groups", sink.log_groups)
+    first = BulkLoader(batch_size=5, parallelism=2).load(events(40))
+
+    sink.fail_on_call = None
+    BulkLoader(batch_size=5, parallelism=2).load(events(40), resume=decode_resume(first["resume"]))
+    assert sorted(sink.written) == sorted(f"p{i}" for i in range(1, 41))
+
+
+def test_bad_resume_token():
+    with pytest.raises(ValueError):
+        decode_resume("not-a-token")
@@ -0,0 +1,54 @@
+# tests/test_cache.py
+import threading
+
+from cache import MemoryCacheBackend, RecommendationCache
+
+
+def test_invalidate_during_compute_skips_store():
+    cache = RecommendationCache(MemoryCacheBackend(max_entries=100), ttl=60)
+
+    def compute():
+        # пользователь что-то купил, пока считались рекомендации
+        cache.invalidate_user("u1")
+        return ["stale"]
+
+    assert cache.get_or_compute("u1", "cf", {"limit": 5}, compute) == ["stale"]
+    assert cache.get_or_compute("u1", "cf", {"limit": 5}, lambda: ["fresh"]) == ["fresh"]
+    assert cache.get_or_compute("u1", "cf", {"limit": 5}, lambda: ["other"]) == ["fresh"]
+
+
+def test_forgotten_generations_do_not_store_in_flight_results():
+    backend = MemoryCacheBackend(max_entries=2)
+    generation = backend.generation("u1")
+    for user_id in ("u1", "u2", "u3"):
+        backend.delete_group(user_id)
+    assert not backend.set("u1", "k", ["stale"], 60, generation)
+    assert backend.set("u1", "k", ["fresh"], 60, backend.generation("u1"))
+
+
+def test_counters_are_exact_under_threads():
+    cache = RecommendationCache(MemoryCacheBackend(max_entries=100), ttl=60)
+    cache.get_or_compute(None, "top", {}, lambda: [1])
+
+    def worker():
+        for _ in range(500):
+            cache.get_or_compute(None, "top", {}, lambda: [1])
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.stats()["hits"] == 4000 and cache.stats()["misses"] == 1
+
+
+def test_product_invalidated_during_read_is_not_cached():
+    from cache import TTLCache
+    cache = TTLCache(max_entries=10, ttl=60)
+    generation = cache.generation("p1")
+    # PUT /products/p1 закоммитился, пока GET читал старую карточку
+    cache.invalidate("p1")
+    assert not cache.set("p1", {"body": "old"}, generation=generation)
+    assert cache.get("p1") is None
+    assert cache.set("p1", {"body": "new"}, generation=cache.generation("p1"))
+    assert cache.get("p1") == {"body": "new"}
@@ -0,0 +1,177 @@
+# tests/test_cart_store.py
+import threading
+import time
+import pytest
+
+cart_store = pytest.importorskip("cart_store")
+from cart_store import CartStore, MemoryCartBackend
+
+
+class Neo4jStub:
+    """То, что CartStore пишет в Neo4j и читает из него, без живой базы"""
+
+    def __init__(self, carts=None):
+        self.carts = carts or {}
+        self.fail = False
+        self.writes = []
+        self.on_write = None
+
+    def write(self, carts):
+        if self.on_write:
+            self.on_write()
+        if self.fail:
+            raise RuntimeError("neo4j unavailable")
+        self.writes.append(dict((u, dict(lines)) for u, lines in carts))
+        for user_id, lines in carts:
+            self.carts[user_id] = dict(lines)
+
+    def get_cart(self, user_id):
+        return [{"id": pid, "quantity": qty} for pid, qty in self.carts.get(user_id, {}).items()]
+
+
+@pytest.fixture
+def neo4j(monkeypatch):
+    stub = Neo4jStub()
+    monkeypatch.setattr(cart_store.Cart, "get_cart", stub.get_cart)
+    return stub
+
+
+def make_store(neo4j, max_entries=100):
+    store = CartStore(MemoryCartBackend(max_entries=max_entries), batch_size=2)
+    store.start = lambda: None  # без фонового потока: flush вызывается тестом
+    store._write = neo4j.write
+    return store
+
+
+def test_failed_flush_keeps_cart_dirty_and_retries(neo4j):
+    store = make_store(neo4j)
+    store.add("u1", "p1", 2)
+
+    neo4j.fail = True
+    assert store.flush() == 0
+    assert store.flush_failures == 1
+    assert store.backend.dirty_count() == 1
+
+    neo4j.fail = False
+    assert store.flush() == 1
+    assert neo4j.carts["u1"] == {"p1": 2}
+    assert store.backend.dirty_count() == 0
+
+
+def test_failed_flush_survives_eviction(neo4j):
+    store = make_store(neo4j, max_entries=1)
+    store.add("u1", "p1", 1)
+    neo4j.fail = True
+    store.flush()
+
+    # другие корзины вытесняют из памяти только уже записанные
+    for user_id in ("u2", "u3", "u4"):
+        store.get(user_id)
+    assert store.backend.get("u1") == {"p1": 1}
+
+    neo4j.fail = False
+    store.flush()
+    assert neo4j.carts["u1"] == {"p1": 1}
+    assert all(lines for write in neo4j.writes for lines in write.values())
+
+
+def test_add_after_eviction_keeps_loaded_lines(neo4j):
+    store = make_store(neo4j, max_entries=1)
+    neo4j.carts = {"u1": {"p0": 3}}
+    store.backend.add("dirty", "p", 1)
+    store.add("u1", "p1", 1)  # загрузка u1 сверх лимита, пока "dirty" не записана
+
+    store.flush()
+    assert neo4j.carts["u1"] == {"p0": 3, "p1": 1}
+
+
+def test_eviction_drops_only_clean_carts(neo4j):
+    store = make_store(neo4j, max_entries=2)
+    neo4j.carts = {"clean1": {"p": 1}, "clean2": {"p": 1}}
+    store.backend.load("clean1", {"p": 1})
+    store.backend.load("clean2", {"p": 1})
+    store.backend.add("dirty", "p", 1)
+    store.backend.put("clean3", {})
+
+    assert store.backend.get("dirty") == {"p": 1}
+    assert store.backend.get("clean1") is None
+
+
+def test_change_during_flush_stays_dirty(neo4j):
+    store = make_store(neo4j)
+    store.add("u1", "p1", 1)
+    neo4j.on_write = lambda: (store.backend.add("u1", "p2", 1), setattr(neo4j, "on_write", None))
+
+    store.flush()
+    assert neo4j.carts["u1"] == {"p1": 1}
+    assert store.backend.dirty_count() == 1  # изменение после чтения не потеряно
+
+    store.flush()
+    assert neo4j.carts["u1"] == {"p1": 1, "p2": 1}
+    assert store.backend.dirty_count() == 0
+
+
+def test_checkout_replay_keeps_hot_cart(neo4j, monkeypatch):
+    store = make_store(neo4j)
+    orders = iter([{"order_id": "o1", "created": True}, {"order_id": "o1", "created": False}])
+    monkeypatch.setattr(cart_store.Cart, "checkout", lambda user_id, idempotency_key=None: next(orders))
+
+    store.add("u1", "p1", 1)
+    assert store.checkout("u1", "key")["created"] is True
+    assert neo4j.carts["u1"] == {"p1": 1}  # сброшено в Neo4j до заказа
+    assert store.backend.get("u1") == {}
+
+    store.add("u1", "p2", 1)
+    assert store.checkout("u1", "key")["created"] is False
+    assert store.backend.get("u1") == {"p2": 1}
+
+
+def test_concurrent_first_adds_are_not_lost(neo4j, monkeypatch):
+    store = make_store(neo4j)
+    neo4j.carts = {"u1": {"p0": 1}}
+    slow = neo4j.get_cart
+
+    def get_cart(user_id):
+        time.sleep(0.05)
+        return slow(user_id)
+    monkeypatch.setattr(cart_store.Cart, "get_cart", get_cart)
+
+    threads = [threading.Thread(target=store.add, args=("u1", f"p{i}", 1)) for i in (1, 2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.backend.get("u1") == {"p0": 1, "p1": 1, "p2": 1}
+
+
+def test_idle_clean_carts_expire(neo4j):
+    store = make_store(neo4j)
+    store.backend.ttl = 0.05
+    neo4j.carts["u1"] = {"p1": 1}
+    store._ensure_loaded("u1")
+    store.add("u2", "p2", 1)  # грязная — не выгружается, пока не записана
+    time.sleep(0.1)
+
+    assert store.backend.get("u1") is None
+    assert store.backend.get("u2") == {"p2": 1}
+    store.flush()
+    time.sleep(0.1)
+    store.backend.put("u3", {})
+    assert store.backend.stats()["carts"] == 1
+
+
+def test_memory_store_refuses_multiple_workers(monkeypatch):
+    monkeypatch.setattr(cart_store, "CART_STORE_BACKEND", "memory")
+    monkeypatch.setattr(cart_store, "WEB_CONCURRENCY", 4)
+    with pytest.raises(RuntimeError):
+        cart_store._make_store()
+
+
+def test_auto_prefers_redis_when_configured(monkeypatch):
+    monkeypatch.setattr(cart_store, "CART_STORE_BACKEND", "auto")
+    monkeypatch.setattr(cart_store, "WEB_CONCURRENCY", 1)
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    assert isinstance(cart_store._make_store().backend, MemoryCartBackend)
+    if cart_store.redis is not None:
+        monkeypatch.setenv("REDIS_URL", "redis://localhost:6379/0")
+        assert isinstance(cart_store._make_store().backend, cart_store.RedisCartBackend)
@@ -0,0 +1,111 @@
+# tests/test_cf_engine.py
+import pytest
+
+pytest.importorskip("numpy")
+
+# (user, product, score) — пересекающиеся вкусы с разными весами
+PREFERS = [
+    ("u1", "p1", 3), ("u1", "p2", 1), ("u1", "p3", 2),
+    ("u2", "p1", 1), ("u2", "p2", 2), ("u2", "p4", 5),
+    ("u3", "p2", 4), ("u3", "p3", 1), ("u3", "p5", 2), ("u3", "p4", 1),
+    ("u4", "p1", 2), ("u4", "p5", 3), ("u4", "p6", 1),
+]
+
+
+@pytest.fixture
+def preferences(neo4j_driver, graph):
+    with neo4j_driver.session() as s:
+        s.run("""
+            UNWIND $rows AS row
+            MERGE (u:User {id:$prefix + row[0]})
+            MERGE (p:Product {id:$prefix + row[1]})
+            ON CREATE SET p.name = row[1], p.category = 'c', p.price = 1.0
+            CREATE (u)-[:PREFERS {score:row[2]}]->(p)
+        """, rows=[list(r) for r in PREFERS], prefix=graph).consume()
+    return graph
+
+
+# item_based в Cypher читает предрасчитанный SIMILAR_TO (top-k), in-memory — точный косинус,
+# поэтому поэлементное совпадение проверяется только для user_based
+@pytest.mark.parametrize("algo", ["user_based"])
+def test_in_memory_matches_cypher(preferences, algo):
+    from cf_engine import CollaborativeFiltering
+    cypher = CollaborativeFiltering(in_memory=False)
+    memory = CollaborativeFiltering(in_memory=True)
+    memory.load_matrix()
+
+    for name in ("u1", "u2", "u3", "u4"):
+        user_id = preferences + name
+        expected = {r["id"]: r["score"] for r in cypher.recommend(user_id, limit=100, algo=algo)}
+        actual = {r["id"]: r["score"] for r in memory.recommend(user_id, limit=100, algo=algo)}
+        assert expected, f"{algo}: у {name} нет рекомендаций"
+        assert actual.keys() == expected.keys()
+        for product_id, score in expected.items():
+            assert actual[product_id] == pytest.approx(score)
+
+
+def test_cypher_item_based_uses_similar_to(neo4j_driver, preferences):
+    from cf_engine import CollaborativeFiltering
+    with neo4j_driver.session() as s:
+        s.run("""
+            UNWIND $edges AS e
+            MATCH (a:Product {id:$prefix + e[0]}), (b:Product {id:$prefix + e[1]})
+            CREATE (a)-[:SIMILAR_TO {score:e[2], rank:1}]->(b)
+        """, edges=[["p1", "p4", 0.5], ["p3", "p4", 0.25], ["p2", "p5", 0.1], ["p1", "p2", 0.9]],
+            prefix=preferences).consume()
+
+    result = CollaborativeFiltering().recommend(preferences + "u1", limit=10, algo="item_based")
+    # u1: p1=3, p2=1, p3=2; p2 уже в PREFERS и исключается
+    assert [(r["id"], r["score"]) for r in result] == [
+        (preferences + "p4", pytest.approx(3 * 0.5 + 2 * 0.25)),
+        (preferences + "p5", pytest.approx(1 * 0.1)),
+    ]
+
+
+def _trained(tmp_path):
+    from cf_engine import PreferenceMatrix, MatrixFactorization
+    matrix = PreferenceMatrix.from_triples(PREFERS, {p: {"name": p} for _, p, _ in PREFERS})
+    model = MatrixFactorization(factors=4, iterations=3).fit(matrix)
+    path = str(tmp_path / "als.npz")
+    model.save(path)
+    return model, path
+
+
+def test_als_model_round_trips_without_pickle(tmp_path):
+    import numpy as np
+    from cf_engine import MatrixFactorization
+    model, path = _trained(tmp_path)
+    with np.load(path, allow_pickle=False) as f:
+        assert f["user_ids"].dtype.kind == "U"
+    loaded = MatrixFactorization.load(path)
+    assert loaded.recommend("u1", limit=3) == model.recommend("u1", limit=3)
+
+
+def test_missing_or_legacy_model_is_not_ready(tmp_path):
+    import numpy as np
+    from cf_engine import CollaborativeFiltering, ModelNotReady
+    cf = CollaborativeFiltering(model_path=str(tmp_path / "missing.npz"))
+    with pytest.raises(ModelNotReady):
+        cf.recommend("u1", algo="als")
+
+    legacy = tmp_path / "legacy.npz"
+    np.savez(legacy, params=np.array('{"factors": 4}'), user_ids=np.array(["u1"], dtype=object))
+    cf = CollaborativeFiltering(model_path=str(legacy))
+    assert cf.load_model() is None
+    with pytest.raises(ModelNotReady):
+        cf.recommend("u1", algo="als")
+
+
+def test_failed_delta_keeps_dirty_pairs(monkeypatch):
+    import neo4j_conn_Final
+    from cf_engine import CollaborativeFiltering
+    neo4j_conn_Final.pop_dirty_preferences()
+    neo4j_conn_Final.mark_preference_dirty("u1", "p1")
+
+    def fail(self, dirty):
+        raise RuntimeError("neo4j unavailable")
+
+    monkeypatch.setattr(CollaborativeFiltering, "_write_preference_delta", fail)
+    with pytest.raises(RuntimeError):
+        CollaborativeFiltering().update_preference_matrix(incremental=True)
+    assert neo4j_conn_Final.pop_dirty_preferences() == ({("u1", "p1")}, False)
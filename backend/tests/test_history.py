@@ -0,0 +1,71 @@
+# tests/test_history.py
+import pytest
+
+
+def _build(driver, prefix):
+    """u смотрит p1 трижды и лайкает p2; o1 и o2 пересекаются с ним и смотрят другое по многу раз"""
+    with driver.session() as s:
+        s.run("""
+            UNWIND range(1, 5) AS i
+            CREATE (:Product {id:$prefix + 'p' + toString(i), name:'p' + toString(i)})
+        """, prefix=prefix).consume()
+        s.run("""
+            UNWIND ['u', 'o1', 'o2'] AS name
+            CREATE (:User {id:$prefix + name})
+        """, prefix=prefix).consume()
+        s.run("""
+            UNWIND $edges AS e
+            MATCH (u:User {id:$prefix + e[0]}), (p:Product {id:$prefix + e[2]})
+            FOREACH (i IN CASE WHEN e[1] = 'VIEWED' THEN range(1, e[3]) ELSE [] END |
+                CREATE (u)-[:VIEWED {time:datetime() - duration({minutes:i})}]->(p))
+            FOREACH (_ IN CASE WHEN e[1] = 'LIKED' THEN [1] ELSE [] END | CREATE (u)-[:LIKED {time:datetime()}]->(p))
+            FOREACH (_ IN CASE WHEN e[1] = 'WISHLISTED' THEN [1] ELSE [] END | CREATE (u)-[:WISHLISTED]->(p))
+        """, prefix=prefix, edges=[
+            ["u", "VIEWED", "p1", 3], ["u", "LIKED", "p2", 1],
+            ["o1", "LIKED", "p1", 1], ["o1", "VIEWED", "p3", 4], ["o1", "WISHLISTED", "p4", 1],
+            ["o2", "WISHLISTED", "p2", 1], ["o2", "LIKED", "p3", 1], ["o2", "VIEWED", "p5", 2],
+        ]).consume()
+
+
+def _scores(user_id):
+    from neo4j_conn_Final import Recommendation
+    return {r["product_id"]: r["score"] for r in Recommendation.recommend_products_advanced(user_id, limit=10)}
+
+
+def test_advanced_scores_match_raw_and_compacted(neo4j_driver, graph):
+    from neo4j_conn_Final import History
+    _build(neo4j_driver, graph)
+    raw = _scores(graph + "u")
+    assert raw == {graph + "p3": 4 + 3, graph + "p4": 2, graph + "p5": 2}
+
+    result = History.compact_views([graph + name for name in ("u", "o1", "o2")])
+    assert result["edges_removed"] == (3 - 1) + (4 - 1) + (2 - 1)
+    assert _scores(graph + "u") == raw
+
+
+@pytest.mark.parametrize("views", [1, 3])
+def test_compact_write_folds_leftover_raw_edges(neo4j_driver, graph, monkeypatch, views):
+    import neo4j_conn_Final
+    _build(neo4j_driver, graph)
+    monkeypatch.setitem(neo4j_conn_Final.History.BATCH_QUERIES, "view", neo4j_conn_Final._COMPACT_VIEW_QUERY)
+
+    for _ in range(views):
+        neo4j_conn_Final.History.log_view(graph + "o1", graph + "p3")
+    with neo4j_driver.session() as s:
+        rows = s.run("""
+            MATCH (:User {id:$u})-[v:VIEWED]->(:Product {id:$p}) RETURN v.count AS count
+        """, u=graph + "o1", p=graph + "p3").data()
+    assert rows == [{"count": 4 + views}]
+
+
+def test_return_after_repeat_purchases_is_logged_once(neo4j_driver, graph):
+    from neo4j_conn_Final import History
+    _build(neo4j_driver, graph)
+    for _ in range(3):
+        History.log_purchase(graph + "u", graph + "p1")
+    History.log_return(graph + "u", graph + "p1")
+    with neo4j_driver.session() as s:
+        returned = s.run("""
+            MATCH (:User {id:$u})-[r:RETURNED]->(:Product {id:$p}) RETURN count(r) AS n
+        """, u=graph + "u", p=graph + "p1").single()["n"]
+    assert returned == 1
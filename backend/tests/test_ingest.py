@@ -0,0 +1,95 @@
+# tests/test_ingest.py
+import time
+
+import pytest
+
+
+class FlakyHistory:
+    """History.log_batch, который падает первые failures вызовов"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.written = []
+
+    def log_batch(self, action, events):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("neo4j unavailable")
+        self.written.extend((action, e["product_id"]) for e in events)
+
+
+@pytest.fixture
+def history(monkeypatch):
+    import ingest
+    flaky = FlakyHistory()
+    monkeypatch.setattr(ingest, "History", flaky)
+    monkeypatch.setattr(ingest, "INGEST_RETRY_BACKOFF", 0.01)
+    return flaky
+
+
+def _ingestor(tmp_path, **kwargs):
+    from ingest import EventIngestor
+    params = dict(mode="async", queue_size=100, batch_size=10, flush_interval=0.01, workers=1,
+                  spill_path=str(tmp_path / "spill.ndjson"))
+    params.update(kwargs)
+    return EventIngestor(**params)
+
+
+def _wait(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_failed_flush_is_retried_in_order(tmp_path, history):
+    history.failures = 3
+    ingestor = _ingestor(tmp_path)
+    ingestor.submit("purchase", "u1", "p1")
+    ingestor.submit("return", "u1", "p1")
+    assert _wait(lambda: len(history.written) == 2)
+    ingestor.stop()
+    assert history.written == [("purchase", "p1"), ("return", "p1")]
+    assert ingestor.stats()["failed"] == 3 and ingestor.stats()["spilled"] == 0
+
+
+def test_unwritten_events_are_spilled_and_restored(tmp_path, history):
+    history.failures = 10 ** 6
+    ingestor = _ingestor(tmp_path)
+    for i in range(5):
+        ingestor.submit("view", "u1", f"p{i}")
+    assert _wait(lambda: ingestor.stats()["failed"] >= 5)
+    ingestor.stop()
+    assert ingestor.stats()["spilled"] == 5 and history.written == []
+
+    history.failures = 0
+    restarted = _ingestor(tmp_path)
+    restarted.start()
+    assert restarted.stats()["restored"] == 5
+    assert _wait(lambda: len(history.written) == 5)
+    restarted.stop()
+    assert [p for _, p in history.written] == [f"p{i}" for i in range(5)]
+    assert not (tmp_path / "spill.ndjson").exists()
+
+
+def test_full_window_applies_backpressure_while_failing(tmp_path, history):
+    from ingest import IngestQueueFull
+    history.failures = 10 ** 6
+    ingestor = _ingestor(tmp_path, queue_size=5, batch_size=2, put_timeout=0.05)
+    with pytest.raises(IngestQueueFull):
+        for i in range(50):
+            ingestor.submit("view", "u1", f"p{i}")
+    accepted = ingestor.stats()["enqueued"]
+    ingestor.stop()
+    assert ingestor.stats()["spilled"] == accepted
+
+
+def test_dirty_preferences_are_capped(monkeypatch):
+    import neo4j_conn_Final
+    neo4j_conn_Final.pop_dirty_preferences()
+    monkeypatch.setattr(neo4j_conn_Final, "PREFERENCE_DIRTY_MAX", 3)
+    for i in range(5):
+        neo4j_conn_Final.mark_preference_dirty("u", f"p{i}")
+    pairs, overflow = neo4j_conn_Final.pop_dirty_preferences()
+    assert len(pairs) == 3 and overflow
+    assert neo4j_conn_Final.pop_dirty_preferences() == (set(), False)
@@ -0,0 +1,123 @@
+# tests/test_mail_outbox.py
+import socket
+import time
+import pytest
+
+import mail_outbox
+from mail_outbox import MailOutbox
+
+aiosmtpd_controller = pytest.importorskip("aiosmtpd.controller")
+
+
+class Recorder:
+    """Обработчик aiosmtpd: запоминает письма, адреса из refuse отвергает"""
+
+    def __init__(self, refuse=()):
+        self.messages = []
+        self.refuse = set(refuse)
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refuse:
+            return "550 no such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.rcpt_tos, envelope.content.decode("utf-8", "replace")))
+        return "250 Message accepted"
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    handler = Recorder(refuse={"nobody@example.com"})
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    controller = aiosmtpd_controller.Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    monkeypatch.setattr(mail_outbox, "MAIL_SERVER", "127.0.0.1")
+    monkeypatch.setattr(mail_outbox, "MAIL_PORT", port)
+    monkeypatch.setattr(mail_outbox, "MAIL_USE_TLS", False)
+    monkeypatch.setattr(mail_outbox, "MAIL_USERNAME", "")
+    yield handler
+    controller.stop()
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_import_does_not_touch_disk(tmp_path):
+    box = MailOutbox(path=str(tmp_path / "outbox.db"))
+    assert not (tmp_path / "outbox.db").exists()
+    box.stats()
+    assert (tmp_path / "outbox.db").exists()
+
+
+def test_delivers_over_one_connection(smtp, tmp_path):
+    box = MailOutbox(path=str(tmp_path / "outbox.db"), concurrency=1)
+    for i in range(3):
+        box.enqueue(f"subject {i}", ["user@example.com"], f"body {i}")
+    try:
+        assert wait_for(lambda: len(smtp.messages) == 3)
+        assert wait_for(lambda: box.stats()["sent_total"] == 3)
+    finally:
+        box.stop()
+    assert box.connections_opened == 1
+    assert all(rcpt == ["user@example.com"] for rcpt, _ in smtp.messages)
+
+
+def test_refused_recipient_fails_without_retry(smtp, tmp_path):
+    box = MailOutbox(path=str(tmp_path / "outbox.db"), concurrency=1)
+    box.enqueue("hello", ["nobody@example.com"], "body")
+    try:
+        assert wait_for(lambda: box.stats()["failed_total"] == 1)
+    finally:
+        box.stop()
+    assert smtp.messages == []
+    assert box.retried == 0
+
+
+def test_unreachable_server_is_retried_later(monkeypatch, tmp_path):
+    monkeypatch.setattr(mail_outbox, "MAIL_SERVER", "127.0.0.1")
+    monkeypatch.setattr(mail_outbox, "MAIL_PORT", 1)
+    box = MailOutbox(path=str(tmp_path / "outbox.db"), concurrency=1)
+    box.enqueue("hello", ["user@example.com"], "body")
+    try:
+        assert wait_for(lambda: box.retried == 1)
+    finally:
+        box.stop()
+    stats = box.stats()
+    assert stats["pending"] == 1 and stats["due"] == 0
+
+
+def test_claim_is_exclusive_across_instances(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    first, second = MailOutbox(path=path), MailOutbox(path=path)
+    first._db().execute("INSERT INTO outbox (recipients, subject, body, next_attempt_at, created_at) "
+                        "VALUES ('[]', 's', 'b', 0, 0)")
+    first._db().commit()
+
+    row, _ = first._claim()
+    assert row is not None
+    assert second._claim()[0] is None
+
+
+def test_new_instance_does_not_requeue_live_claims(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    sender = MailOutbox(path=path)
+    sender._db().execute("INSERT INTO outbox (recipients, subject, body, next_attempt_at, created_at) "
+                         "VALUES ('[]', 's', 'b', 0, 0)")
+    sender._db().commit()
+    assert sender._claim()[0] is not None
+
+    # ещё один процесс (воркер, CLI) не забирает письмо, пока аренда не истекла
+    other = MailOutbox(path=path)
+    assert other._claim()[0] is None
+    other.lease = -1
+    assert other._claim()[0] is not None
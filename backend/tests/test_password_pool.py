@@ -0,0 +1,22 @@
+# tests/test_password_pool.py
+import subprocess
+import sys
+
+from conftest import BACKEND
+
+
+def test_worker_module_imports_nothing_from_the_app():
+    code = ("import sys, password_worker; "
+            "print(sorted(m for m in ('neo4j', 'flask', 'neo4j_conn_Final', 'dotenv') if m in sys.modules))")
+    out = subprocess.run([sys.executable, "-c", code], cwd=BACKEND, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "[]"
+
+
+def test_pool_hashes_in_spawned_worker():
+    from utils import PasswordPool
+    from password_worker import hashpw, checkpw
+    pool = PasswordPool(workers=1, max_pending=2, timeout=30)
+    hashed = pool.run(hashpw, "secret", 4)
+    assert pool.run(checkpw, "secret", hashed) is True
+    assert pool.run(checkpw, "wrong", hashed) is False
+    assert pool.stats()["completed"] == 3
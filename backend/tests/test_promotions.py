@@ -0,0 +1,69 @@
+# tests/test_promotions.py
+import pytest
+
+
+PRODUCTS = [
+    {"id": f"p{i}", "name": f"p{i}", "price": 1.0, "category": "c", "weight": float(10 - i), "season": None, "promo": False}
+    for i in range(5)
+]
+
+
+@pytest.fixture
+def lists(monkeypatch):
+    from promotions import PromotionLists
+    shared = {"version": 0}
+
+    def bump():
+        shared["version"] += 1
+
+    monkeypatch.setattr(PromotionLists, "read_shared_version", staticmethod(lambda: shared["version"]))
+    monkeypatch.setattr(PromotionLists, "bump_shared_version", staticmethod(bump))
+    monkeypatch.setattr(PromotionLists, "fetch", staticmethod(lambda: PRODUCTS))
+    lists = PromotionLists()
+    lists.build()
+    return lists
+
+
+def test_zero_limit_returns_empty_page_at_same_position(lists):
+    from promotions import MANUAL
+    first = lists.page(MANUAL, limit=2)
+    assert [p["id"] for p in first["items"]] == ["p0", "p1"]
+
+    empty = lists.page(MANUAL, limit=0, cursor=first["next_cursor"])
+    assert empty["items"] == [] and empty["next_cursor"] == first["next_cursor"]
+    assert lists.page(MANUAL, limit=0)["items"] == []
+
+    rest = lists.page(MANUAL, limit=10, cursor=empty["next_cursor"])
+    assert [p["id"] for p in rest["items"]] == ["p2", "p3", "p4"] and rest["next_cursor"] is None
+
+
+def test_negative_limit_is_rejected(lists):
+    from promotions import MANUAL
+    with pytest.raises(ValueError):
+        lists.page(MANUAL, limit=-1)
+
+
+def test_invalidate_in_another_process_triggers_rebuild(lists, monkeypatch):
+    import promotions
+    from promotions import PromotionLists, MANUAL
+    monkeypatch.setattr(promotions, "PROMO_VERSION_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(promotions, "PROMO_BUMP_DELAY", 0)
+    other = PromotionLists()
+    other.build()
+    version = lists.page(MANUAL)["version"]
+
+    other.invalidate()
+    assert lists.page(MANUAL)["version"] == version + 1
+    assert lists.page(MANUAL)["version"] == version + 1
+
+
+def test_invalidate_bursts_bump_shared_version_once(lists, monkeypatch):
+    import promotions
+    monkeypatch.setattr(promotions, "PROMO_BUMP_DELAY", 0.05)
+    before = lists.read_shared_version()
+    for _ in range(10):
+        lists.invalidate()
+    assert lists._stale
+    timer = lists._bump_timer
+    timer.join(1)
+    assert lists.read_shared_version() == before + 1 and lists._bump_timer is None
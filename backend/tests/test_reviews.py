@@ -0,0 +1,42 @@
+# tests/test_reviews.py
+import pytest
+
+
+@pytest.fixture
+def product(neo4j_driver, graph):
+    sku = graph + "sku"
+    with neo4j_driver.session() as s:
+        s.run("CREATE (:Product {id:$id, sku:$sku})", id=graph + "p", sku=sku).consume()
+    yield sku
+    with neo4j_driver.session() as s:
+        s.run("MATCH (:Product {sku:$sku})-[:HAS_REVIEW]->(r:Review) DETACH DELETE r", sku=sku).consume()
+
+
+def _stored(driver, sku):
+    with driver.session() as s:
+        return s.run("MATCH (p:Product {sku:$sku}) RETURN p.review_count AS n, p.rating_hist AS hist",
+                     sku=sku).single().data()
+
+
+def test_add_and_rebuild_bucket_half_ratings_the_same(neo4j_driver, product):
+    from neo4j_conn_Final import Review
+    for rating in (2.5, 3.5, 4.5, 1.0):
+        Review.add(product, rating)
+    incremental = _stored(neo4j_driver, product)
+    Review.rebuild_aggregates(product)
+    assert _stored(neo4j_driver, product) == incremental == {"n": 4, "hist": [1, 0, 1, 1, 1]}
+
+
+def test_aggregates_read_does_not_write(neo4j_driver, product):
+    from neo4j_conn_Final import Review
+    with neo4j_driver.session() as s:
+        s.run("""
+            MATCH (p:Product {sku:$sku})
+            UNWIND [5, 4] AS rating
+            CREATE (p)-[:HAS_REVIEW]->(:Review {id:randomUUID(), rating:rating, date:datetime()})
+        """, sku=product).consume()
+
+    head = Review.aggregates(product)
+    assert head["review_count"] == 2 and head["average_rating"] == 4.5
+    assert head["rating_histogram"] == {"1": 0, "2": 0, "3": 0, "4": 1, "5": 1}
+    assert _stored(neo4j_driver, product) == {"n": None, "hist": None}
@@ -0,0 +1,17 @@
+# tests/test_schema.py
+from schema import schema_statements
+
+
+def test_idempotency_key_is_unique_per_user():
+    statements = schema_statements()
+    drop = statements.index("DROP CONSTRAINT order_idempotency_key_unique IF EXISTS")
+    create = statements.index(
+        "CREATE CONSTRAINT order_user_idempotency_key_unique IF NOT EXISTS "
+        "FOR (n:Order) REQUIRE (n.user_id, n.idempotency_key) IS UNIQUE")
+    assert drop < create
+
+
+def test_recorded_at_relationship_indexes():
+    statements = schema_statements()
+    for rel_type, name in (("PURCHASED", "purchased_recorded_at_index"), ("LIKED", "liked_recorded_at_index")):
+        assert f"CREATE INDEX {name} IF NOT EXISTS FOR ()-[r:{rel_type}]-() ON (r.recorded_at)" in statements
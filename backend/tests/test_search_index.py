@@ -0,0 +1,89 @@
+# tests/test_search_index.py
+import pytest
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """Товары «в Neo4j»: fetch отдаёт их копию; on_full_fetch вызывается посреди полной перестройки"""
+    from search_index import SearchIndex
+    db = {
+        "p1": {"id": "p1", "name": "red kettle", "category": "kitchen", "brand": "a", "price": 10.0},
+        "p2": {"id": "p2", "name": "blue mug", "category": "kitchen", "brand": "b", "price": 5.0},
+    }
+    hooks = {"on_full_fetch": None}
+
+    def fetch(product_ids=None):
+        snapshot = [dict(p) for pid, p in db.items() if product_ids is None or pid in product_ids]
+        if product_ids is None and hooks["on_full_fetch"]:
+            hook, hooks["on_full_fetch"] = hooks["on_full_fetch"], None
+            hook()
+        return snapshot
+
+    monkeypatch.setattr(SearchIndex, "fetch", staticmethod(fetch))
+    return db, hooks
+
+
+def _names(index, q):
+    return [doc["name"] for doc, _ in index.search(q)]
+
+
+def test_refresh_during_rebuild_survives_swap(catalog):
+    from search_index import SearchIndex
+    db, hooks = catalog
+    index = SearchIndex()
+    index.build()
+
+    def write_during_build():
+        db["p1"]["name"] = "green kettle"
+        index.refresh(["p1"])
+        del db["p2"]
+        index.remove("p2")
+
+    hooks["on_full_fetch"] = write_during_build
+    index.build()
+    assert _names(index, "kettle") == ["green kettle"]
+    assert _names(index, "mug") == []
+    assert index._touched_during_build == []
+
+
+def test_refresh_without_rebuild_is_not_replayed(catalog):
+    from search_index import SearchIndex
+    db, _ = catalog
+    index = SearchIndex()
+    index.build()
+    db["p2"]["name"] = "blue cup"
+    index.refresh(["p2"])
+    assert _names(index, "cup") == ["blue cup"]
+    assert index._touched_during_build == []
+
+
+def _bulk_index(count):
+    from search_index import SearchIndex
+    index = SearchIndex()
+    # w1, w10, w11, ... w1999: у префикса "w1" больше тысячи продолжений с разной частотой
+    index.build([{"id": f"p{i}", "name": " ".join(f"w{j}" for j in range(i % 40, i % 40 + 5)) + f" w1{i}",
+                  "category": "c", "brand": "b", "price": 1.0} for i in range(count)])
+    return index
+
+
+def test_prefix_expansion_is_capped_to_most_frequent_terms(monkeypatch):
+    import search_index
+    index = _bulk_index(2000)
+    completions = index._expand("w1", limit=10 ** 6)
+    assert completions == ["w1"]  # короче SEARCH_PREFIX_MIN — только точное совпадение
+
+    monkeypatch.setattr(search_index, "SEARCH_PREFIX_MIN", 2)
+    all_terms = [t for t in index.terms if t.startswith("w1")]
+    assert len(all_terms) > 1000
+    capped = index._expand("w1", limit=5)
+    assert len(capped) == 6 and capped[0] == "w1"
+    frequencies = sorted((len(index.postings[t]) for t in all_terms if t != "w1"), reverse=True)
+    assert sorted((len(index.postings[t]) for t in capped[1:]), reverse=True) == frequencies[:5]
+
+
+def test_short_prefix_matches_exact_term_only():
+    index = _bulk_index(200)
+    hits = index.search("w1")
+    assert hits and all("w1" in doc["name"].split() for doc, _ in hits)
+    # с SEARCH_PREFIX_MIN символов — уже по префиксу
+    assert any("w11" not in doc["name"].split() for doc, _ in index.search("w11"))
@@ -0,0 +1,53 @@
+# tests/test_segments.py
+
+
+def _purchases(driver, user_id, prefix, prices, returned=()):
+    with driver.session() as s:
+        s.run("""
+            CREATE (u:User {id:$user_id})
+            WITH u
+            UNWIND range(0, size($prices) - 1) AS i
+            CREATE (p:Product {id:$prefix + 'p' + toString(i), price:$prices[i]})
+            CREATE (u)-[:PURCHASED {time:datetime()}]->(p)
+            FOREACH (_ IN CASE WHEN i IN $returned THEN [1] ELSE [] END |
+                CREATE (u)-[:RETURNED {time:datetime()}]->(p))
+        """, user_id=user_id, prefix=prefix, prices=prices, returned=list(returned)).consume()
+
+
+def test_refresh_segments_nets_out_returns(neo4j_driver, graph):
+    from neo4j_conn_Final import User
+    user_id = graph + "u"
+    _purchases(neo4j_driver, user_id, graph, [100.0, 200.0, 300.0, 400.0], returned=[3])
+
+    assert User.refresh_segments([user_id]) == 1
+    profile = User.get_user_profile_segment(user_id)
+    assert profile["frequency"] == 3
+    assert profile["monetary"] == 600.0
+    assert profile["recency_days"] == 0
+    assert profile["segment"] == "active"
+
+
+def test_refresh_segments_user_without_purchases(neo4j_driver, graph):
+    from neo4j_conn_Final import User
+    user_id = graph + "u"
+    with neo4j_driver.session() as s:
+        s.run("CREATE (:User {id:$user_id})", user_id=user_id).consume()
+
+    assert User.refresh_segments([user_id]) == 1
+    profile = User.get_user_profile_segment(user_id)
+    assert profile["segment"] == "newbie"
+    assert profile["frequency"] == 0
+    assert profile["recency_days"] is None
+    assert profile["rfm"] == [0, 0, 0]
+
+
+def test_profile_without_stored_segment_is_computed_read_only(neo4j_driver, graph):
+    from neo4j_conn_Final import User
+    user_id = graph + "u"
+    _purchases(neo4j_driver, user_id, graph, [50.0, 70.0, 80.0])
+
+    profile = User.get_user_profile_segment(user_id)
+    assert profile["segment"] == "active" and profile["frequency"] == 3 and profile["monetary"] == 200.0
+    with neo4j_driver.session() as s:
+        stored = s.run("MATCH (u:User {id:$id}) RETURN u.segment AS segment", id=user_id).single()["segment"]
+    assert stored is None
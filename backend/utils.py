@@ -1,9 +1,13 @@
 # utils.py
-import bcrypt
 import jwt
 import os
 import datetime
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
+from password_worker import hashpw, checkpw
 
 load_dotenv()
 
@@ -11,31 +15,125 @@ JWT_SECRET = os.getenv("JWT_SECRET", "supersecretchangeit")
 JWT_ALGORITHM = "HS256"
 JWT_EXP_DELTA_SECONDS = 3600  # токен живёт 1 час
 
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", os.cpu_count() or 2))  # 0 — считать в потоке запроса
+PASSWORD_POOL_MAX_PENDING = int(os.getenv("PASSWORD_POOL_MAX_PENDING", 64))
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", 5.0))
+
 
 # ------------------------
 # Password hashing
 # ------------------------
+class PasswordPoolBusy(Exception):
+    """Очередь bcrypt-задач заполнена"""
+
+
+class PasswordPoolTimeout(Exception):
+    """bcrypt-задача не уложилась в PASSWORD_TIMEOUT"""
+
+
+class PasswordPool:
+    """
+    Пул процессов для bcrypt: хэширование не держит потоки веб-сервера и
+    масштабируется по ядрам. Не больше max_pending задач одновременно,
+    ожидание результата ограничено timeout.
+    """
+
+    def __init__(self, workers=PASSWORD_POOL_WORKERS, max_pending=PASSWORD_POOL_MAX_PENDING, timeout=PASSWORD_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.seconds_total = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: без fork процесса, в котором уже крутятся потоки драйвера и очередей.
+                # Воркер импортирует только password_worker и главный модуль как __mp_main__,
+                # поэтому стартовая работа AppFull стоит под проверкой __name__
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordPoolBusy(f"password pool is saturated ({self.max_pending} pending)")
+        started = time.monotonic()
+        with self._lock:
+            self.pending += 1
+        future = self._get_executor().submit(fn, *args)
+        future.add_done_callback(self._done)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self.timeouts += 1
+            raise PasswordPoolTimeout(f"password hashing took longer than {self.timeout}s")
+        with self._lock:
+            self.seconds_total += time.monotonic() - started
+        return result
+
+    def _done(self, future):
+        # слот освобождается, когда задача реально закончилась, даже если вызывающий ушёл по таймауту
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def stats(self):
+        return {
+            "workers": self.workers, "max_pending": self.max_pending,
+            "pending": self.pending, "saturation": round(self.pending / self.max_pending, 3),
+            "completed": self.completed, "rejected": self.rejected, "timeouts": self.timeouts,
+            "avg_seconds": round(self.seconds_total / self.completed, 4) if self.completed else 0.0,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+        }
+
+
+password_pool = PasswordPool()
+
+
 def hash_password(password: str) -> str:
     """Возвращает хэш пароля"""
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed.decode('utf-8')
+    return password_pool.run(hashpw, password, BCRYPT_ROUNDS)
 
 
 def verify_password(password: str, hashed: str) -> bool:
     """Проверяет пароль с хэшем"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return password_pool.run(checkpw, password, hashed)
+
+
+def needs_rehash(hashed: str) -> bool:
+    """True, если хэш посчитан с другим cost factor, чем BCRYPT_ROUNDS ($2b$<cost>$...)"""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
 
 
 # ------------------------
 # JWT токены
 # ------------------------
-def create_access_token(user_id: str) -> str:
-    """Создаёт JWT токен с user_id"""
-    payload = {
-        "user_id": user_id,
-        "exp": datetime.datetime.utcnow() + datetime.timedelta(seconds=JWT_EXP_DELTA_SECONDS)
-    }
+def create_access_token(user_id: str, extra: dict = None, minutes: int = None) -> str:
+    """
+    Создаёт JWT токен с user_id.
+    extra — дополнительные claims (например {"action": "reset_password"}),
+    minutes — время жизни вместо JWT_EXP_DELTA_SECONDS.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lifetime = datetime.timedelta(minutes=minutes) if minutes else datetime.timedelta(seconds=JWT_EXP_DELTA_SECONDS)
+    payload = dict(extra or {})
+    payload.update({"user_id": user_id, "iat": int(now.timestamp()), "exp": now + lifetime})
     token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return token
 
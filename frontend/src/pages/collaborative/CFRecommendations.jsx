@@ -32,6 +32,7 @@ export default function CFRecommendations({ userId }) {
         <select value={algo} onChange={e => setAlgo(e.target.value)}>
           <option value="user_based">User-based CF</option>
           <option value="item_based">Item-based CF</option>
+          <option value="als">Matrix factorization (ALS)</option>
         </select>
       </div>
 